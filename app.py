@@ -2,6 +2,7 @@ import streamlit as st
 import pandas as pd
 from modules.case_manager import QAManager
 from modules.claude_vision_reader import ClaudeVisionReader
+from modules.whisper_manager import get_manager
 import sqlite3
 import os
 
@@ -12,6 +13,9 @@ st.set_page_config(
 )
 
 st.title("遺言作成補助システム ダッシュボード")
+
+# 文字起こしモデルをバックグラウンドで読み込んでおく（プロセスごとに1回）
+get_manager().warm_up()
 st.markdown("""
 <div style='font-size:20px; color:#555; margin-bottom:24px;'>
   サイドバーからページを選択してください。<br>
@@ -0,0 +1,168 @@
+"""
+テキスト処理（要約）のスループットのベンチマーク
+
+ローカルのスタブサーバー（dev/llm_stub_server.py）をOpenAIの代わりに起動し、
+modules/summarizer.py の要約処理（チャンクごとの整形・要約と段階的な統合）を
+複数の面談で同時に実行して、スループット・遅延の分布・エラーと再試行の回数を表示する。
+APIキーや課金なしで、並列度・レート制御・キャッシュの変更の効果を比較できる。
+
+使い方（リポジトリのルートで実行）:
+    python dev/benchmark_llm.py --interviews 50 --chars 20000 --latency lognormal:800,0.5 --rate-429 0.05
+    python dev/benchmark_llm.py --interviews 50 --cache --repeat 2     # キャッシュの効果
+    python dev/benchmark_llm.py --base-url http://127.0.0.1:8765/v1    # 起動済みのスタブを使う
+"""
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, List
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from llm_stub_server import add_backend_arguments, backend_from_args, start_server, _SENTENCES
+
+
+def make_transcript(index: int, chars: int) -> str:
+    """面談ごとに異なる、話者ラベルのない文字起こし風のテキスト"""
+    parts, i = [], index
+    while sum(len(p) for p in parts) < chars:
+        parts.append(_SENTENCES[i % len(_SENTENCES)].rstrip("。") + f"（{index}-{len(parts)}）。")
+        i += index % 5 + 1
+    return "".join(parts)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="要約処理のスループット・遅延・再試行回数を測る")
+    parser.add_argument("--interviews", type=int, default=50, help="面談の数")
+    parser.add_argument("--parallel", type=int, default=None, help="同時に処理する面談の数（既定は全件）")
+    parser.add_argument("--chars", type=int, default=12000, help="1面談あたりの文字起こしの文字数")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="1面談あたりのAPI呼び出しの並列数")
+    parser.add_argument("--rpm", type=int, default=None, help="レート制御のRPM（既定はrate_limiterの既定値）")
+    parser.add_argument("--tpm", type=int, default=None, help="レート制御のTPM")
+    parser.add_argument("--cache", action="store_true", help="応答キャッシュを使う（一時ファイル）")
+    parser.add_argument("--repeat", type=int, default=1, help="同じ面談を繰り返す回数（キャッシュの効果の確認）")
+    parser.add_argument("--base-url", default=None, help="起動済みのOpenAI互換サーバーのURL")
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+
+    backend = None
+    if args.base_url:
+        base_url = args.base_url
+    else:
+        backend = backend_from_args(args)
+        server = start_server(backend)
+        base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    os.environ["LLM_CONCURRENCY"] = str(args.llm_concurrency)
+    if not args.cache:
+        os.environ["LLM_CACHE_DISABLED"] = "1"
+
+    from modules import lazy_imports, llm_cache, llm_client, rate_limiter, summarizer
+
+    tmp_dir = tempfile.mkdtemp(prefix="benchmark_llm_")
+    if args.cache:
+        llm_cache._cache = llm_cache.LLMCache(os.path.join(tmp_dir, "llm_cache.db"))
+
+    # レート制御はこのプロセス内だけで共有し、429による待機の回数を数える
+    counters = {"rate_limited": 0, "calls": 0, "failed_calls": 0}
+    lock = threading.Lock()
+
+    class CountingGovernor(rate_limiter.RateGovernor):
+        def report_rate_limited(self, provider, retry_after=10.0):
+            with lock:
+                counters["rate_limited"] += 1
+            super().report_rate_limited(provider, retry_after)
+
+    limits = {"openai": {k: v for k, v in (("rpm", args.rpm), ("tpm", args.tpm)) if v}}
+    rate_limiter._governor = CountingGovernor(store=rate_limiter.MemoryBucketStore(), limits=limits)
+
+    call_latencies: List[float] = []
+
+    class CountingClient:
+        """APIへのリクエスト（chat.completions.create）ごとに回数・遅延・失敗を数えるクライアント"""
+        def __init__(self, client):
+            self._client = client
+            self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+        def _create(self, **kwargs):
+            started = time.monotonic()
+            try:
+                return self._client.chat.completions.create(**kwargs)
+            except Exception:
+                with lock:
+                    counters["failed_calls"] += 1
+                raise
+            finally:
+                with lock:
+                    counters["calls"] += 1
+                    call_latencies.append(time.monotonic() - started)
+
+    # SDKの再試行は無効にし、429はすべてRateGovernorが待機・再試行する（サーバーの429の件数と一致する）
+    llm_client._client = CountingClient(lazy_imports.openai().OpenAI(
+        **llm_client.openai_settings(), max_retries=rate_limiter.SDK_MAX_RETRIES))
+
+    transcripts = [make_transcript(i, args.chars) for i in range(args.interviews)]
+    token_counting = contextlib.nullcontext()
+    try:
+        chunk_lists = [summarizer.split_text(t, max_tokens=summarizer.FORMAT_CHUNK_TOKENS) for t in transcripts]
+    except Exception as e:
+        # tiktokenの語彙を取得できない環境では、分割も統合時のトークン数も文字数から見積もる（1トークン≒1文字）
+        print(f"トークン数での分割ができないため、文字数で分割します: {e}")
+        token_counting = mock.patch.object(summarizer, "count_tokens", rate_limiter.estimate_tokens)
+        size = summarizer.FORMAT_CHUNK_TOKENS
+        chunk_lists = [[t[i:i + size] for i in range(0, len(t), size)] for t in transcripts]
+
+    def run_interview(chunks) -> Dict:
+        started = time.monotonic()
+        _, summary, errors = summarizer.map_reduce_summarize(chunks, format_chunks=True)
+        return {"seconds": time.monotonic() - started, "errors": len(errors), "ok": bool(summary) and not errors}
+
+    print(f"接続先: {base_url}  面談: {args.interviews}件 × {args.repeat}回  "
+          f"チャンク: 平均{sum(map(len, chunk_lists)) / len(chunk_lists):.1f}個")
+    for round_index in range(args.repeat):
+        calls_before = counters["calls"]
+        del call_latencies[:]
+        started = time.monotonic()
+        with token_counting, ThreadPoolExecutor(max_workers=args.parallel or args.interviews) as executor:
+            results = list(executor.map(run_interview, chunk_lists))
+        wall = time.monotonic() - started
+        seconds = [r["seconds"] for r in results]
+        calls = counters["calls"] - calls_before
+
+        print(f"\n[{round_index + 1}回目]")
+        print(f"  所要時間        {wall:.1f}秒（{len(results) / wall * 60:.1f}件/分, {calls / wall:.1f}呼び出し/秒）")
+        print(f"  面談ごとの遅延  p50 {percentile(seconds, 0.5):.1f}秒  p95 {percentile(seconds, 0.95):.1f}秒  "
+              f"p99 {percentile(seconds, 0.99):.1f}秒  最大 {max(seconds):.1f}秒")
+        print(f"  呼び出しの遅延  p50 {percentile(call_latencies, 0.5):.2f}秒  "
+              f"p95 {percentile(call_latencies, 0.95):.2f}秒  p99 {percentile(call_latencies, 0.99):.2f}秒")
+        print(f"  失敗した面談    {sum(1 for r in results if not r['ok'])}件（エラー {sum(r['errors'] for r in results)}件）")
+        if llm_cache.get_cache() is not None:
+            stats = llm_cache.get_cache().stats()
+            print(f"  応答キャッシュ  ヒット {stats['hits']}  ミス {stats['misses']}")
+
+    print("\n[合計]")
+    print(f"  API呼び出し     {counters['calls']}回（失敗 {counters['failed_calls']}回、429を含む）")
+    print(f"  429による待機   {counters['rate_limited']}回（RateGovernor）")
+    if backend is not None:
+        stats = backend.summary()
+        print(f"  サーバー        リクエスト {stats['requests']}件  成功 {stats['ok']}  "
+              f"429 {stats['429']}  500 {stats['500']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+文字起こしエンジンのベンチマーク
+
+サンプル音声をエンジンごとに文字起こしし、実時間係数（RTF: 処理時間 / 音声の長さ）と
+正解テキストとの誤り率（WER: 空白区切りの単語、CER: 文字）を比較する。
+正解テキストは音声ファイルと同じ名前の .txt に置く（例: sample.wav と sample.txt）。
+
+使い方（リポジトリのルートで実行）:
+    python dev/benchmark_stt.py samples/*.wav --engines whisper faster_whisper --model base
+"""
+import argparse
+import os
+import sys
+import time
+import unicodedata
+from typing import Dict, List, Optional, Sequence
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from modules.parallel_transcriber import load_audio
+from modules.speech_to_text import get_engine, ENGINES
+from modules.vad import SAMPLE_RATE
+
+
+def edit_distance(reference: Sequence, hypothesis: Sequence) -> int:
+    """レーベンシュタイン距離（置換・挿入・削除の回数）"""
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref in enumerate(reference, start=1):
+        current = [i] + [0] * len(hypothesis)
+        for j, hyp in enumerate(hypothesis, start=1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref != hyp))
+        previous = current
+    return previous[-1]
+
+
+def _normalize(text: str) -> str:
+    """句読点と空白の違いで誤りにならないよう正規化する"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(c if not unicodedata.category(c).startswith("P") else " " for c in text)
+
+
+def error_rates(reference: str, hypothesis: str) -> Dict[str, float]:
+    """WER（空白区切りの単語）とCER（空白を除いた文字）"""
+    ref, hyp = _normalize(reference), _normalize(hypothesis)
+    ref_words, hyp_words = ref.split(), hyp.split()
+    ref_chars, hyp_chars = "".join(ref_words), "".join(hyp_words)
+    return {
+        "wer": edit_distance(ref_words, hyp_words) / max(1, len(ref_words)),
+        "cer": edit_distance(ref_chars, hyp_chars) / max(1, len(ref_chars)),
+    }
+
+
+def _read_reference(audio_path: str) -> Optional[str]:
+    path = os.path.splitext(audio_path)[0] + ".txt"
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def benchmark(files: List[str], engine_name: str, model_size: str, language: str,
+              compute_type: Optional[str] = None, threads: int = 0) -> List[Dict]:
+    """1つのエンジンで全ファイルを文字起こしし、ファイルごとの結果を返す"""
+    engine = get_engine(engine_name, compute_type)
+    started = time.perf_counter()
+    model = engine.load(model_size, threads=threads)
+    load_seconds = time.perf_counter() - started
+    print(f"[{engine_name}] モデル読み込み: {load_seconds:.1f}秒")
+
+    rows = []
+    for path in files:
+        audio = load_audio(path)
+        duration = len(audio) / SAMPLE_RATE
+        started = time.perf_counter()
+        result = engine.transcribe(model, audio, language=language)
+        elapsed = time.perf_counter() - started
+        row = {"engine": engine_name, "file": os.path.basename(path), "duration": duration,
+               "seconds": elapsed, "rtf": elapsed / duration if duration else 0.0}
+        reference = _read_reference(path)
+        if reference is not None:
+            row.update(error_rates(reference, result["text"]))
+        rows.append(row)
+        print(f"  {row['file']}: {duration:.1f}秒 → {elapsed:.1f}秒 (RTF {row['rtf']:.3f})"
+              + (f" WER {row['wer']:.3f} CER {row['cer']:.3f}" if "wer" in row else ""))
+    return rows
+
+
+def summarize(rows: List[Dict]):
+    """エンジンごとの合計（RTFは総処理時間 / 総音声長、誤り率は平均）"""
+    print("\nエンジン          RTF      速度比    WER      CER")
+    baseline = None
+    for engine_name in dict.fromkeys(r["engine"] for r in rows):
+        engine_rows = [r for r in rows if r["engine"] == engine_name]
+        rtf = sum(r["seconds"] for r in engine_rows) / max(1e-9, sum(r["duration"] for r in engine_rows))
+        baseline = baseline or rtf
+        scored = [r for r in engine_rows if "wer" in r]
+        wer = f"{sum(r['wer'] for r in scored) / len(scored):.3f}" if scored else "-"
+        cer = f"{sum(r['cer'] for r in scored) / len(scored):.3f}" if scored else "-"
+        print(f"{engine_name:<16}  {rtf:.3f}    x{baseline / rtf:.2f}     {wer:<7}  {cer}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文字起こしエンジンのRTFと誤り率を比較する")
+    parser.add_argument("files", nargs="+", help="音声ファイル（正解テキストは同名の.txt）")
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument("--model", default="base", help="モデルサイズ")
+    parser.add_argument("--language", default="ja")
+    parser.add_argument("--compute-type", default=None, help="faster_whisperの量子化方式（int8など）")
+    parser.add_argument("--threads", type=int, default=0, help="推論スレッド数（0は既定値）")
+    args = parser.parse_args()
+
+    rows = []
+    for engine_name in args.engines:
+        rows.extend(benchmark(args.files, engine_name, args.model, args.language,
+                              args.compute_type, args.threads))
+    summarize(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+ページごとの読み込み時間の計測
+
+各ページ（app.py と pages/*.py）の先頭のimport文だけを取り出し、新しいPythonプロセスで
+実行して読み込み時間を計る。予算（秒）を超えたページがあれば終了コード1で終了するため、
+デプロイ前のチェックに使える。--detail を付けると時間のかかったモジュールも表示する。
+
+使い方（リポジトリのルートで実行）:
+    python dev/import_budget.py
+    python dev/import_budget.py --budget 1.0 --detail
+"""
+import argparse
+import ast
+import glob
+import os
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# ページごとの予算（秒）。指定のないページは --budget の値を使う
+DEFAULT_BUDGET = 1.5
+PAGE_BUDGETS = {}
+
+_TIMER = """
+import sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+{imports}
+print(time.perf_counter() - started)
+"""
+
+
+def top_level_imports(path: str) -> List[str]:
+    """ページの最上位にあるimport文（関数内のimportは対象外）"""
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    tree = ast.parse(source, filename=path)
+    return [
+        ast.get_source_segment(source, node)
+        for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    ]
+
+
+def measure(path: str, repeat: int = 3) -> Dict:
+    """
+    ページのimportを別プロセスで実行し、読み込み時間（repeat回の最小値）を計る
+
+    Returns:
+        Dict: seconds（失敗した場合はNone）, error
+    """
+    script = _TIMER.format(root=os.path.abspath(ROOT), imports="\n".join(top_level_imports(path)))
+    timings = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True)
+        if proc.returncode != 0:
+            return {"seconds": None, "error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "不明なエラー"}
+        timings.append(float(proc.stdout.strip().splitlines()[-1]))
+    return {"seconds": min(timings), "error": None}
+
+
+def _import_times(script: str) -> List[tuple]:
+    """-X importtime の出力のうち、直接importされたモジュール（入れ子の深さ0）の累積時間"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", script], cwd=ROOT,
+                          capture_output=True, text=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if len(name) - len(name.lstrip()) == 1:
+            rows.append((int(cumulative) / 1e6, name.strip()))
+    return rows
+
+
+def slowest_modules(path: str, limit: int = 5) -> List[tuple]:
+    """ページのimportで読み込みに時間のかかったモジュール（累積時間順）"""
+    script = _TIMER.format(root=os.path.abspath(ROOT), imports="\n".join(top_level_imports(path)))
+    # インタープリタの起動時に読み込まれるモジュールは除く
+    startup = {name for _, name in _import_times(_TIMER.format(root=os.path.abspath(ROOT), imports=""))}
+    rows = [(sec, name) for sec, name in _import_times(script) if name not in startup]
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="ページごとのimport時間を計測し、予算超過を検出する")
+    parser.add_argument("pages", nargs="*", help="対象のページ（省略時は app.py と pages/*.py）")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="1ページあたりの予算（秒）")
+    parser.add_argument("--repeat", type=int, default=3, help="計測回数（最小値を採用）")
+    parser.add_argument("--detail", action="store_true", help="時間のかかったモジュールを表示する")
+    args = parser.parse_args(argv)
+
+    pages = args.pages or [os.path.join(ROOT, "app.py")] + sorted(glob.glob(os.path.join(ROOT, "pages", "*.py")))
+    failed = []
+    for path in pages:
+        name = os.path.relpath(path, ROOT)
+        budget = PAGE_BUDGETS.get(name, args.budget)
+        result = measure(path, args.repeat)
+        if result["seconds"] is None:
+            print(f"[ERROR] {name}: {result['error']}")
+            failed.append(name)
+            continue
+        status = "OK  " if result["seconds"] <= budget else "OVER"
+        print(f"[{status}] {name}: {result['seconds']:.2f}秒（予算 {budget:.2f}秒）")
+        if result["seconds"] > budget:
+            failed.append(name)
+        if args.detail:
+            for seconds, module in slowest_modules(path):
+                print(f"         {module}: {seconds:.2f}秒")
+
+    if failed:
+        print(f"\n予算を超えた、または読み込みに失敗したページ: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
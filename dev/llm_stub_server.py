@@ -0,0 +1,284 @@
+"""
+OpenAI互換のローカルのスタブサーバー（開発・ベンチマーク用）
+
+/v1/chat/completions に、スクリプトで決めた応答を返す。ネットワークや課金なしで
+要約・カテゴリ分類などのテキスト処理を動かし、遅延・429・500を意図的に発生させて
+並列度やキャッシュの変更の効果を測るために使う。
+
+- 応答: --script のJSON（[{"match": "正規表現", "response": "応答"}]）で最初に一致したもの。
+  一致しない場合は入力から決まる固定の文章を返す（同じ入力には常に同じ応答）。
+  response_formatにjson_schemaを指定した場合は、スキーマに沿ったJSONを返す。
+- 遅延: --latency fixed:800 / uniform:300,1500 / lognormal:800,0.5（ミリ秒、lognormalは中央値とσ）
+  と、ストリーミング時の1断片ごとの遅延 --token-ms
+- エラー: --rate-429 / --rate-500 の確率で429（retry-after付き）・500を返す
+- 集計: GET /stats でリクエスト数・エラー数・遅延を返す
+
+使い方（リポジトリのルートで実行）:
+    python dev/llm_stub_server.py --port 8765 --latency lognormal:800,0.5 --rate-429 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub streamlit run app.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# 既定の応答に使う文（入力のハッシュで選ぶ）
+_SENTENCES = [
+    "顧客は事業承継に向けて自社株の評価方法を確認したいと話した。",
+    "担当者は定期預金の満期と今後の資金計画について説明した。",
+    "相続人の構成と遺言の有無について確認した。",
+    "投資信託のリスク許容度について、次回までに検討することになった。",
+    "必要書類として登記簿謄本と固定資産評価証明書を依頼した。",
+    "次回面談は来月中旬を予定している。",
+]
+
+
+class Latency:
+    """遅延の分布（ミリ秒）"""
+    def __init__(self, spec: str, rng: random.Random):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",")] if params else []
+        self.rng = rng
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"不明な遅延の分布です: {spec}")
+
+    def sample(self) -> float:
+        """1回分の遅延（秒）"""
+        if self.kind == "fixed":
+            ms = self.params[0] if self.params else 0.0
+        elif self.kind == "uniform":
+            ms = self.rng.uniform(self.params[0], self.params[1])
+        else:
+            median, sigma = self.params[0], self.params[1] if len(self.params) > 1 else 0.5
+            ms = self.rng.lognormvariate(0.0, sigma) * median
+        return ms / 1000.0
+
+
+def _sample_from_schema(schema: Dict, seed: int):
+    """JSONスキーマに沿った値（文字列は固定の文）"""
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: _sample_from_schema(value, seed + i)
+                for i, (key, value) in enumerate(schema.get("properties", {}).items())}
+    if kind == "array":
+        return [_sample_from_schema(schema.get("items", {}), seed)]
+    if kind in ("integer", "number"):
+        return 0
+    if kind == "boolean":
+        return False
+    return _SENTENCES[seed % len(_SENTENCES)]
+
+
+class StubBackend:
+    """応答の決定・遅延・エラーの注入と集計"""
+    def __init__(self, script: Optional[List[Dict]] = None, latency: str = "fixed:0", token_ms: float = 0.0,
+                 rate_429: float = 0.0, rate_500: float = 0.0, retry_after: float = 1.0,
+                 seed: Optional[int] = None):
+        self.rng = random.Random(seed)
+        self.rules = [(re.compile(rule["match"], re.S), rule["response"]) for rule in (script or [])]
+        self.latency = Latency(latency, self.rng)
+        self.token_ms = token_ms
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "ok": 0, "429": 0, "500": 0, "latencies": []}
+
+    def decide(self) -> Dict:
+        """今回のリクエストの結果（エラーの有無と遅延）"""
+        with self._lock:
+            self.stats["requests"] += 1
+            roll = self.rng.random()
+            delay = self.latency.sample()
+        if roll < self.rate_429:
+            status = 429
+        elif roll < self.rate_429 + self.rate_500:
+            status = 500
+        else:
+            status = 200
+        return {"status": status, "delay": delay}
+
+    def record(self, status: int, seconds: float):
+        with self._lock:
+            self.stats["ok" if status == 200 else str(status)] += 1
+            if status == 200:
+                self.stats["latencies"].append(seconds)
+
+    def respond(self, request: Dict) -> str:
+        """リクエストに対する応答のテキスト"""
+        messages = request.get("messages", [])
+        prompt = "\n".join(m.get("content", "") for m in messages if isinstance(m.get("content"), str))
+        seed = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16)
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            schema = response_format.get("json_schema", {}).get("schema", {})
+            return json.dumps(_sample_from_schema(schema, seed), ensure_ascii=False)
+        for pattern, response in self.rules:
+            if pattern.search(prompt):
+                return response
+        # 出力の上限の目安（1トークン≒1文字）に収まる長さで、入力に応じた文を並べる
+        length = min(int(request.get("max_tokens") or 500), max(60, len(prompt) // 4))
+        text, i = "", 0
+        while len(text) < length:
+            text += _SENTENCES[(seed + i) % len(_SENTENCES)]
+            i += 1
+        return text
+
+    def summary(self) -> Dict:
+        with self._lock:
+            latencies = sorted(self.stats["latencies"])
+            result = {k: v for k, v in self.stats.items() if k != "latencies"}
+        if latencies:
+            result["latency_p50"] = latencies[len(latencies) // 2]
+            result["latency_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return result
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text))
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 429の後にまとめて再送されても接続を拒否しないよう、待ち行列を大きくする
+    request_queue_size = 256
+
+
+def make_handler(backend: StubBackend):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _json(self, status: int, body: Dict, headers: Optional[Dict] = None):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                self._json(200, backend.summary())
+            elif self.path.rstrip("/").endswith("/models"):
+                self._json(200, {"object": "list", "data": [{"id": "stub", "object": "model"}]})
+            else:
+                self._json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._json(404, {"error": {"message": "not found"}})
+                return
+            started = time.monotonic()
+            decision = backend.decide()
+            time.sleep(decision["delay"])
+            if decision["status"] == 429:
+                backend.record(429, time.monotonic() - started)
+                self._json(429, {"error": {"message": "Rate limit reached (stub)", "type": "rate_limit_error",
+                                           "code": "rate_limit_exceeded"}},
+                           {"retry-after": str(backend.retry_after)})
+                return
+            if decision["status"] == 500:
+                backend.record(500, time.monotonic() - started)
+                self._json(500, {"error": {"message": "Internal server error (stub)", "type": "server_error"}})
+                return
+
+            text = backend.respond(request)
+            model = request.get("model", "stub")
+            completion_id = f"chatcmpl-stub-{int(time.time() * 1000)}"
+            if request.get("stream"):
+                self._stream(completion_id, model, text)
+            else:
+                prompt_tokens = sum(_tokens(m.get("content") or "") for m in request.get("messages", []))
+                self._json(200, {
+                    "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                 "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": _tokens(text),
+                              "total_tokens": prompt_tokens + _tokens(text)},
+                })
+            backend.record(200, time.monotonic() - started)
+
+        def _stream(self, completion_id: str, model: str, text: str):
+            """Server-Sent Eventsで数文字ずつ返す"""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            def send(delta: Dict, finish_reason: Optional[str] = None):
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            send({"role": "assistant", "content": ""})
+            for i in range(0, len(text), 4):
+                if backend.token_ms:
+                    time.sleep(backend.token_ms / 1000.0)
+                send({"content": text[i:i + 4]})
+            send({}, "stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def start_server(backend: StubBackend, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """バックグラウンドのスレッドでサーバーを起動する（port=0は空いているポート）"""
+    server = StubServer((host, port), make_handler(backend))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_backend_arguments(parser: argparse.ArgumentParser):
+    """スタブの挙動を指定する引数（ベンチマークと共通）"""
+    parser.add_argument("--script", default=None, help="応答のスクリプト（JSON: [{match, response}]）")
+    parser.add_argument("--latency", default="lognormal:800,0.5",
+                        help="遅延の分布（fixed:ms / uniform:min,max / lognormal:median,sigma）")
+    parser.add_argument("--token-ms", type=float, default=0.0, help="ストリーミング時の1断片ごとの遅延（ミリ秒）")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="429を返す確率")
+    parser.add_argument("--rate-500", type=float, default=0.0, help="500を返す確率")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429のretry-after（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+
+
+def backend_from_args(args) -> StubBackend:
+    script = None
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as f:
+            script = json.load(f)
+    return StubBackend(script, args.latency, args.token_ms, args.rate_429, args.rate_500,
+                       args.retry_after, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI互換のローカルのスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port), make_handler(backend_from_args(args)))
+    print(f"http://{args.host}:{server.server_port}/v1 で待機中（Ctrl+Cで終了）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
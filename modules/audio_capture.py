@@ -1,31 +1,174 @@
 import streamlit as st
 import os
-import tempfile
-import sounddevice as sd
 import numpy as np
-import wave
 import threading
-import time
 import logging
+import uuid
+from modules import lazy_imports
+from modules.wav_io import IncrementalWavWriter, StreamingResampler, TARGET_SAMPLE_RATE
+from modules.live_transcriber import LiveTranscriber, segments_path
+from modules.audio_decode import decode_audio, AudioDecodeError
 
 # ログの設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Streamlitのaudio_recorderウィジェットを使って録音
+# 録音設定
+SAMPLE_RATE = 44100
+CHANNELS = 1
+# リングバッファに保持する秒数（書き出しスレッドが遅れても取りこぼさない余裕）
+BUFFER_SECONDS = 30
+# ファイルへ書き出す間隔（秒）
+FLUSH_INTERVAL = 0.5
 
 
-# グローバル変数
-recording = None
-is_recording = False
-recording_thread = None
+class RingBuffer:
+    """int16の音声フレームを保持する固定長のリングバッファ"""
+    def __init__(self, capacity_frames: int, channels: int = CHANNELS):
+        self._buffer = np.zeros((capacity_frames, channels), dtype=np.int16)
+        self._capacity = capacity_frames
+        self._written = 0  # 書き込んだ総フレーム数
+        self._read = 0  # 読み出した総フレーム数
+        self._lock = threading.Lock()
+        self.dropped_frames = 0
+
+    def write(self, frames: np.ndarray):
+        """フレームを書き込む（空きがない場合は入りきらない分を破棄）"""
+        with self._lock:
+            free = self._capacity - (self._written - self._read)
+            if len(frames) > free:
+                self.dropped_frames += len(frames) - free
+                frames = frames[:free]
+            count = len(frames)
+            if count == 0:
+                return
+            start = self._written % self._capacity
+            first = min(count, self._capacity - start)
+            self._buffer[start:start + first] = frames[:first]
+            if count > first:
+                self._buffer[:count - first] = frames[first:]
+            self._written += count
+
+    def read_available(self) -> np.ndarray:
+        """未読のフレームをすべて取り出す"""
+        with self._lock:
+            count = self._written - self._read
+            start = self._read % self._capacity
+            first = min(count, self._capacity - start)
+            data = np.concatenate([self._buffer[start:start + first], self._buffer[:count - first]])
+            self._read += count
+            return data
+
+    @property
+    def total_frames(self) -> int:
+        """これまでに書き込んだ総フレーム数"""
+        return self._written
+
+
+class StreamRecorder:
+    """
+    InputStreamのコールバックで途切れなく録音し、別スレッドでWAVファイルに書き出すクラス
+    書き出し時に16kHz・モノラルへ変換するため、文字起こし時のリサンプリングは不要
+    """
+    def __init__(self, save_path: str, samplerate: int = SAMPLE_RATE, channels: int = CHANNELS,
+                 device=None, buffer_seconds: int = BUFFER_SECONDS, flush_interval: float = FLUSH_INTERVAL,
+                 output_rate: int = TARGET_SAMPLE_RATE):
+        self.save_path = os.path.abspath(save_path)
+        self.samplerate = samplerate
+        self.channels = channels
+        self.output_rate = output_rate
+        self.device = device if device is not None else lazy_imports.sounddevice().default.device[0]
+        self.flush_interval = flush_interval
+        self._ring = RingBuffer(samplerate * buffer_seconds, channels)
+        self._stream = None
+        self._writer_thread = None
+        self._stop_event = threading.Event()
+        self._resampler = None
+        self._wav = None
+        self._frames_saved = 0
+
+    def _callback(self, indata, frames, time_info, status):
+        """音声デバイスからのコールバック（重い処理はせずバッファに書くだけ）"""
+        if status:
+            logger.warning(f"録音ステータス: {status}")
+        self._ring.write(indata)
+
+    def _flush(self):
+        """バッファの内容を16kHz・モノラルに変換してファイルに追記する"""
+        data = self._ring.read_available()
+        if len(data):
+            self._wav.write(self._resampler.process(data))
+
+    def _writer_loop(self):
+        """一定間隔でバッファをファイルに書き出すスレッド"""
+        while not self._stop_event.wait(self.flush_interval):
+            self._flush()
+
+    def start(self):
+        """録音を開始する"""
+        dir_path = os.path.dirname(self.save_path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+            logger.info(f"ディレクトリを作成しました: {dir_path}")
+        self._resampler = StreamingResampler(self.samplerate, self.output_rate)
+        self._wav = IncrementalWavWriter(self.save_path, self.output_rate, channels=1)
+        self._stop_event.clear()
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
+        self._stream = lazy_imports.sounddevice().InputStream(
+            samplerate=self.samplerate,
+            channels=self.channels,
+            dtype="int16",
+            device=self.device,
+            callback=self._callback
+        )
+        self._stream.start()
+
+    def stop(self) -> str:
+        """
+        録音を停止してファイルを閉じる
+
+        Returns:
+            str: 録音ファイルのパス
+        """
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
+        self._stop_event.set()
+        if self._writer_thread is not None:
+            self._writer_thread.join()
+            self._writer_thread = None
+        if self._wav is not None:
+            self._flush()
+            self._wav.close()
+            self._frames_saved = self._wav.frames_written
+            self._wav = None
+        if self._ring.dropped_frames:
+            logger.warning(f"書き出しが間に合わず {self._ring.dropped_frames} フレームを破棄しました")
+        logger.info(f"録音ファイルを保存しました: {self.save_path}")
+        return self.save_path
+
+    @property
+    def frames_written(self) -> int:
+        """ファイルに書き出したフレーム数（変換後）"""
+        return self._wav.frames_written if self._wav is not None else self._frames_saved
+
+    @property
+    def is_recording(self) -> bool:
+        return self._stream is not None
+
+    @property
+    def duration(self) -> float:
+        """録音済みの秒数"""
+        return self._ring.total_frames / self.samplerate
 
 def upload_audio():
     """
-    音声ファイルをアップロードする関数
+    音声ファイルをアップロードする関数（一時ファイルを作らずにデコードする）
     
     Returns:
-        str: アップロードされたファイルのパス
+        np.ndarray: 16kHz・モノラルの音声データ（未アップロード・デコード失敗時はNone）
     """
     uploaded_file = st.file_uploader(
         "音声ファイル（WAV/MP3/MP4など）をアップロードしてください",
@@ -34,123 +177,138 @@ def upload_audio():
     )
     
     if uploaded_file is not None:
-        # 一時ファイルとして保存
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            return tmp_file.name
+        try:
+            return decode_audio(uploaded_file)
+        except AudioDecodeError as e:
+            logger.error(f"音声ファイルのデコードに失敗しました: {e}")
+            st.error(str(e))
     return None
 
-def record_audio(save_path="tmp/output.mp4"):
+def _show_live_transcript(transcriber: LiveTranscriber):
+    """録音中の文字起こし結果を表示する（一定間隔で自動更新）"""
+    if transcriber.error:
+        st.warning(f"リアルタイム文字起こしでエラーが発生しました: {transcriber.error}")
+    st.caption(f"文字起こし済み: {transcriber.processed_seconds:.0f}秒")
+    st.text_area("文字起こし（途中経過）", transcriber.text, height=200, disabled=True)
+
+
+def _new_recording_path() -> str:
+    """録音ごとに一意な録音ファイルのパス（同じセッションの前の録音や、他のセッションの録音と重ならない）"""
+    return os.path.join("tmp", f"recording_{uuid.uuid4().hex}.wav")
+
+
+def discard_recording(path):
+    """録音ファイルと、リアルタイム文字起こしの区間の結果（.segments.jsonl）を削除する"""
+    if not path:
+        return
+    for file_path in (path, segments_path(path)):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"録音ファイルを削除できませんでした: {file_path}: {e}")
+
+
+def record_audio(save_path=None, live=False):
     """
-    音声を録音する関数
+    音声を録音する関数（録音状態はセッションごとに保持）
     
     Args:
-        save_path (str): 録音ファイルの保存先パス
+        save_path (str): 録音ファイルの保存先パス（省略時は録音ごとに一意なパスに保存し、
+            次の録音を開始する際に前の録音のファイルを削除する）
+        live (bool): Trueの場合は録音中に区間ごとの文字起こしを行い、
+            録音終了時の結果を st.session_state.live_result に保存する
         
     Returns:
         str: 録音ファイルのパス
     """
-    global recording, is_recording, recording_thread
-    
     # セッション状態の初期化
     if 'recording_status' not in st.session_state:
         st.session_state.recording_status = "idle"
     if 'saved_file_path' not in st.session_state:
         st.session_state.saved_file_path = None
-    if 'save_path' not in st.session_state:
-        st.session_state.save_path = os.path.abspath(save_path)
-        logger.info(f"録音ファイルの保存先: {st.session_state.save_path}")
     
     # 録音状態に応じたボタン表示と処理
     if st.session_state.recording_status == "idle":
         if st.button("録音開始", key="recording_button", type="primary"):
-            is_recording = True
-            recording = []
-            recording_thread = threading.Thread(target=record_audio_thread)
-            recording_thread.start()
+            path = os.path.abspath(save_path or _new_recording_path())
+            logger.info(f"録音ファイルの保存先: {path}")
+            try:
+                recorder = StreamRecorder(path)
+                recorder.start()
+            except Exception as e:
+                error_msg = f"録音の開始中にエラーが発生しました: {str(e)}"
+                logger.error(error_msg)
+                st.error(error_msg)
+                return None
+            st.session_state.recorder = recorder
+            st.session_state.live_transcriber = None
+            st.session_state.live_result = None
+            if live:
+                transcriber = LiveTranscriber(recorder.save_path)
+                transcriber.start()
+                st.session_state.live_transcriber = transcriber
             st.session_state.recording_status = "recording"
             st.success("録音を開始しました")
             st.rerun()
     
     elif st.session_state.recording_status == "recording":
-        st.info("🎤 録音中...")
+        recorder = st.session_state.get("recorder")
+        st.info(f"🎤 録音中... （{recorder.duration:.0f}秒）" if recorder else "🎤 録音中...")
+        transcriber = st.session_state.get("live_transcriber")
+        if transcriber is not None:
+            st.fragment(run_every=2)(_show_live_transcript)(transcriber)
         if st.button("録音終了", key="recording_button", type="secondary"):
-            is_recording = False
-            if recording_thread:
-                recording_thread.join()
             st.session_state.recording_status = "stopped"
+            st.session_state.recorder = None
+            st.session_state.live_transcriber = None
             
-            # 録音データを保存
-            if recording and st.session_state.save_path:
-                saved_path = save_audio(recording, st.session_state.save_path)
-                if saved_path:
-                    st.session_state.saved_file_path = saved_path
-                    st.session_state.recording_status = "saved"
-                    st.success(f"録音ファイルを保存しました: {saved_path}")
-                    return saved_path  # 保存されたファイルのパスを返す
-                else:
-                    st.error("録音ファイルの保存に失敗しました")
-                    st.session_state.recording_status = "idle"
+            # 録音を停止してファイルを閉じる
+            saved_path = None
+            if recorder:
+                try:
+                    saved_path = recorder.stop()
+                except Exception as e:
+                    error_msg = f"音声ファイルの保存中にエラーが発生しました: {str(e)}"
+                    logger.error(error_msg)
+                    st.error(error_msg)
+            if saved_path and recorder.frames_written > 0:
+                if transcriber is not None:
+                    # 録音中に確定した区間は文字起こし済みのため、残りの区間だけを処理する
+                    with st.spinner("最後の区間を文字起こし中..."):
+                        try:
+                            st.session_state.live_result = transcriber.finish()
+                        except Exception as e:
+                            error_msg = f"文字起こし中にエラーが発生しました: {str(e)}"
+                            logger.error(error_msg)
+                            st.error(error_msg)
+                st.session_state.saved_file_path = saved_path
+                st.session_state.recording_status = "saved"
+                st.success(f"録音ファイルを保存しました: {saved_path}")
+                return saved_path  # 保存されたファイルのパスを返す
             else:
+                if transcriber is not None:
+                    transcriber.stop()
+                if save_path is None and recorder:
+                    discard_recording(recorder.save_path)
                 st.error("録音データがありません")
                 st.session_state.recording_status = "idle"
             st.rerun()
     
     elif st.session_state.recording_status == "saved":
-        st.success(f"録音ファイルを保存しました: {st.session_state.saved_file_path}")
+        saved_path = st.session_state.saved_file_path
+        if saved_path and os.path.exists(saved_path):
+            st.success(f"録音ファイルを保存しました: {saved_path}")
+        else:
+            st.success("録音を終了しました")
         if st.button("新しい録音を開始", key="new_recording_button", type="primary"):
+            # 前の録音のファイルは使わないため削除する（案件に保存済みの場合は削除済み）
+            if save_path is None:
+                discard_recording(saved_path)
+            st.session_state.saved_file_path = None
+            st.session_state.live_result = None
             st.session_state.recording_status = "idle"
             st.rerun()
     
     return None  # 録音中または保存前はNoneを返す
-
-def record_audio_thread():
-    """
-    録音を実行するスレッド関数
-    """
-    global recording, is_recording
-    
-    fs = 44100  # サンプリングレート
-    device_id = sd.default.device[0]  # デフォルトの入力デバイスを使用
-    
-    while is_recording:
-        # 1秒ごとに録音
-        audio_chunk = sd.rec(int(1 * fs), samplerate=fs, channels=1, device=device_id)
-        sd.wait()
-        recording.extend(audio_chunk)
-
-def save_audio(audio_data, save_path):
-    """
-    録音データをファイルに保存する関数
-    
-    Args:
-        audio_data (list): 録音データ
-        save_path (str): 保存先パス
-        
-    Returns:
-        str: 保存されたファイルの絶対パス
-    """
-    try:
-        # ディレクトリが存在しない場合のみ作成
-        dir_path = os.path.dirname(save_path)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-            logger.info(f"ディレクトリを作成しました: {dir_path}")
-        
-        # 録音データをnumpy配列に変換
-        audio_array = np.concatenate(audio_data)
-        
-        # WAVファイルとして保存
-        with wave.open(save_path, 'wb') as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(2)  # 16bit
-            wf.setframerate(44100)
-            wf.writeframes((audio_array * 32767).astype(np.int16).tobytes())
-        
-        logger.info(f"録音ファイルを保存しました: {save_path}")
-        return save_path
-    except Exception as e:
-        error_msg = f"音声ファイルの保存中にエラーが発生しました: {str(e)}"
-        logger.error(error_msg)
-        st.error(error_msg)
-        return None 
\ No newline at end of file
@@ -0,0 +1,221 @@
+"""
+音声のデコード（一時ファイルを使わない）
+
+アップロードされた音声をチャンクごとにffmpegの標準入力へ流し込み、標準出力から
+16kHz・モノラルのPCMを受け取ってNumPy配列にする。コンテナ形式は先頭バイトから判定して
+ffmpegに明示し、サイズの上限を超えた場合は途中で打ち切る。
+
+MP4/M4Aでmoovボックスがファイルの末尾にある場合はパイプからは読めないため、
+その場合に限り一時ファイルを使い、デコード後に必ず削除する。
+"""
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import wave
+from typing import BinaryIO, Optional, Union
+
+import numpy as np
+
+from modules.wav_io import TARGET_SAMPLE_RATE
+
+# アップロードの上限（MB）
+DEFAULT_MAX_MB = 500
+CHUNK_SIZE = 1024 * 1024
+
+
+class AudioDecodeError(ValueError):
+    """音声をデコードできない場合のエラー"""
+
+
+def detect_container(head: bytes) -> Optional[str]:
+    """
+    先頭バイトからコンテナ形式を判定する
+
+    Returns:
+        Optional[str]: ffmpegの入力形式名（wav / mp3 / mov / ogg / flac / matroska、不明な場合はNone）
+    """
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[4:8] == b"ftyp":
+        # mp4 / m4a / mov はffmpegではmovデマルチプレクサで扱う
+        return "mov"
+    if head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return "mp3"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "matroska"
+    return None
+
+
+def _mp4_streamable(head: bytes) -> bool:
+    """MP4のmoovボックスがmdatより前にあるか（パイプで読めるか）"""
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], "big")
+        box = head[offset + 4:offset + 8]
+        if box == b"moov":
+            return True
+        if box == b"mdat":
+            return False
+        if size == 1 and offset + 16 <= len(head):
+            size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if size < 8:
+            break
+        offset += size
+    # 先頭部分で判定できない場合は一時ファイルを使う
+    return False
+
+
+def _max_bytes() -> int:
+    max_mb = DEFAULT_MAX_MB
+    try:
+        import streamlit as st
+        max_mb = float(st.secrets.get("audio_max_upload_mb", max_mb))
+    except Exception:
+        pass
+    return int(max_mb * 1024 * 1024)
+
+
+def _open(source) -> BinaryIO:
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, "rb")
+    return source
+
+
+def _decode_wav_16k(head: bytes, stream: BinaryIO) -> Optional[np.ndarray]:
+    """16kHz・モノラル・16bitのWAVはffmpegを使わずに読み込む"""
+    if detect_container(head) != "wav":
+        return None
+    stream.seek(0)
+    try:
+        with wave.open(stream, "rb") as wf:
+            if (wf.getframerate() != TARGET_SAMPLE_RATE or wf.getnchannels() != 1
+                    or wf.getsampwidth() != 2):
+                return None
+            data = wf.readframes(wf.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    return np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768.0
+
+
+def _ffmpeg_command(input_format: Optional[str], input_path: str = "pipe:0"):
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    if input_format:
+        command += ["-f", input_format]
+    return command + ["-i", input_path, "-f", "s16le", "-ac", "1", "-ar", str(TARGET_SAMPLE_RATE), "pipe:1"]
+
+
+def _run_ffmpeg(command, stream: Optional[BinaryIO], head: bytes, max_bytes: int) -> np.ndarray:
+    """ffmpegを実行し、標準入力へ音声を流し込みながら標準出力のPCMを受け取る"""
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if stream is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    state = {"sent": 0, "too_large": False, "error": None}
+
+    def feed():
+        try:
+            chunk = head
+            while chunk:
+                state["sent"] += len(chunk)
+                if state["sent"] > max_bytes:
+                    state["too_large"] = True
+                    process.kill()
+                    return
+                process.stdin.write(chunk)
+                chunk = stream.read(CHUNK_SIZE)
+        except (BrokenPipeError, OSError) as e:
+            # ffmpegが先に終了した場合（エラーは終了コードで判定する）
+            state["error"] = e
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    stderr_chunks = []
+    threads = [threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)]
+    if stream is not None:
+        threads.append(threading.Thread(target=feed, daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        pcm = process.stdout.read()
+        process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        for thread in threads:
+            thread.join()
+        process.stdout.close()
+        process.stderr.close()
+
+    if state["too_large"]:
+        raise AudioDecodeError(f"音声ファイルが上限（{max_bytes // (1024 * 1024)}MB）を超えています")
+    if process.returncode != 0:
+        message = b"".join(stderr_chunks).decode("utf-8", errors="replace").strip()
+        raise AudioDecodeError(f"音声をデコードできませんでした: {message or process.returncode}")
+    return np.frombuffer(pcm[:len(pcm) // 2 * 2], dtype="<i2").astype(np.float32) / 32768.0
+
+
+def decode_audio(source: Union[bytes, str, BinaryIO], max_bytes: Optional[int] = None) -> np.ndarray:
+    """
+    音声を16kHz・モノラルのfloat32配列にデコードする
+
+    Args:
+        source: 音声データ（bytes）、ファイルパス、またはファイルオブジェクト（st.file_uploaderの戻り値など）
+        max_bytes (int): 入力サイズの上限（省略時はsecretsのaudio_max_upload_mb）
+
+    Returns:
+        np.ndarray: Whisperにそのまま渡せる音声データ
+
+    Raises:
+        AudioDecodeError: 形式が不明・上限超過・デコード失敗の場合
+    """
+    if shutil.which("ffmpeg") is None:
+        raise AudioDecodeError("ffmpegがインストールされていません")
+    max_bytes = max_bytes or _max_bytes()
+    stream = _open(source)
+    try:
+        if hasattr(stream, "seek"):
+            stream.seek(0)
+        head = stream.read(64 * 1024)
+        if not head:
+            raise AudioDecodeError("音声データが空です")
+        container = detect_container(head)
+        if container is None:
+            raise AudioDecodeError("対応していない音声形式です（WAV/MP3/M4A/MP4/OGG/FLAC/WebM）")
+
+        audio = _decode_wav_16k(head, stream) if hasattr(stream, "seek") else None
+        if audio is not None:
+            return audio
+        if hasattr(stream, "seek"):
+            stream.seek(len(head))
+
+        if container == "mov" and not _mp4_streamable(head):
+            # moovが末尾にあるMP4はシークが必要なため、一時ファイル経由でデコードする
+            with tempfile.NamedTemporaryFile(suffix=".mp4") as tmp_file:
+                size = 0
+                chunk = head
+                while chunk:
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise AudioDecodeError(f"音声ファイルが上限（{max_bytes // (1024 * 1024)}MB）を超えています")
+                    tmp_file.write(chunk)
+                    chunk = stream.read(CHUNK_SIZE)
+                tmp_file.flush()
+                return _run_ffmpeg(_ffmpeg_command(container, tmp_file.name), None, b"", max_bytes)
+        return _run_ffmpeg(_ffmpeg_command(container), stream, head, max_bytes)
+    finally:
+        if stream is not source:
+            stream.close()
@@ -66,6 +66,26 @@ class QAManager:
                 return df.iloc[-1]['id']
         return None
     
+    def save_case_segments(self, case_id: int, segments: List[Dict]) -> bool:
+        """案件に話者付きの文字起こし（区間ごとの元の録音のrecording_idを含む）を保存する"""
+        return self.db.save_case_segments(case_id, segments)
+    
+    def get_case_segments(self, case_id: int) -> List[Dict]:
+        """案件の話者付きの文字起こしを取得する"""
+        return self.db.get_case_segments(case_id)
+    
+    def get_summary_parts(self, case_id: int) -> Dict[str, Dict]:
+        """案件の要約の途中結果（チャンクごとの要約・統合結果）を取得する"""
+        return self.db.get_summary_parts(case_id)
+    
+    def save_case_summary(self, case_id: int, parts: Dict[str, Dict], summary: str) -> bool:
+        """案件の要約と途中結果を保存する"""
+        return self.db.save_case_summary(case_id, parts, summary)
+    
+    def get_case_summary(self, case_id: int) -> Optional[str]:
+        """案件の要約を取得する"""
+        return self.db.get_case_summary(case_id)
+    
     def get_case(self, case_id: int) -> Optional[Dict]:
         """案件を取得する"""
         return self.db.get_case(case_id)
@@ -323,13 +343,14 @@ class QAManager:
     def display_audio_upload(self):
         """音声アップロード画面の表示"""
         st.subheader("音声ファイルアップロード")
-        audio_path = audio_capture.upload_audio()
-        if audio_path:
+        audio = audio_capture.upload_audio()
+        if audio is not None:
+            audio_path = st.session_state.audio_uploader.name
             self.session_state.audio_path = audio_path
-            st.success(f"音声ファイルを受け付けました: {audio_path}")
+            st.success(f"音声ファイルを受け付けました: {audio_path}（{len(audio) / 16000:.0f}秒）")
             
             # 音声処理の実行
-            result = self.audio_processor.process_audio(audio_path)
+            result = self.audio_processor.process_audio(audio)
             
             # 結果の表示
             if "text" in result:
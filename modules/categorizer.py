@@ -2,18 +2,23 @@ import json
 import os
 import streamlit as st
 from typing import Dict, List, Optional
-import openai
 import httpx
+from modules import lazy_imports
+from modules.llm_client import chat, openai_settings
+from modules.rate_limiter import SDK_MAX_RETRIES
+
+# プロンプトを変更した場合は上げる（キャッシュされた応答を使わないようにする）
+PROMPT_TEMPLATE = "categorizer/1"
 
 class Categorizer:
     """カテゴリ分類クラス"""
     def __init__(self):
         try:
-            self.openai_api_key = st.secrets["openai_api_key"]
-            # OpenAIクライアントの初期化
-            self.client = openai.OpenAI(
-                api_key=self.openai_api_key,
-                http_client=httpx.Client()
+            # OpenAIクライアントの初期化（APIキーはsecrets、なければ環境変数OPENAI_API_KEY）
+            self.client = lazy_imports.openai().OpenAI(
+                **openai_settings(),
+                http_client=httpx.Client(),
+                max_retries=SDK_MAX_RETRIES
             )
             # question.jsonの読み込み
             with open("question.json", "r", encoding="utf-8") as f:
@@ -25,21 +30,9 @@ class Categorizer:
             st.error("question.jsonが見つかりません。")
             self.categories = None
     
-    def categorize(self, text: str) -> Optional[Dict[str, str]]:
-        """テキストをカテゴリに分類する
-        
-        Args:
-            text: 分類対象のテキスト
-        
-        Returns:
-            Optional[Dict[str, str]]: カテゴリ分類結果
-        """
-        try:
-            if not self.client or not self.categories:
-                return None
-
-            # プロンプトの作成
-            prompt = f"""
+    def _messages(self, text: str) -> List[Dict]:
+        """カテゴリ分類のメッセージを作成する"""
+        prompt = f"""
             以下のテキストを、以下のカテゴリに分類してください。
             各カテゴリの内容を抽出し、JSON形式で返してください。
             
@@ -55,28 +48,45 @@ class Categorizer:
             3. 日付はYYYY-MM-DD形式で返してください
             4. 金融商品の種類は具体的な商品名を返してください
             """
-            
-            # OpenAI APIの呼び出し
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "あなたは金融機関の面談記録を分析する専門家です。"},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=2000
-            )
-            
-            # レスポンスの解析
-            result = response.choices[0].message.content.strip()
+        return [
+            {"role": "system", "content": "あなたは金融機関の面談記録を分析する専門家です。"},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def parse_categories(self, result: str) -> Optional[Dict[str, str]]:
+        """応答のテキストをカテゴリ分類結果に変換する
+        
+        Args:
+            result: APIの応答のテキスト
+        
+        Returns:
+            Optional[Dict[str, str]]: カテゴリ分類結果
+        """
+        try:
+            return json.loads(result.strip())
+        except json.JSONDecodeError:
+            st.error("カテゴリ分類結果の解析に失敗しました。")
+            return None
+    
+    def categorize(self, text: str) -> Optional[Dict[str, str]]:
+        """テキストをカテゴリに分類する
+        
+        Args:
+            text: 分類対象のテキスト
+        
+        Returns:
+            Optional[Dict[str, str]]: カテゴリ分類結果
+        """
+        try:
+            if not self.client or not self.categories:
+                return None
+
+            # OpenAI APIの呼び出し（モデルは入力の長さから選び、同じ内容の呼び出しはキャッシュから返す）
+            result = chat(self._messages(text), task="categorize", temperature=0.3, max_tokens=2000,
+                          client=self.client, template=PROMPT_TEMPLATE)
             
             # JSON形式に変換
-            try:
-                categories = json.loads(result)
-                return categories
-            except json.JSONDecodeError:
-                st.error("カテゴリ分類結果の解析に失敗しました。")
-                return None
+            return self.parse_categories(result)
                 
         except Exception as e:
             st.error(f"カテゴリ分類中にエラーが発生しました: {str(e)}")
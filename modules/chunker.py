@@ -0,0 +1,135 @@
+"""
+トークン数によるテキストの分割
+
+テキスト全体を1度だけトークン化し、各トークンの文字位置から分割位置を決める。
+分割位置は上限のトークン数以内で、話者の交代 → 改行 → 文末 → 読点・空白 の順に
+区切りの良い位置を優先し、見つからない場合はトークン位置でそのまま分割する。
+「。」を含まない文字起こしや、1文が上限を超える場合も上限以内に分割される。
+"""
+import bisect
+import functools
+import re
+from typing import List
+
+import numpy as np
+
+from modules import lazy_imports
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+DEFAULT_MAX_TOKENS = 3000
+
+# 区切りの候補（優先度の高い順）。いずれも一致した位置の直後で分割する
+_BOUNDARY_PATTERNS = [
+    # 話者の交代（次の行が「話者名: 」で始まる）
+    re.compile(r"\n(?=[^\n:：]{1,20}[:：])"),
+    # 改行
+    re.compile(r"\n+"),
+    # 文末（閉じ括弧・引用符を含む）
+    re.compile(r"[。．！？!?][」』）)\"']*"),
+    # 読点・空白
+    re.compile(r"[、，,]|\s+"),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = DEFAULT_MODEL):
+    """モデルに対応するtiktokenのエンコーダー（プロセス内で1度だけ読み込む）"""
+    tiktoken = lazy_imports.tiktoken()
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@functools.lru_cache(maxsize=None)
+def _token_byte_lengths(model: str = DEFAULT_MODEL) -> np.ndarray:
+    """トークン番号ごとのバイト数（語彙全体で1度だけ計算する）"""
+    encoding = get_encoding(model)
+    lengths = np.zeros(encoding.n_vocab, dtype=np.int64)
+    for token in range(encoding.n_vocab):
+        try:
+            lengths[token] = len(encoding.decode_single_token_bytes(token))
+        except KeyError:
+            pass
+    return lengths
+
+
+def token_offsets(text: str, tokens: List[int], model: str = DEFAULT_MODEL) -> np.ndarray:
+    """
+    各トークンの開始位置（文字単位）
+
+    トークンのバイト数の累積和を、文字ごとのUTF-8のバイト位置と照合して求める。
+    文字の途中から始まるトークンは、その文字の位置とする。
+    """
+    byte_starts = np.concatenate([[0], np.cumsum(_token_byte_lengths(model)[np.asarray(tokens)])[:-1]])
+    codepoints = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    char_bytes = 1 + (codepoints >= 0x80) + (codepoints >= 0x800) + (codepoints >= 0x10000)
+    char_starts = np.concatenate([[0], np.cumsum(char_bytes)[:-1]])
+    return np.searchsorted(char_starts, byte_starts, side="right") - 1
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """テキストのトークン数"""
+    return len(get_encoding(model).encode(text))
+
+
+def _boundaries(text: str, offsets: np.ndarray) -> List[List[int]]:
+    """優先度ごとの区切り位置（トークン番号、昇順）"""
+    tiers = []
+    for pattern in _BOUNDARY_PATTERNS:
+        ends = np.fromiter((match.end() for match in pattern.finditer(text)), dtype=np.int64)
+        # 区切りの直後から始まるトークンの番号
+        tiers.append(np.unique(np.searchsorted(offsets, ends, side="left")).tolist())
+    return tiers
+
+
+def _find_cut(tiers: List[List[int]], lower: int, upper: int) -> int:
+    """lower〜upperの範囲で最も優先度の高い区切りのうち、最も後ろの位置（なければupper）"""
+    for positions in tiers:
+        i = bisect.bisect_right(positions, upper) - 1
+        if i >= 0 and positions[i] > lower:
+            return positions[i]
+    return upper
+
+
+def chunk_text(text: str, max_tokens: int = DEFAULT_MAX_TOKENS, overlap_tokens: int = 0,
+               model: str = DEFAULT_MODEL) -> List[str]:
+    """
+    テキストをトークン数の上限以内のチャンクに分割する
+
+    Args:
+        text (str): 分割するテキスト
+        max_tokens (int): 1チャンクあたりの最大トークン数
+        overlap_tokens (int): 前のチャンクの末尾を次のチャンクの先頭に含めるトークン数
+        model (str): トークン数を数えるモデル
+
+    Returns:
+        List[str]: 分割されたテキストのリスト
+    """
+    if not text:
+        return []
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)
+    total = len(tokens)
+    if total <= max_tokens:
+        return [text]
+    offsets = token_offsets(text, tokens, model)
+    tiers = _boundaries(text, offsets)
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+
+    chunks = []
+    start = 0
+    while start < total:
+        upper = start + max_tokens
+        if upper >= total:
+            end = total
+        else:
+            # 短すぎるチャンクを作らないよう、上限の半分より後ろの区切りだけを使う
+            end = _find_cut(tiers, start + max_tokens // 2, upper)
+        chunk = text[int(offsets[start]):int(offsets[end]) if end < total else len(text)]
+        if chunk.strip():
+            chunks.append(chunk)
+        if end >= total:
+            break
+        start = max(end - overlap_tokens, start + 1)
+    return chunks
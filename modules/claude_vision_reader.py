@@ -1,14 +1,22 @@
 from PIL import Image
 import io
-import anthropic
 import base64
 import os
 import streamlit as st
 import sqlite3
-from pdf2image import convert_from_path
+from modules import lazy_imports
+from modules.rate_limiter import (
+    get_governor, estimate_tokens, IMAGE_TOKEN_ESTIMATE,
+    PRIORITY_INTERACTIVE, PRIORITY_BATCH, SDK_MAX_RETRIES
+)
+from modules.llm_client import chat
+from modules.upload_store import UploadStore
+from modules.layout_regions import get_regions, crop_regions
+from modules.ocr_fields import OcrFieldStore
 
 class ClaudeVisionReader:
-    def __init__(self, api_key=None, model="claude-3-7-sonnet-20250219"):
+    def __init__(self, api_key=None, model="claude-3-7-sonnet-20250219", priority=PRIORITY_INTERACTIVE,
+                 use_regions=True):
         # APIキーをANTHROPIC_API_KEY環境変数にセット
         if api_key:
             self.api_key = api_key
@@ -21,7 +29,17 @@ class ClaudeVisionReader:
             raise ValueError("Claude APIキーが設定されていません。")
         os.environ["ANTHROPIC_API_KEY"] = self.api_key
         self.model = model
-        self.client = anthropic.Anthropic(api_key=self.api_key)
+        self.client = lazy_imports.anthropic().Anthropic(api_key=self.api_key, max_retries=SDK_MAX_RETRIES)
+        # レート制御（priority: 優先度, on_wait: 順番待ち表示用コールバック）
+        self.priority = priority
+        self.on_wait = None
+        # ページ全体ではなく、検出した領域だけを切り出して送信する
+        self.use_regions = use_regions
+
+    def _call_api(self, provider, fn, prompt, max_tokens=2048, images=1):
+        """レート制御の下でAPIを呼び出す"""
+        tokens = IMAGE_TOKEN_ESTIMATE * images + estimate_tokens(prompt) + max_tokens
+        return get_governor().call(provider, fn, tokens=tokens, priority=self.priority, on_wait=self.on_wait)
 
     def resize_image_to_max_size(self, png_path, max_bytes=5*1024*1024):
         with open(png_path, "rb") as f:
@@ -51,63 +69,92 @@ class ClaudeVisionReader:
                 break
         return data  # 最小まで縮小しても超える場合はそのまま返す
 
+    def encode_image(self, img, max_bytes=5*1024*1024):
+        """
+        画像をコントラスト強調してPNGに変換する（上限を超える場合のみ縮小）
+        """
+        # 画像モードをRGBまたはLに変換
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        # コントラストを強調
+        from PIL import ImageEnhance
+        img = ImageEnhance.Contrast(img).enhance(1.5)
+        buf = io.BytesIO()
+        img.save(buf, format="PNG", optimize=True)
+        data = buf.getvalue()
+        scale = 0.9
+        while len(data) > max_bytes and scale > 0.1:
+            img_resized = img.resize((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
+            buf = io.BytesIO()
+            img_resized.save(buf, format="PNG", optimize=True)
+            data = buf.getvalue()
+            scale -= 0.05
+        return data
+
+    def build_image_content(self, file_path, page_index, img, prompt):
+        """
+        ページ画像と指示文からメッセージのcontentを作成する
+        use_regionsが有効な場合は、検出した領域を元の解像度のまま切り出して送信する
+        """
+        if self.use_regions:
+            crops = crop_regions(img, get_regions(file_path, page_index, img))
+        else:
+            crops = [img]
+        content = []
+        for crop in crops:
+            image_base64 = base64.b64encode(self.encode_image(crop)).decode("utf-8")
+            content.append({"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": image_base64}})
+        if len(crops) > 1:
+            prompt = f"{prompt}\n（画像は同じページ内の領域を上から順に切り出したものです）"
+        content.append({"type": "text", "text": prompt})
+        return content, len(crops)
+
     def extract_info_from_png(self, file_path, prompt):
         """
         PNG画像から情報を抽出する
         """
-        image_data = self.resize_image_to_max_size(file_path)
-        image_base64 = base64.b64encode(image_data).decode("utf-8")
-        message = self.client.messages.create(
+        if self.use_regions:
+            img = Image.open(file_path)
+            content, images = self.build_image_content(file_path, 0, img, prompt)
+        else:
+            image_data = self.resize_image_to_max_size(file_path)
+            image_base64 = base64.b64encode(image_data).decode("utf-8")
+            content = [
+                {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": image_base64}},
+                {"type": "text", "text": prompt}
+            ]
+            images = 1
+        message = self._call_api("anthropic", lambda: self.client.messages.create(
             model=self.model,
             max_tokens=2048,  # より多くのトークンを許可
             messages=[
                 {
                     "role": "user",
-                    "content": [
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": image_base64}},
-                        {"type": "text", "text": prompt}
-                    ]
+                    "content": content
                 }
             ]
-        )
+        ), prompt, images=images)
         return message.content[0].text
 
     def extract_info_from_pdf(self, file_path, prompt):
         """
         PDFファイルから情報を抽出する（各ページごとに処理）
         """
-        images = convert_from_path(file_path)
+        images = lazy_imports.pdf2image().convert_from_path(file_path)
         results = []
-        from PIL import ImageEnhance
         for i, img in enumerate(images):
-            # 画像モードをRGBまたはLに変換
-            if img.mode not in ("RGB", "L"):
-                img = img.convert("RGB")
-            # コントラストを強調
-            enhancer = ImageEnhance.Contrast(img)
-            img = enhancer.enhance(1.5)
-            buf = io.BytesIO()
-            img.save(buf, format="PNG", optimize=True)
-            image_data = buf.getvalue()
-            if len(image_data) > 5*1024*1024:
-                img = img.resize((int(img.width * 0.7), int(img.height * 0.7)), Image.LANCZOS)
-                buf = io.BytesIO()
-                img.save(buf, format="PNG", optimize=True)
-                image_data = buf.getvalue()
-            image_base64 = base64.b64encode(image_data).decode("utf-8")
-            message = self.client.messages.create(
+            page_prompt = f"{prompt}（{i+1}ページ目）"
+            content, image_count = self.build_image_content(file_path, i, img, page_prompt)
+            message = self._call_api("anthropic", lambda: self.client.messages.create(
                 model=self.model,
                 max_tokens=2048,  # より多くのトークンを許可
                 messages=[
                     {
                         "role": "user",
-                        "content": [
-                            {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": image_base64}},
-                            {"type": "text", "text": f"{prompt}（{i+1}ページ目）"}
-                        ]
+                        "content": content
                     }
                 ]
-            )
+            ), page_prompt, images=image_count)
             results.append(message.content[0].text)
         return "\n".join(results)
 
@@ -146,25 +193,17 @@ class ClaudeVisionReader:
     @staticmethod
     def refine_japanese_text(text: str) -> str:
         """OpenAIで日本語として自然な文章に整形"""
-        import openai
-        import streamlit as st
-        client = openai.OpenAI(api_key=st.secrets["openai_api_key"])
         prompt = (
             "以下のテキストを日本語として自然な文章に整形してください。"
             "句読点やスペース、改行も適切に修正し、読みやすくしてください。"
             "内容は変えず、誤字脱字や不自然な表現があれば直してください。\n\n"
             f"テキスト:\n{text}"
         )
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたは日本語の文章校正の専門家です。"},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=2048,
-            temperature=0.2
-        )
-        return response.choices[0].message.content.strip()
+        # 同じテキストの整形はキャッシュから返す
+        return chat([
+            {"role": "system", "content": "あなたは日本語の文章校正の専門家です。"},
+            {"role": "user", "content": prompt}
+        ], task="ocr_refine", max_tokens=2048, temperature=0.2, template="ocr.refine/1").strip()
 
     def ocr_and_refine(self, file_path: str, want_to_read: str) -> str:
         """OCR→日本語整形まで一括実行"""
@@ -179,41 +218,76 @@ class ClaudeVisionReader:
         :param png_dir: png/pdfファイルのディレクトリ
         :param target_ids: 処理対象のocr.idリスト（Noneなら全件）
         """
+        store = UploadStore(db_path, blob_dir=os.path.join(png_dir, "blobs"))
+        field_store = OcrFieldStore(db_path)
         conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, filename, want_to_read FROM ocr")
-        rows = cursor.fetchall()
-        for row in rows:
-            ocr_id, filename, want_to_read = row
-            if target_ids and ocr_id not in target_ids:
-                continue
-            file_path = os.path.join(png_dir, filename)
-            if not self.png_exists(filename, png_dir):
-                print(f"ファイルが見つかりません: {file_path}")
-                continue
-            prompt = self.make_ocr_prompt(want_to_read)
-            try:
-                result = self.read_image_and_extract_info(file_path, prompt)
-                print(f"[Claude OCR LOG] id={ocr_id}, filename={filename}, want_to_read={want_to_read}, result={result}")
-                cursor.execute("UPDATE ocr SET result = ? WHERE id = ?", (result, ocr_id))
-                conn.commit()
-            except Exception as e:
-                print(f"Claude Visionエラー: {e}")
-        conn.close()
+        # 一括処理は対話操作より後回しにする（例外で中断した場合も優先度を戻し、接続を閉じる）
+        interactive_priority = self.priority
+        self.priority = PRIORITY_BATCH
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, filename, want_to_read, blob_hash FROM ocr")
+            rows = cursor.fetchall()
+            for row in rows:
+                ocr_id, filename, want_to_read, blob_hash = row
+                if target_ids and ocr_id not in target_ids:
+                    continue
+                file_path = (blob_hash and store.path_for(blob_hash)) or os.path.join(png_dir, filename)
+                if not os.path.isfile(file_path):
+                    print(f"ファイルが見つかりません: {file_path}")
+                    continue
+                # 同じ内容のファイルを同じ項目で処理済みなら結果を再利用
+                if blob_hash:
+                    existing = store.find_existing_result(blob_hash, want_to_read)
+                    if existing:
+                        cursor.execute("UPDATE ocr SET result = ? WHERE id = ?", (existing, ocr_id))
+                        field_store.save_result(ocr_id, existing, conn=conn)
+                        conn.commit()
+                        continue
+                prompt = self.make_ocr_prompt(want_to_read)
+                try:
+                    result = self.read_image_and_extract_info(file_path, prompt)
+                    print(f"[Claude OCR LOG] id={ocr_id}, filename={filename}, want_to_read={want_to_read}, result={result}")
+                    cursor.execute("UPDATE ocr SET result = ? WHERE id = ?", (result, ocr_id))
+                    field_store.save_result(ocr_id, result, self.model, conn=conn)
+                    conn.commit()
+                except Exception as e:
+                    print(f"Claude Visionエラー: {e}")
+        finally:
+            self.priority = interactive_priority
+            conn.close()
+
+    def save_ocr_result(self, db_path, ocr_id, result, model=None):
+        """
+        OCR結果をocrテーブルに保存し、項目ごとに分解してocr_fieldsにも保存する
+        :param db_path: qa.dbのパス
+        :param ocr_id: ocr.id
+        :param result: OCRの生出力
+        :param model: 抽出に使用したモデル名
+        """
+        field_store = OcrFieldStore(db_path)
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.execute("UPDATE ocr SET result = ? WHERE id = ?", (result, ocr_id))
+            field_store.save_result(ocr_id, result, model, conn=conn)
+            conn.commit()
+        finally:
+            conn.close()
 
     def get_ocr_entries_with_images(self, db_path, png_dir="png"):
         """
         ocrテーブルの内容と画像/ファイルパスをリストで返す。
         type: 'image' or 'pdf' を付与。
         """
+        store = UploadStore(db_path, blob_dir=os.path.join(png_dir, "blobs"))
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
-        cursor.execute("SELECT id, filename, want_to_read, result FROM ocr")
+        cursor.execute("SELECT id, filename, want_to_read, result, blob_hash FROM ocr")
         rows = cursor.fetchall()
         entries = []
         for row in rows:
-            ocr_id, filename, want_to_read, result = row
-            file_path = os.path.join(png_dir, filename)
+            ocr_id, filename, want_to_read, result, blob_hash = row
+            file_path = (blob_hash and store.path_for(blob_hash)) or os.path.join(png_dir, filename)
             ext = os.path.splitext(filename)[1].lower()
             if ext in [".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tiff"]:
                 entry_type = "image"
@@ -227,6 +301,7 @@ class ClaudeVisionReader:
                 "want_to_read": want_to_read,
                 "result": result,
                 "file_path": file_path,
+                "blob_hash": blob_hash,
                 "type": entry_type
             })
         conn.close()
@@ -236,27 +311,29 @@ class ClaudeVisionReader:
         st.subheader("PNGまたはPDFファイルのアップロードと業種・項目指定")
         uploaded_file = st.file_uploader("ファイルを選択してください（PNGまたはPDF）", type=["png", "pdf"])
         if uploaded_file is not None:
-            # 保存先ディレクトリがなければ作成
-            if not os.path.exists(png_dir):
-                os.makedirs(png_dir)
-            # ファイル保存
-            save_path = os.path.join(png_dir, uploaded_file.name)
-            with open(save_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            st.success(f"ファイルを保存しました: {save_path}")
+            # 内容のハッシュ値で保存（同じファイルは重複して保存しない）
+            store = UploadStore(db_path, blob_dir=os.path.join(png_dir, "blobs"))
+            blob = store.put_upload(uploaded_file)
+            if blob["deduplicated"]:
+                st.success(f"同じ内容のファイルが保存済みです: {blob['path']}")
+            else:
+                st.success(f"ファイルを保存しました: {blob['path']}")
 
             # 業種選択
-            label = st.selectbox("業種", ["不動産", "保険"], key=f"label_{uploaded_file.name}")
+            label = st.selectbox("業種", ["不動産", "保険"], key=f"label_{blob['sha256']}")
             # 読み取りたい項目
-            want_to_read = st.text_input("読み取りたい項目", key=f"want_to_read_{uploaded_file.name}")
-            if st.button("登録", key=f"register_label_{uploaded_file.name}"):
-                # DBに登録
+            want_to_read = st.text_input("読み取りたい項目", key=f"want_to_read_{blob['sha256']}")
+            if st.button("登録", key=f"register_label_{blob['sha256']}"):
+                # DBに登録（処理済みの同一ファイル・同一項目があれば結果を引き継ぐ）
+                existing_result = store.find_existing_result(blob["sha256"], want_to_read)
                 conn = sqlite3.connect(db_path)
                 cursor = conn.cursor()
                 cursor.execute(
-                    "INSERT INTO ocr (filename, want_to_read, label) VALUES (?, ?, ?)",
-                    (uploaded_file.name, want_to_read, label)
+                    "INSERT INTO ocr (filename, want_to_read, label, blob_hash, result) VALUES (?, ?, ?, ?, ?)",
+                    (uploaded_file.name, want_to_read, label, blob["sha256"], existing_result)
                 )
+                if existing_result:
+                    OcrFieldStore(db_path).save_result(cursor.lastrowid, existing_result, conn=conn)
                 conn.commit()
                 conn.close()
                 st.success("ファイル・業種・項目をデータベースに登録しました。")
@@ -265,13 +342,12 @@ class ClaudeVisionReader:
         """
         OpenAI Vision APIで画像（PNG）から情報を抽出する（openai>=1.0.0新SDK対応）
         """
-        from openai import OpenAI
         import base64
-        client = OpenAI(api_key=st.secrets["openai_api_key"])
+        client = lazy_imports.openai().OpenAI(api_key=st.secrets["openai_api_key"], max_retries=SDK_MAX_RETRIES)
         with open(file_path, "rb") as f:
             image_data = f.read()
         image_base64 = base64.b64encode(image_data).decode()
-        response = client.chat.completions.create(
+        response = self._call_api("openai", lambda: client.chat.completions.create(
             model="gpt-4o",
             messages=[
                 {
@@ -283,37 +359,36 @@ class ClaudeVisionReader:
                 }
             ],
             max_tokens=2048
-        )
+        ), prompt)
         return response.choices[0].message.content
 
     def openai_ocr_pdf(self, file_path, prompt):
         """
         OpenAI Vision APIでPDF（各ページ画像化）から情報を抽出する（openai>=1.0.0新SDK対応）
         """
-        from openai import OpenAI
         import base64
-        from pdf2image import convert_from_path
-        client = OpenAI(api_key=st.secrets["openai_api_key"])
-        images = convert_from_path(file_path)
+        client = lazy_imports.openai().OpenAI(api_key=st.secrets["openai_api_key"], max_retries=SDK_MAX_RETRIES)
+        images = lazy_imports.pdf2image().convert_from_path(file_path)
         results = []
         for i, img in enumerate(images):
             buf = io.BytesIO()
             img.save(buf, format="PNG", optimize=True)
             image_data = buf.getvalue()
             image_base64 = base64.b64encode(image_data).decode()
-            response = client.chat.completions.create(
+            page_prompt = f"{prompt}（{i+1}ページ目）"
+            response = self._call_api("openai", lambda: client.chat.completions.create(
                 model="gpt-4o",
                 messages=[
                     {
                         "role": "user",
                         "content": [
-                            {"type": "text", "text": f"{prompt}（{i+1}ページ目）"},
+                            {"type": "text", "text": page_prompt},
                             {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
                         ]
                     }
                 ],
                 max_tokens=2048
-            )
+            ), page_prompt)
             results.append(response.choices[0].message.content)
         return "\n".join(results)
 
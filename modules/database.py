@@ -27,6 +27,44 @@ class DatabaseManager:
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            # 面談音声の話者付き文字起こし（区間ごと）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS case_segments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    case_id INTEGER NOT NULL,
+                    segment_index INTEGER NOT NULL,
+                    start REAL NOT NULL,
+                    end REAL NOT NULL,
+                    speaker TEXT,
+                    text TEXT NOT NULL,
+                    recording_id TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # 区間の元の録音（音声のハッシュなど）。同じ録音を案件に重ねて追加しないために使う
+            columns = [row[1] for row in cursor.execute("PRAGMA table_info(case_segments)")]
+            if "recording_id" not in columns:
+                cursor.execute("ALTER TABLE case_segments ADD COLUMN recording_id TEXT")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_case_segments_case_id ON case_segments(case_id, segment_index)")
+            # 案件の要約の途中結果（チャンクごとの要約・統合結果を入力のハッシュで保存）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS case_summary_parts (
+                    case_id INTEGER NOT NULL,
+                    part_hash TEXT NOT NULL,
+                    body TEXT,
+                    summary TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (case_id, part_hash)
+                )
+            """)
+            # 案件の要約（統合後）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS case_summaries (
+                    case_id INTEGER PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
             conn.commit()
     
     def add_case(self, case_data: Dict[str, str]) -> bool:
@@ -133,4 +171,90 @@ class DatabaseManager:
                 return None
         except Exception as e:
             st.error(f"案件の取得中にエラーが発生しました: {str(e)}")
-            return None 
\ No newline at end of file
+            return None
+
+    def save_case_segments(self, case_id: int, segments: List[Dict]) -> bool:
+        """案件の話者付き文字起こしの保存（既存の区間は置き換え）"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM case_segments WHERE case_id = ?", (case_id,))
+                cursor.executemany("""
+                    INSERT INTO case_segments (
+                        case_id, segment_index, start, end, speaker, text, recording_id
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, [
+                    (case_id, i, seg['start'], seg['end'], seg.get('speaker'), seg['text'], seg.get('recording_id'))
+                    for i, seg in enumerate(segments)
+                ])
+                conn.commit()
+            return True
+        except Exception as e:
+            st.error(f"文字起こしの保存中にエラーが発生しました: {str(e)}")
+            return False
+
+    def get_case_segments(self, case_id: int) -> List[Dict]:
+        """案件の話者付き文字起こしの取得"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT start, end, speaker, text, recording_id FROM case_segments
+                    WHERE case_id = ? ORDER BY segment_index
+                """, (case_id,))
+                return [
+                    {'start': row[0], 'end': row[1], 'speaker': row[2], 'text': row[3], 'recording_id': row[4]}
+                    for row in cursor.fetchall()
+                ]
+        except Exception as e:
+            st.error(f"文字起こしの取得中にエラーが発生しました: {str(e)}")
+            return []
+
+    def get_summary_parts(self, case_id: int) -> Dict[str, Dict]:
+        """案件の要約の途中結果の取得（ハッシュ → body, summary）"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT part_hash, body, summary FROM case_summary_parts WHERE case_id = ?
+                """, (case_id,))
+                return {row[0]: {'body': row[1], 'summary': row[2]} for row in cursor.fetchall()}
+        except Exception as e:
+            st.error(f"要約の途中結果の取得中にエラーが発生しました: {str(e)}")
+            return {}
+
+    def save_case_summary(self, case_id: int, parts: Dict[str, Dict], summary: str) -> bool:
+        """案件の要約と途中結果の保存（途中結果は今回使ったものだけに置き換え）"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM case_summary_parts WHERE case_id = ?", (case_id,))
+                cursor.executemany("""
+                    INSERT INTO case_summary_parts (case_id, part_hash, body, summary)
+                    VALUES (?, ?, ?, ?)
+                """, [
+                    (case_id, part_hash, part.get('body'), part['summary'])
+                    for part_hash, part in parts.items()
+                ])
+                if summary:
+                    cursor.execute("""
+                        INSERT OR REPLACE INTO case_summaries (case_id, summary, updated_at)
+                        VALUES (?, ?, CURRENT_TIMESTAMP)
+                    """, (case_id, summary))
+                conn.commit()
+            return True
+        except Exception as e:
+            st.error(f"要約の保存中にエラーが発生しました: {str(e)}")
+            return False
+
+    def get_case_summary(self, case_id: int) -> Optional[str]:
+        """案件の要約の取得"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT summary FROM case_summaries WHERE case_id = ?", (case_id,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            st.error(f"要約の取得中にエラーが発生しました: {str(e)}")
+            return None
@@ -0,0 +1,212 @@
+"""
+面談記録からのサマリーとカテゴリ分類の一括抽出
+
+question.jsonの構造からJSONスキーマを作成し、構造化出力（response_format: json_schema）で
+サマリーとカテゴリの各項目を1回の呼び出しで抽出する。応答は必ずスキーマに沿ったJSONになるため、
+解析の失敗による再実行が発生しない。スキーマはquestion.jsonが更新されるまで使い回す。
+"""
+import functools
+import json
+import os
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+import streamlit as st
+
+from modules import model_router
+from modules.llm_client import ChatStream, chat
+
+QUESTION_PATH = "question.json"
+EXTRACTION_MAX_TOKENS = 3000
+# プロンプトを変更した場合は上げる（キャッシュされた応答を使わないようにする）
+PROMPT_TEMPLATE = "interview_extractor/1"
+
+_SYSTEM_PROMPT = "あなたは金融機関の面談記録を要約・分析する専門家です。"
+
+_PROMPT = """
+以下の会話ログから、サマリーとカテゴリごとの内容を抽出してください。
+
+サマリー（summary）の要件：
+1. 不要な言い回しや重複を削除
+2. 重要な情報を簡潔にまとめる
+3. 自然な日本語で読みやすくする
+4. 箇条書きや見出しを使用して構造化する
+5. 金融機関の面談記録として適切な形式にする
+
+カテゴリ（categories）の注意事項：
+1. 各カテゴリの情報が存在しない場合は空文字列("")を返してください
+2. 金額は数値のみを返してください
+3. 日付はYYYY-MM-DD形式で返してください
+4. 金融商品の種類は具体的な商品名を返してください
+
+会話ログ:
+{text}
+"""
+
+
+def _compile_node(node) -> Dict:
+    """question.jsonの要素をJSONスキーマに変換する（辞書はオブジェクト、それ以外は文字列）"""
+    if isinstance(node, dict):
+        return {
+            "type": "object",
+            "properties": {key: _compile_node(value) for key, value in node.items()},
+            "required": list(node),
+            "additionalProperties": False,
+        }
+    return {"type": "string"}
+
+
+@functools.lru_cache(maxsize=4)
+def _compile_schema(path: str, mtime: float) -> Dict:
+    with open(path, "r", encoding="utf-8") as f:
+        categories = json.load(f)
+    return {
+        "name": "interview_extraction",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            # summaryを先に生成させ、ストリーミング時にサマリーから表示できるようにする
+            "properties": {
+                "summary": {"type": "string"},
+                "categories": _compile_node(categories),
+            },
+            "required": ["summary", "categories"],
+            "additionalProperties": False,
+        },
+    }
+
+
+def get_schema(path: str = QUESTION_PATH) -> Dict:
+    """
+    question.jsonから作成したスキーマ（response_formatのjson_schemaに渡す形式）
+
+    ファイルの更新日時をキーにキャッシュするため、question.jsonを編集すると作り直す。
+    """
+    return _compile_schema(path, os.path.getmtime(path))
+
+
+def _partial_string(buffer: str, key: str) -> Tuple[Optional[str], bool]:
+    """
+    生成途中のJSONから、文字列の値（途中まで）を取り出す
+
+    Returns:
+        Tuple[Optional[str], bool]: (値, 値の終わりまで届いているか)
+    """
+    start = buffer.find(f'"{key}"')
+    colon = buffer.find(":", start + len(key) + 2) if start >= 0 else -1
+    quote = buffer.find('"', colon + 1) if colon >= 0 else -1
+    if quote < 0:
+        return None, False
+    raw = buffer[quote + 1:]
+    complete = False
+    escaped = False
+    for i, c in enumerate(raw):
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c == '"':
+            raw, complete = raw[:i], True
+            break
+    # 末尾のエスケープシーケンスが途中の場合は、その手前まで
+    for trim in range(7):
+        try:
+            return json.loads('"' + raw[:len(raw) - trim] + '"'), complete
+        except json.JSONDecodeError:
+            continue
+    return None, complete
+
+
+class InterviewExtractor:
+    """サマリーとカテゴリ分類を1回の呼び出しで抽出するクラス"""
+    def __init__(self, question_path: str = QUESTION_PATH):
+        self.question_path = question_path
+        try:
+            self.schema = get_schema(question_path)
+        except FileNotFoundError:
+            st.error("question.jsonが見つかりません。")
+            self.schema = None
+
+    def _request(self, text: str) -> Dict:
+        return {
+            "messages": [
+                {"role": "system", "content": _SYSTEM_PROMPT},
+                {"role": "user", "content": _PROMPT.format(text=text)}
+            ],
+            # モデルは構造化出力に対応したものから、入力の長さに応じて選ぶ
+            "task": "extract",
+            "temperature": 0.3,
+            "max_tokens": EXTRACTION_MAX_TOKENS,
+            "response_format": {"type": "json_schema", "json_schema": self.schema},
+            "template": PROMPT_TEMPLATE,
+        }
+
+    def estimate(self, text: str) -> Optional[Dict]:
+        """抽出に使うモデルと、所要時間・費用の見積もり（model_router.planの先頭の候補）"""
+        if not self.schema:
+            return None
+        request = self._request(text)
+        return model_router.plan(request["task"], request["messages"], request["max_tokens"], structured=True)[0]
+
+    def parse(self, result: str) -> Optional[Dict]:
+        """応答のJSONを summary, categories の辞書に変換する"""
+        try:
+            return json.loads(result)
+        except (TypeError, json.JSONDecodeError):
+            # スキーマに沿った出力が上限のトークン数で途切れた場合など
+            st.error("サマリー・カテゴリ分類の抽出結果が不完全です。")
+            return None
+
+    def extract(self, text: str) -> Optional[Dict]:
+        """
+        テキストからサマリーとカテゴリ分類を抽出する
+
+        Args:
+            text: 抽出対象のテキスト
+
+        Returns:
+            Optional[Dict]: summary（str）, categories（question.jsonと同じ構造のdict）
+        """
+        if not self.schema:
+            return None
+        try:
+            return self.parse(chat(**self._request(text)))
+        except Exception as e:
+            st.error(f"サマリー・カテゴリ分類の抽出中にエラーが発生しました: {str(e)}")
+            return None
+
+    def extract_stream(self, text: str) -> Optional[ChatStream]:
+        """
+        extractのストリーミング版。SummaryStreamでサマリーを表示し、終了後にparse(stream.text)で結果を得る
+        """
+        if not self.schema:
+            return None
+        return ChatStream(**self._request(text))
+
+
+class SummaryStream:
+    """
+    抽出のストリームから、サマリーの部分だけを届いた順に返す（st.write_streamに渡す）
+
+    ttftには、サマリーの最初の文字が届くまでの秒数を記録する（JSONの書き出しの
+    {"summary": " などが届いた時点ではなく、利用者に表示される文字が届いた時点）。
+    ストリームは最後まで読み進めるため、終了後はstream.textで応答全体を参照できる。
+    """
+    def __init__(self, stream: ChatStream):
+        self.stream = stream
+        self.ttft: Optional[float] = None
+
+    def __iter__(self) -> Iterator[str]:
+        started = time.monotonic()
+        buffer, emitted, complete = "", 0, False
+        for delta in self.stream:
+            if complete:
+                # サマリーの生成が終わった後は、カテゴリ部分を読み進めるだけ
+                continue
+            buffer += delta
+            summary, complete = _partial_string(buffer, "summary")
+            if summary and len(summary) > emitted:
+                if self.ttft is None:
+                    self.ttft = time.monotonic() - started
+                yield summary[emitted:]
+                emitted = len(summary)
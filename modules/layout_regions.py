@@ -0,0 +1,222 @@
+"""
+レイアウト解析モジュール
+
+ページ画像から表や文章のまとまり（領域）を検出し、余白を除いた領域だけを
+切り出す。領域の検出はローカルの画像処理（二値化と再帰的なXYカット）で行い、
+検出結果は元ファイルの隣に領域マップ（JSON）として保存して再利用する。
+"""
+from PIL import Image, ImageFilter
+import numpy as np
+import json
+import os
+import logging
+import tempfile
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+REGION_MAP_SUFFIX = ".regions.json"
+REGION_MAP_VERSION = 1
+
+# 解析用に縮小する際の長辺のピクセル数
+ANALYSIS_MAX_SIDE = 1200
+# 領域とみなす最小サイズ（解析画像に対する割合）
+MIN_REGION_RATIO = 0.02
+# 領域を分割する空白の最小幅（解析画像のピクセル数）
+MIN_GAP = 12
+# 切り出し時に領域の周囲に付ける余白（元画像のピクセル数）
+REGION_PADDING = 16
+# 1ページあたりに送信する最大領域数
+MAX_REGIONS = 6
+
+
+def _ink_mask(img: Image.Image) -> tuple:
+    """解析用に縮小した画像から文字・罫線部分のマスクを作成する"""
+    gray = img.convert("L")
+    scale = min(1.0, ANALYSIS_MAX_SIDE / max(gray.size))
+    if scale < 1.0:
+        gray = gray.resize((int(gray.width * scale), int(gray.height * scale)), Image.BILINEAR)
+    # 小さな文字同士をつなげるため、黒い部分を少し太らせてから二値化する
+    gray = gray.filter(ImageFilter.MinFilter(3))
+    pixels = np.asarray(gray, dtype=np.uint8)
+    threshold = min(200, int(pixels.mean()) - 10)
+    return pixels < threshold, scale
+
+
+def _split_on_gap(profile: np.ndarray, min_gap: int) -> Optional[tuple]:
+    """投影プロファイルから最も広い空白区間を探し、(開始, 終了) を返す"""
+    best = None
+    start = None
+    for i, has_ink in enumerate(profile):
+        if not has_ink:
+            if start is None:
+                start = i
+        elif start is not None:
+            if i - start >= min_gap and (best is None or i - start > best[1] - best[0]):
+                best = (start, i)
+            start = None
+    return best
+
+
+def _xy_cut(mask: np.ndarray, x0: int, y0: int, depth: int, min_size: tuple, boxes: List):
+    """再帰的なXYカットで領域を分割する"""
+    rows = mask.any(axis=1)
+    cols = mask.any(axis=0)
+    if not rows.any():
+        return
+    # インクのある範囲に切り詰める
+    top, bottom = np.argmax(rows), len(rows) - np.argmax(rows[::-1])
+    left, right = np.argmax(cols), len(cols) - np.argmax(cols[::-1])
+    mask = mask[top:bottom, left:right]
+    x0, y0 = x0 + left, y0 + top
+    height, width = mask.shape
+    if height < min_size[1] and width < min_size[0]:
+        return
+
+    if depth > 0:
+        # 横方向の空白で上下に分割し、できなければ縦方向の空白で左右に分割する
+        gap = _split_on_gap(mask.any(axis=1), MIN_GAP)
+        if gap:
+            _xy_cut(mask[:gap[0], :], x0, y0, depth - 1, min_size, boxes)
+            _xy_cut(mask[gap[1]:, :], x0, y0 + gap[1], depth - 1, min_size, boxes)
+            return
+        gap = _split_on_gap(mask.any(axis=0), MIN_GAP * 2)
+        if gap:
+            _xy_cut(mask[:, :gap[0]], x0, y0, depth - 1, min_size, boxes)
+            _xy_cut(mask[:, gap[1]:], x0 + gap[1], y0, depth - 1, min_size, boxes)
+            return
+
+    # 領域の幅・高さいっぱいの罫線が縦横に複数ある領域は表とみなす
+    line_rows = (mask.mean(axis=1) > 0.8).sum()
+    line_cols = (mask.mean(axis=0) > 0.8).sum()
+    kind = "table" if line_rows >= 2 and line_cols >= 2 else "text"
+    boxes.append({"box": [int(x0), int(y0), int(x0 + width), int(y0 + height)], "kind": kind})
+
+
+def _merge_closest(regions: List[Dict]) -> List[Dict]:
+    """縦方向に最も近い2つの領域を1つにまとめる"""
+    regions = sorted(regions, key=lambda r: (r["box"][1], r["box"][0]))
+    best_index, best_gap = 0, None
+    for i in range(len(regions) - 1):
+        gap = regions[i + 1]["box"][1] - regions[i]["box"][3]
+        if best_gap is None or gap < best_gap:
+            best_index, best_gap = i, gap
+    a, b = regions[best_index], regions[best_index + 1]
+    merged = {
+        "box": [min(a["box"][0], b["box"][0]), min(a["box"][1], b["box"][1]),
+                max(a["box"][2], b["box"][2]), max(a["box"][3], b["box"][3])],
+        "kind": "table" if "table" in (a["kind"], b["kind"]) else "text",
+    }
+    return regions[:best_index] + [merged] + regions[best_index + 2:]
+
+
+def detect_regions(img: Image.Image, max_regions: int = MAX_REGIONS) -> List[Dict]:
+    """
+    ページ画像から領域を検出する
+
+    Args:
+        img (Image.Image): ページ画像
+        max_regions (int): 返す最大領域数（超える場合は近い領域をまとめる）
+
+    Returns:
+        List[Dict]: 元画像の座標での領域リスト（box: [左, 上, 右, 下], kind: table/text）
+    """
+    mask, scale = _ink_mask(img)
+    min_size = (int(mask.shape[1] * MIN_REGION_RATIO), int(mask.shape[0] * MIN_REGION_RATIO))
+    boxes = []
+    _xy_cut(mask, 0, 0, depth=8, min_size=min_size, boxes=boxes)
+    while len(boxes) > max_regions:
+        boxes = _merge_closest(boxes)
+
+    regions = []
+    for region in sorted(boxes, key=lambda r: (r["box"][1], r["box"][0])):
+        left, top, right, bottom = [v / scale for v in region["box"]]
+        regions.append({
+            "box": [
+                max(0, int(left) - REGION_PADDING),
+                max(0, int(top) - REGION_PADDING),
+                min(img.width, int(right) + REGION_PADDING),
+                min(img.height, int(bottom) + REGION_PADDING),
+            ],
+            "kind": region["kind"],
+        })
+    return regions
+
+
+def region_map_path(file_path: str) -> str:
+    """領域マップの保存先パス（元ファイルと同じディレクトリ）"""
+    return file_path + REGION_MAP_SUFFIX
+
+
+def load_region_map(file_path: str) -> Dict:
+    """保存済みの領域マップを読み込む（元ファイルより古い場合は空）"""
+    path = region_map_path(file_path)
+    try:
+        if os.path.getmtime(path) < os.path.getmtime(file_path):
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != REGION_MAP_VERSION:
+            return {}
+        return data.get("pages", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_region_map(file_path: str, pages: Dict):
+    """領域マップを保存する"""
+    path = region_map_path(file_path)
+    tmp_path = None
+    try:
+        # 同じプロセスの別のセッション（スレッド）と一時ファイルが重ならないよう、一意な名前で作る
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".part")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"version": REGION_MAP_VERSION, "pages": pages}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"領域マップの保存に失敗しました: {path} ({e})")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_regions(file_path: str, page_index: int, img: Image.Image) -> List[Dict]:
+    """
+    ページの領域を取得する（保存済みの領域マップがあれば再利用）
+
+    Args:
+        file_path (str): 元の画像またはPDFのパス
+        page_index (int): ページ番号（0始まり）
+        img (Image.Image): ページ画像
+
+    Returns:
+        List[Dict]: 領域リスト
+    """
+    pages = load_region_map(file_path)
+    key = str(page_index)
+    if key in pages:
+        return pages[key]
+    regions = detect_regions(img)
+    pages[key] = regions
+    save_region_map(file_path, pages)
+    return regions
+
+
+def crop_regions(img: Image.Image, regions: List[Dict], min_saving: float = 0.15) -> List[Image.Image]:
+    """
+    領域を元の解像度のまま切り出す
+
+    Args:
+        img (Image.Image): ページ画像
+        regions (List[Dict]): 領域リスト
+        min_saving (float): 切り出しで減らせる面積の割合がこれ未満ならページ全体を返す
+
+    Returns:
+        List[Image.Image]: 切り出した画像のリスト
+    """
+    if not regions:
+        return [img]
+    page_area = img.width * img.height
+    region_area = sum((r["box"][2] - r["box"][0]) * (r["box"][3] - r["box"][1]) for r in regions)
+    if region_area > page_area * (1.0 - min_saving):
+        return [img]
+    return [img.crop(tuple(r["box"])) for r in regions]
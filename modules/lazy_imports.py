@@ -0,0 +1,71 @@
+"""
+重いライブラリの遅延読み込み
+
+torch・pyannote・whisper や各社のSDKは読み込みだけで数秒かかるため、
+モジュールの先頭ではimportせず、実際に使う時点でこのモジュールの関数から取得する。
+2回目以降は読み込み済みのモジュールをそのまま返す。
+"""
+import functools
+import importlib
+
+
+@functools.lru_cache(maxsize=None)
+def _load(name: str):
+    return importlib.import_module(name)
+
+
+def torch():
+    """torch"""
+    return _load("torch")
+
+
+def whisper():
+    """openai-whisper"""
+    return _load("whisper")
+
+
+def pyannote_pipeline():
+    """pyannote.audio.Pipeline"""
+    return _load("pyannote.audio").Pipeline
+
+
+def faster_whisper():
+    """faster-whisper"""
+    return _load("faster_whisper")
+
+
+def sounddevice():
+    """sounddevice"""
+    return _load("sounddevice")
+
+
+def anthropic():
+    """anthropic SDK"""
+    return _load("anthropic")
+
+
+def openai():
+    """openai SDK"""
+    return _load("openai")
+
+
+def genai():
+    """google.generativeai"""
+    return _load("google.generativeai")
+
+
+def pyplot():
+    """matplotlib.pyplot（サーバー上で描画するためAggバックエンドを使用）"""
+    matplotlib = _load("matplotlib")
+    matplotlib.use("Agg")
+    return _load("matplotlib.pyplot")
+
+
+def pdf2image():
+    """pdf2image"""
+    return _load("pdf2image")
+
+
+def tiktoken():
+    """tiktoken"""
+    return _load("tiktoken")
@@ -0,0 +1,164 @@
+"""
+録音中のリアルタイム文字起こしモジュール
+
+StreamRecorderが書き出している16kHzのWAVを一定間隔で読み、区切りの付いた区間
+（無音の位置、またはWhisperの入力上限の30秒）から順にバックグラウンドで文字起こしする。
+確定した区間の結果は録音ファイルの横の .segments.jsonl に追記するため、
+録音終了時に残っているのは最後の区間だけになる。
+"""
+import json
+import logging
+import os
+import struct
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from modules.vad import find_cut_point, detect_speech, SAMPLE_RATE, MIN_SEGMENT_SECONDS, MAX_SEGMENT_SECONDS
+from modules.whisper_manager import get_manager
+
+logger = logging.getLogger(__name__)
+
+# 録音ファイルを確認する間隔（秒）
+POLL_INTERVAL = 1.0
+_HEADER_SIZE = 44
+
+
+def segments_path(wav_path: str) -> str:
+    """録音ファイルの横に保存する、区間ごとの結果のパス"""
+    return f"{wav_path}.segments.jsonl"
+
+
+class LiveTranscriber:
+    """録音中のWAVファイルを区間ごとに文字起こしするクラス"""
+    def __init__(self, wav_path: str, model_size: str = "base", language: str = "ja",
+                 min_window: float = MIN_SEGMENT_SECONDS, max_window: float = MAX_SEGMENT_SECONDS,
+                 poll_interval: float = POLL_INTERVAL):
+        self.wav_path = wav_path
+        self.segments_path = segments_path(wav_path)
+        self.model_size = model_size
+        self.language = language
+        self.min_window = min_window
+        self.max_window = max_window
+        self.poll_interval = poll_interval
+        self.error = None
+        self._segments = []
+        self._processed = 0  # 文字起こし済みのサンプル数
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """バックグラウンドでの文字起こしを開始する"""
+        # 前回の録音の結果が残っていれば消す
+        if os.path.exists(self.segments_path):
+            os.remove(self.segments_path)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _available_samples(self) -> int:
+        """録音ファイルに書き出し済みのサンプル数（ヘッダーのサイズ情報から取得）"""
+        try:
+            with open(self.wav_path, "rb") as f:
+                f.seek(40)
+                size = f.read(4)
+        except OSError:
+            return 0
+        return struct.unpack("<I", size)[0] // 2 if len(size) == 4 else 0
+
+    def _read(self, start: int, end: int) -> np.ndarray:
+        with open(self.wav_path, "rb") as f:
+            f.seek(_HEADER_SIZE + start * 2)
+            data = f.read((end - start) * 2)
+        return np.frombuffer(data[:len(data) // 2 * 2], dtype="<i2").astype(np.float32) / 32768.0
+
+    def _transcribe(self, audio: np.ndarray, offset: int):
+        """1区間を文字起こしし、結果を絶対時刻に直して保存する"""
+        if not detect_speech(audio).any():
+            return
+        result = get_manager().transcribe(audio, size=self.model_size, language=self.language)
+        base = offset / SAMPLE_RATE
+        with self._lock:
+            new_segments = []
+            for seg in result["segments"]:
+                text = seg["text"].strip()
+                if text:
+                    new_segments.append({
+                        "id": len(self._segments) + len(new_segments),
+                        "start": round(seg["start"] + base, 2),
+                        "end": round(seg["end"] + base, 2),
+                        "text": text,
+                    })
+            self._segments.extend(new_segments)
+        with open(self.segments_path, "a", encoding="utf-8") as f:
+            for seg in new_segments:
+                f.write(json.dumps(seg, ensure_ascii=False) + "\n")
+
+    def _process(self, final: bool = False):
+        """区切りの付いた区間を順に文字起こしする（final=Trueの場合は残りすべて）"""
+        max_samples = int(self.max_window * SAMPLE_RATE)
+        while True:
+            total = self._available_samples()
+            pending = self._read(self._processed, min(total, self._processed + max_samples))
+            if len(pending) == 0:
+                return
+            cut = find_cut_point(pending, self.min_window, self.max_window)
+            if cut is None:
+                if not final:
+                    return
+                cut = len(pending)
+            self._transcribe(pending[:cut], self._processed)
+            self._processed += cut
+
+    def _loop(self):
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                self._process()
+            except Exception as e:
+                self.error = str(e)
+                logger.error(f"リアルタイム文字起こし中にエラーが発生しました: {e}")
+                return
+
+    def stop(self):
+        """バックグラウンドでの文字起こしを停止する（実行中の区間の完了は待つ）"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def finish(self) -> Dict:
+        """
+        録音終了後に呼び出し、残りの区間を文字起こしして結果を返す
+
+        Returns:
+            Dict: text, segments（whisperのtranscribeと同じ形式、時刻は録音開始からの秒数）
+        """
+        self.stop()
+        self._process(final=True)
+        return {"text": self.text, "segments": self.segments}
+
+    @property
+    def segments(self) -> List[Dict]:
+        with self._lock:
+            return list(self._segments)
+
+    @property
+    def text(self) -> str:
+        """確定済みの文字起こし結果"""
+        return "".join(seg["text"] for seg in self.segments)
+
+    @property
+    def processed_seconds(self) -> float:
+        """文字起こし済みの秒数"""
+        return self._processed / SAMPLE_RATE
+
+
+def load_segments(wav_path: str) -> Optional[List[Dict]]:
+    """録音ファイルの横に保存された区間ごとの結果を読み込む（ない場合はNone）"""
+    path = segments_path(wav_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
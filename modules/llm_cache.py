@@ -0,0 +1,187 @@
+"""
+テキスト生成（チャットAPI）の結果のキャッシュ
+
+モデル・正規化したプロンプト・パラメータ・プロンプトのテンプレートのバージョンをキーに、
+応答のテキストをSQLiteに保存する。Streamlitの再実行や案件の再表示で同じ呼び出しが
+行われた場合は、APIを呼び出さずに保存済みの応答を返す。
+保存から有効期限（TTL）を過ぎたものは使わず、合計サイズが上限を超えた場合は
+最後に使われた日時が古いものから削除する。
+温度がMAX_CACHEABLE_TEMPERATUREより高い（応答が毎回変わる前提の）呼び出しは保存しない。
+
+secretsのllm_cache_enabled（または環境変数LLM_CACHE_DISABLED=1）でキャッシュを無効にできる。
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Dict, List, Optional
+
+DEFAULT_DB_PATH = "db/llm_cache.db"
+# キャッシュの合計サイズの上限（MB）
+DEFAULT_MAX_MB = 100
+# 有効期限（日）
+DEFAULT_TTL_DAYS = 30
+# キャッシュする呼び出しの温度の上限（これより高い温度の応答は毎回変わる前提のため保存しない）
+MAX_CACHEABLE_TEMPERATURE = 0.3
+
+
+def normalize_prompt(text: str) -> str:
+    """キーの計算に使うプロンプトの正規化（インデント・行末の空白・連続する空白や空行の違いを無視する）"""
+    text = unicodedata.normalize("NFC", text)
+    lines = [re.sub(r"[ \t　]+", " ", line).strip() for line in text.strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+
+def make_key(model: str, messages: List[Dict], params: Optional[Dict] = None,
+             template: Optional[str] = None) -> str:
+    """キャッシュのキー（モデル・正規化したプロンプト・パラメータ・テンプレートのバージョンから作る）"""
+    payload = json.dumps({
+        "model": model,
+        "messages": [
+            [m.get("role"), normalize_prompt(m["content"]) if isinstance(m.get("content"), str) else m.get("content")]
+            for m in messages
+        ],
+        "params": params or {},
+        "template": template,
+    }, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """チャットAPIの応答をSQLiteに保存するキャッシュ"""
+    def __init__(self, db_path: str = DEFAULT_DB_PATH, max_mb: float = DEFAULT_MAX_MB,
+                 ttl_days: float = DEFAULT_TTL_DAYS):
+        self.db_path = db_path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        dir_path = os.path.dirname(db_path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    template TEXT,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_completions_last_used ON completions(last_used)")
+            conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        キャッシュされた応答を取得する
+
+        Returns:
+            Optional[str]: 応答のテキスト（キャッシュにない・有効期限切れの場合はNone）
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT response, created_at FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl_seconds:
+                conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE completions SET last_used = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+        return row[0]
+
+    def put(self, key: str, response: str, model: Optional[str] = None, template: Optional[str] = None):
+        """応答を保存し、有効期限切れのものと上限を超えた分を古いものから削除する"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO completions (key, model, template, response, size, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (key, model, template, response, len(response.encode("utf-8")), now, now))
+            conn.execute("DELETE FROM completions WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection):
+        """合計サイズが上限以下になるまで、最後に使われた日時が古いものから削除する"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        removed = []
+        for key, size in conn.execute("SELECT key, size FROM completions ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            removed.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM completions WHERE key = ?", removed)
+
+    def clear(self):
+        """すべての応答を削除する"""
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM completions")
+            conn.commit()
+
+    def stats(self) -> Dict:
+        """件数・合計サイズ・ヒット率"""
+        with self._connect() as conn:
+            count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": count,
+            "size_mb": round(total / (1024 * 1024), 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _settings() -> Dict:
+    settings = {"enabled": os.getenv("LLM_CACHE_DISABLED", "") not in ("1", "true"),
+                "max_mb": DEFAULT_MAX_MB, "ttl_days": DEFAULT_TTL_DAYS}
+    try:
+        import streamlit as st
+        # 環境変数LLM_CACHE_DISABLEDで無効にした場合は、secretsのllm_cache_enabledより優先する
+        settings["enabled"] = settings["enabled"] and bool(st.secrets.get("llm_cache_enabled", True))
+        settings["max_mb"] = float(st.secrets.get("llm_cache_mb", settings["max_mb"]))
+        settings["ttl_days"] = float(st.secrets.get("llm_cache_ttl_days", settings["ttl_days"]))
+    except Exception:
+        pass
+    return settings
+
+
+def get_cache() -> Optional[LLMCache]:
+    """
+    プロセス共通のLLMCacheを取得する（無効にしている場合はNone）
+
+    上限はsecretsのllm_cache_mb、有効期限はllm_cache_ttl_daysで変更できる。
+    secretsのllm_cache_enabled = false、または環境変数LLM_CACHE_DISABLED=1で無効になる。
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            settings = _settings()
+            if not settings["enabled"]:
+                return None
+            _cache = LLMCache(max_mb=settings["max_mb"], ttl_days=settings["ttl_days"])
+        return _cache
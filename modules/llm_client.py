@@ -0,0 +1,405 @@
+"""
+OpenAIのチャットAPI呼び出しの共通処理
+
+クライアントはプロセス内で使い回し、すべての呼び出しをレート制御（RateGovernor）の下で行う。
+複数のチャンクを並列に処理する map_parallel と、応答を逐次受け取る ChatStream も提供する。
+応答はllm_cacheに保存し、同じ呼び出しにはAPIを使わずに保存済みの応答を返す。
+モデルを指定しない呼び出しは、model_routerが入力の長さと処理の種類（task）から選んだモデルを使い、
+エラー・タイムアウトの場合は次の候補（Claudeを含む）で呼び出し直す。
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+from modules import lazy_imports
+from modules import llm_cache
+from modules import model_router
+from modules.rate_limiter import get_governor, PRIORITY_INTERACTIVE, SDK_MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# 並列に実行するAPI呼び出しの上限（実際の送信ペースはRateGovernorが制御する）
+DEFAULT_CONCURRENCY = 4
+
+_client = None
+_anthropic_client = None
+_client_lock = threading.Lock()
+
+
+def _secret(name: str) -> Optional[str]:
+    try:
+        import streamlit as st
+        return st.secrets.get(name)
+    except Exception:
+        # secrets.tomlがない場合（開発用のスクリプトなど）
+        return None
+
+
+def openai_base_url() -> Optional[str]:
+    """OpenAI互換の接続先（secretsのopenai_base_url、なければ環境変数OPENAI_BASE_URL。既定はNone）"""
+    return _secret("openai_base_url") or os.getenv("OPENAI_BASE_URL") or None
+
+
+def openai_settings() -> Dict[str, Optional[str]]:
+    """
+    OpenAIの接続先（secretsのopenai_api_key・openai_base_url、なければ環境変数
+    OPENAI_API_KEY・OPENAI_BASE_URL）
+
+    Raises:
+        KeyError: APIキーが設定されていない場合
+    """
+    api_key = _secret("openai_api_key") or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise KeyError("openai_api_key")
+    return {"api_key": api_key, "base_url": openai_base_url()}
+
+
+def get_openai_client():
+    """プロセス共通のOpenAIクライアント"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = lazy_imports.openai().OpenAI(**openai_settings(), max_retries=SDK_MAX_RETRIES)
+        return _client
+
+
+def anthropic_api_key() -> Optional[str]:
+    """代わりのモデル（Claude）に使うAPIキー（secretsのclaude_api_key、なければ環境変数ANTHROPIC_API_KEY）"""
+    return _secret("claude_api_key") or os.getenv("ANTHROPIC_API_KEY")
+
+
+def get_anthropic_client():
+    """プロセス共通のAnthropicクライアント"""
+    global _anthropic_client
+    with _client_lock:
+        if _anthropic_client is None:
+            api_key = anthropic_api_key()
+            if not api_key:
+                raise KeyError("claude_api_key")
+            _anthropic_client = lazy_imports.anthropic().Anthropic(api_key=api_key, max_retries=SDK_MAX_RETRIES)
+        return _anthropic_client
+
+
+def _fallback_enabled() -> bool:
+    value = _secret("llm_fallback_enabled")
+    return True if value is None else bool(value)
+
+
+def _routes(messages: List[Dict], model: Optional[str], max_tokens: int, task: Optional[str],
+            slo: Optional[float], kwargs: Dict) -> List[Dict]:
+    """呼び出すモデルの順序（APIキーのないプロバイダは除く）"""
+    response_format = kwargs.get("response_format") or {}
+    routes = model_router.plan(task, messages, max_tokens, model=model, slo=slo,
+                               structured=response_format.get("type") == "json_schema")
+    if not _fallback_enabled():
+        return routes[:1]
+    has_anthropic = bool(anthropic_api_key())
+    return [r for i, r in enumerate(routes) if i == 0 or r["provider"] == "openai" or has_anthropic]
+
+
+def _next_route(routes: List[Dict], index: int, error: Exception) -> Optional[int]:
+    """
+    失敗したroutes[index]の次に呼び出す候補の番号（なければNone）
+
+    入力が大きすぎるなどのリクエストの誤り（400）は同じプロバイダの次の候補で、
+    それ以外のエラー・タイムアウトは他のプロバイダの候補で呼び出し直す。
+    """
+    same_provider = getattr(error, "status_code", None) == 400
+    for i in range(index + 1, len(routes)):
+        if same_provider or routes[i]["provider"] != routes[index]["provider"]:
+            logger.warning("%sの呼び出しに失敗したため、%sで再実行します: %s",
+                           routes[index]["model"], routes[i]["model"], error)
+            return i
+    return None
+
+
+def _without_retries(client):
+    """
+    SDKの再試行を無効にしたクライアント（呼び出し元が渡したクライアントにも適用する）
+
+    タイムアウト・5xxをSDKが再試行すると、次の候補に切り替わるまでにタイムアウトの数倍かかるため、
+    最初の失敗ですぐに_next_routeの候補に切り替える。
+    """
+    with_options = getattr(client, "with_options", None)
+    return with_options(max_retries=SDK_MAX_RETRIES) if with_options is not None else client
+
+
+def _cache_key(messages: List[Dict], model: str, temperature: float, max_tokens: int,
+               template: Optional[str], kwargs: Dict):
+    """キャッシュとキー（キャッシュを使わない場合・温度が高い呼び出しの場合はNone, None）"""
+    cache = llm_cache.get_cache()
+    if cache is None or temperature > llm_cache.MAX_CACHEABLE_TEMPERATURE:
+        return None, None
+    params = dict(kwargs, temperature=temperature, max_tokens=max_tokens)
+    base_url = openai_base_url()
+    if base_url:
+        # 接続先を変えた場合（開発用のスタブなど）の応答を、本来のAPIの呼び出しに使わない
+        params["base_url"] = base_url
+    return cache, llm_cache.make_key(model, messages, params, template)
+
+
+def _anthropic_request(messages: List[Dict], kwargs: Dict):
+    """OpenAI形式のメッセージを、Claudeのsystemとmessagesに変換する"""
+    system = [m["content"] for m in messages if m.get("role") == "system"]
+    response_format = kwargs.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        # 構造化出力の代わりに、スキーマをプロンプトで指示する
+        schema = json.dumps(response_format["json_schema"]["schema"], ensure_ascii=False)
+        system.append(f"次のJSONスキーマに従うJSONオブジェクトだけを出力してください。\n{schema}")
+    return "\n\n".join(system), [m for m in messages if m.get("role") != "system"]
+
+
+def _complete(route: Dict, messages: List[Dict], temperature: float, priority: int,
+              on_wait: Optional[Callable[[int, float], None]], client, template: Optional[str],
+              cache: bool, kwargs: Dict) -> str:
+    """routeのモデルで1回呼び出す（キャッシュがあればAPIを使わない）"""
+    model, max_tokens = route["model"], route["max_tokens"]
+    store, key = _cache_key(messages, model, temperature, max_tokens, template, kwargs) if cache else (None, None)
+    if store is not None:
+        cached = store.get(key)
+        if cached is not None:
+            return cached
+    timeout = {"timeout": route["timeout"]} if route.get("timeout") else {}
+    if route["provider"] == "anthropic":
+        anthropic_client = _without_retries(get_anthropic_client())
+        system, user_messages = _anthropic_request(messages, kwargs)
+        message = get_governor().call("anthropic", lambda: anthropic_client.messages.create(
+            model=model,
+            system=system,
+            messages=user_messages,
+            temperature=min(temperature, 1.0),
+            max_tokens=max_tokens,
+            **timeout
+        ), tokens=route["input_tokens"] + max_tokens, priority=priority, on_wait=on_wait)
+        text = "".join(block.text for block in message.content if getattr(block, "type", "") == "text")
+        if kwargs.get("response_format"):
+            # コードブロックで囲まれた場合も、JSONの部分だけを返す
+            match = re.search(r"\{[\s\S]*\}", text)
+            text = match.group() if match else text
+        completed = message.stop_reason == "end_turn"
+    else:
+        client = _without_retries(client or get_openai_client())
+        response = get_governor().call("openai", lambda: client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **timeout,
+            **kwargs
+        ), tokens=route["input_tokens"] + max_tokens, priority=priority, on_wait=on_wait)
+        choice = response.choices[0]
+        text = choice.message.content
+        completed = choice.finish_reason == "stop"
+    # 出力の上限で途切れた応答は保存しない
+    if store is not None and text is not None and completed:
+        store.put(key, text, model, template)
+    return text
+
+
+def chat(messages: List[Dict], model: Optional[str] = None, temperature: float = 0.3,
+         max_tokens: int = 2000, priority: int = PRIORITY_INTERACTIVE,
+         on_wait: Optional[Callable[[int, float], None]] = None, client=None,
+         template: Optional[str] = None, cache: bool = True, task: Optional[str] = None,
+         slo: Optional[float] = None, **kwargs) -> str:
+    """
+    チャットAPIを呼び出し、応答のテキストを返す
+
+    Args:
+        messages (List[Dict]): role, content のリスト
+        model (str): モデル名（省略時はtaskと入力の長さからmodel_routerが選ぶ）
+        temperature (float): 温度
+        max_tokens (int): 出力の最大トークン数
+        priority (int): RateGovernorでの優先度
+        on_wait (Callable): 順番待ち中のコールバック
+        client: 使用するOpenAIクライアント（省略時はプロセス共通のクライアント）
+        template (str): プロンプトのテンプレートの名前とバージョン（キャッシュのキーに含める）
+        cache (bool): Falseの場合はキャッシュを使わずに必ずAPIを呼び出す
+        task (str): 処理の種類（model_router.TASKSのキー）。モデルの選択と代わりのモデルに使う
+        slo (float): 応答時間の目標（秒、省略時は処理の種類ごとの既定値）
+        **kwargs: chat.completions.createに渡すその他の引数
+
+    Returns:
+        str: 応答のテキスト
+    """
+    routes = _routes(messages, model, max_tokens, task, slo, kwargs)
+    index = 0
+    while True:
+        try:
+            return _complete(routes[index], messages, temperature, priority, on_wait, client, template,
+                             cache, kwargs)
+        except Exception as e:
+            index = _next_route(routes, index, e)
+            if index is None:
+                raise
+
+
+class ChatStream:
+    """
+    チャットAPIのストリーミング応答
+
+    イテレートすると届いた順にテキストの断片を返す（st.write_streamにそのまま渡せる）。
+    受け取ったテキストはバッファに保持し、終了後にtextで全体を参照できる。
+    ttftには、呼び出し開始（レート制御の順番待ちを含む）から最初の断片が届くまでの秒数を記録する。
+    キャッシュに応答がある場合は、APIを呼び出さずに応答全体を1つの断片として返す。
+    最初の断片が届く前にエラーになった場合は次の候補のモデルで呼び出し直し（modelは実際に
+    使ったモデルになる）、Claudeで呼び出し直す場合は応答全体を1つの断片として返す。
+    """
+    def __init__(self, messages: List[Dict], model: Optional[str] = None, temperature: float = 0.3,
+                 max_tokens: int = 2000, priority: int = PRIORITY_INTERACTIVE,
+                 on_wait: Optional[Callable[[int, float], None]] = None, client=None,
+                 template: Optional[str] = None, cache: bool = True, task: Optional[str] = None,
+                 slo: Optional[float] = None, **kwargs):
+        self.messages = messages
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.priority = priority
+        self.on_wait = on_wait
+        self.client = client
+        self.template = template
+        self.cache = cache
+        self.task = task
+        self.slo = slo
+        self.kwargs = kwargs
+        self.cached = False
+        self.ttft: Optional[float] = None
+        self.total_seconds: Optional[float] = None
+        self.finished = False
+        self._parts: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """これまでに受け取ったテキスト"""
+        return "".join(self._parts)
+
+    def _finish_whole(self, text: str, started: float):
+        """応答全体を1つの断片として受け取った場合"""
+        self.ttft = self.total_seconds = time.monotonic() - started
+        self._parts.append(text)
+        self.finished = True
+
+    def __iter__(self):
+        if self._parts or self.finished:
+            # 2回目以降は、バッファしたテキストを返す（APIを再度呼び出さない）
+            yield self.text
+            return
+        started = time.monotonic()
+        routes = _routes(self.messages, self.model, self.max_tokens, self.task, self.slo, self.kwargs)
+        index = 0
+        while index is not None:
+            route = routes[index]
+            self.model = route["model"]
+            if route["provider"] != "openai":
+                try:
+                    text = _complete(route, self.messages, self.temperature, self.priority, self.on_wait,
+                                     None, self.template, self.cache, self.kwargs)
+                except Exception as e:
+                    index = _next_route(routes, index, e)
+                    if index is None:
+                        raise
+                    continue
+                self._finish_whole(text, started)
+                yield text
+                return
+
+            store, key = _cache_key(self.messages, self.model, self.temperature, route["max_tokens"],
+                                    self.template, self.kwargs) if self.cache else (None, None)
+            cached = store.get(key) if store is not None else None
+            if cached is not None:
+                self.cached = True
+                self._finish_whole(cached, started)
+                yield cached
+                return
+            client = _without_retries(self.client or get_openai_client())
+            timeout = {"timeout": route["timeout"]} if route.get("timeout") else {}
+            try:
+                # 429の再試行は接続時（最初の応答の前）にRateGovernorが行う
+                stream = get_governor().call("openai", lambda: client.chat.completions.create(
+                    model=route["model"],
+                    messages=self.messages,
+                    temperature=self.temperature,
+                    max_tokens=route["max_tokens"],
+                    stream=True,
+                    **timeout,
+                    **self.kwargs
+                ), tokens=route["input_tokens"] + route["max_tokens"], priority=self.priority,
+                    on_wait=self.on_wait)
+            except Exception as e:
+                index = _next_route(routes, index, e)
+                if index is None:
+                    raise
+                continue
+            finish_reason = None
+            failed = False
+            chunks = iter(stream)
+            while True:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    # 最初の断片が届く前の読み取りエラー・タイムアウトは、次の候補で呼び出し直す
+                    if self._parts:
+                        raise
+                    index = _next_route(routes, index, e)
+                    if index is None:
+                        raise
+                    failed = True
+                    break
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if self.ttft is None:
+                    self.ttft = time.monotonic() - started
+                self._parts.append(delta)
+                yield delta
+            if failed:
+                continue
+            self.total_seconds = time.monotonic() - started
+            self.finished = True
+            if store is not None and finish_reason == "stop":
+                store.put(key, self.text, self.model, self.template)
+            logger.info("%s: 最初の応答まで %.2f秒, 完了まで %.2f秒",
+                        self.model, self.ttft or 0.0, self.total_seconds)
+            return
+
+
+def concurrency() -> int:
+    """並列数（secretsのllm_concurrency、なければ環境変数LLM_CONCURRENCYで変更可能）"""
+    try:
+        return max(1, int(_secret("llm_concurrency") or os.getenv("LLM_CONCURRENCY") or DEFAULT_CONCURRENCY))
+    except (TypeError, ValueError):
+        return DEFAULT_CONCURRENCY
+
+
+def map_parallel(func: Callable, items: List, on_done: Optional[Callable[[int], None]] = None,
+                 max_workers: Optional[int] = None) -> List:
+    """
+    itemsの各要素にfuncを並列に適用し、元の順序で結果を返す
+
+    例外が発生した要素は結果の代わりに例外オブジェクトを返す（呼び出し側で処理する）。
+    on_doneは呼び出し元のスレッドで、1件完了するたびに要素の番号を引数に呼ばれるため、
+    Streamlitのプログレスバーを直接更新できる。
+    """
+    if not items:
+        return []
+    results = [None] * len(items)
+    with ThreadPoolExecutor(max_workers=min(max_workers or concurrency(), len(items))) as executor:
+        futures = {executor.submit(func, item): i for i, item in enumerate(items)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                results[index] = e
+            if on_done:
+                on_done(index)
+    return results
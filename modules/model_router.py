@@ -0,0 +1,207 @@
+"""
+入力の長さ・処理の種類・応答時間の目標に応じたモデルの選択
+
+呼び出しの前に入力のトークン数を見積もり、処理の種類（task）ごとの候補の中から
+コンテキスト長に収まり、応答時間の目標（SLO）を満たすモデルを選ぶ。短い入力には速いモデルを使い、
+長い入力はコンテキスト長の大きいモデルに回すため、入力が長すぎて失敗することがない。
+選んだモデルがエラー・タイムアウトになった場合の代わりのモデル（他のプロバイダを含む）も
+順に返し、llm_clientはその順に呼び出す。
+
+estimateは呼び出し1回あたりの所要時間と費用の見積もりで、長い処理の前に画面に表示する。
+料金（1Mトークンあたりのドル）と速度は目安の値。
+"""
+import math
+from typing import Dict, List, Optional
+
+from modules.rate_limiter import estimate_tokens
+
+# モデルごとのプロバイダ・コンテキスト長・出力の上限・料金・速度の目安
+# structuredはresponse_formatのjson_schema（構造化出力）に対応しているか
+MODELS = {
+    "gpt-4o-mini": {"provider": "openai", "context": 128000, "max_output": 16384,
+                    "input_cost": 0.15, "output_cost": 0.6, "ttft": 0.5, "tokens_per_second": 90,
+                    "structured": True},
+    "gpt-3.5-turbo": {"provider": "openai", "context": 16385, "max_output": 4096,
+                      "input_cost": 0.5, "output_cost": 1.5, "ttft": 0.4, "tokens_per_second": 80,
+                      "structured": False},
+    "gpt-4o": {"provider": "openai", "context": 128000, "max_output": 16384,
+               "input_cost": 2.5, "output_cost": 10.0, "ttft": 0.6, "tokens_per_second": 70,
+               "structured": True},
+    "gpt-4": {"provider": "openai", "context": 8192, "max_output": 8192,
+              "input_cost": 30.0, "output_cost": 60.0, "ttft": 1.0, "tokens_per_second": 25,
+              "structured": False},
+    # 構造化出力はプロンプトでスキーマを指示して代替する
+    "claude-3-5-haiku-20241022": {"provider": "anthropic", "context": 200000, "max_output": 8192,
+                                  "input_cost": 0.8, "output_cost": 4.0, "ttft": 0.7,
+                                  "tokens_per_second": 60, "structured": True},
+    "claude-3-7-sonnet-20250219": {"provider": "anthropic", "context": 200000, "max_output": 8192,
+                                   "input_cost": 3.0, "output_cost": 15.0, "ttft": 1.0,
+                                   "tokens_per_second": 50, "structured": True},
+}
+
+# 処理の種類ごとの候補
+#   fast: 入力がshort_tokens以下の場合に優先するモデル
+#   models: 通常の候補（先頭が既定。コンテキスト長に収まらない場合は次の候補）
+#   fallback: エラー・タイムアウト時に使う他のプロバイダのモデル
+#   output_ratio: 入力に対する出力のトークン数の目安（所要時間・費用の見積もりに使う）
+#   slo: 1回の呼び出しの応答時間の目標（秒、Noneは目標なし）
+TASKS = {
+    "default": {"fast": None, "short_tokens": 0, "models": ["gpt-3.5-turbo", "gpt-4o-mini"],
+                "fallback": ["claude-3-5-haiku-20241022"], "output_ratio": 0.5, "slo": None},
+    # summarizer: チャンクの会話形式への整形
+    "format": {"fast": None, "short_tokens": 0, "models": ["gpt-3.5-turbo", "gpt-4o-mini"],
+               "fallback": ["claude-3-5-haiku-20241022"], "output_ratio": 1.1, "slo": None},
+    # summarizer: チャンクの要約と要約の統合
+    "summarize": {"fast": None, "short_tokens": 0, "models": ["gpt-3.5-turbo", "gpt-4o-mini"],
+                  "fallback": ["claude-3-5-haiku-20241022"], "output_ratio": 0.3, "slo": None},
+    # SummaryGenerator
+    "summary": {"fast": "gpt-4o-mini", "short_tokens": 1500, "models": ["gpt-4", "gpt-4o"],
+                "fallback": ["claude-3-7-sonnet-20250219"], "output_ratio": 0.3, "slo": 30},
+    # Categorizer
+    "categorize": {"fast": "gpt-4o-mini", "short_tokens": 1500, "models": ["gpt-4", "gpt-4o"],
+                   "fallback": ["claude-3-7-sonnet-20250219"], "output_ratio": 0.3, "slo": 30},
+    # InterviewExtractor（構造化出力）
+    "extract": {"fast": "gpt-4o-mini", "short_tokens": 1500, "models": ["gpt-4o"],
+                "fallback": ["claude-3-7-sonnet-20250219"], "output_ratio": 0.4, "slo": 30},
+    # OCR結果の日本語の整形
+    "ocr_refine": {"fast": "gpt-4o-mini", "short_tokens": 800, "models": ["gpt-4o"],
+                   "fallback": ["claude-3-5-haiku-20241022"], "output_ratio": 1.0, "slo": 30},
+}
+
+# 入力のトークン数あたりの処理時間の目安（秒/トークン）
+PREFILL_SECONDS_PER_TOKEN = 0.0002
+# メッセージ1件あたりの書式のトークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+# タイムアウトは見積もった所要時間のこの倍（ただしMIN_TIMEOUT秒以上）
+TIMEOUT_FACTOR = 4
+MIN_TIMEOUT = 30
+
+
+def _secret(name: str):
+    try:
+        import streamlit as st
+        return st.secrets.get(name)
+    except Exception:
+        return None
+
+
+def count_input_tokens(messages: List[Dict]) -> int:
+    """メッセージ全体の入力トークン数の見積もり"""
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS
+               for m in messages if isinstance(m.get("content"), str))
+
+
+def task_slo(task: str) -> Optional[float]:
+    """
+    処理の種類ごとの応答時間の目標（秒）
+
+    secretsのllm_latency_sloに数値を指定するとすべての処理に、
+    テーブル（例: {summary = 20}）を指定すると処理の種類ごとに適用する。
+    """
+    override = _secret("llm_latency_slo")
+    if isinstance(override, (int, float)):
+        return float(override)
+    if override is not None and hasattr(override, "get") and override.get(task) is not None:
+        return float(override.get(task))
+    return TASKS.get(task, TASKS["default"])["slo"]
+
+
+def estimate(model: str, input_tokens: int, output_tokens: int) -> Dict:
+    """
+    呼び出し1回の所要時間（秒）と費用（ドル）の見積もり
+
+    Returns:
+        Dict: seconds, cost_usd
+    """
+    spec = MODELS[model]
+    seconds = (spec["ttft"] + input_tokens * PREFILL_SECONDS_PER_TOKEN
+               + output_tokens / spec["tokens_per_second"])
+    cost = (input_tokens * spec["input_cost"] + output_tokens * spec["output_cost"]) / 1_000_000
+    return {"seconds": seconds, "cost_usd": cost}
+
+
+def _fits(model: str, input_tokens: int, max_tokens: int, structured: bool) -> bool:
+    spec = MODELS[model]
+    if structured and not spec["structured"]:
+        return False
+    return input_tokens + min(max_tokens, spec["max_output"]) <= spec["context"]
+
+
+def plan(task: Optional[str], messages: List[Dict], max_tokens: int, model: Optional[str] = None,
+         slo: Optional[float] = None, structured: bool = False) -> List[Dict]:
+    """
+    呼び出すモデルの順序（先頭から呼び出し、失敗した場合は次のモデルを使う）
+
+    Args:
+        task (str): 処理の種類（TASKSのキー。Noneはdefault）
+        messages (List[Dict]): role, content のリスト
+        その他の引数はplan_tokensと同じ
+    """
+    return plan_tokens(task, count_input_tokens(messages), max_tokens, model, slo, structured)
+
+
+def plan_tokens(task: Optional[str], input_tokens: int, max_tokens: int, model: Optional[str] = None,
+                slo: Optional[float] = None, structured: bool = False) -> List[Dict]:
+    """
+    入力のトークン数から、呼び出すモデルの順序を決める（実行前の見積もりにも使う）
+
+    Args:
+        task (str): 処理の種類（TASKSのキー。Noneはdefault）
+        input_tokens (int): 入力のトークン数
+        max_tokens (int): 出力の最大トークン数
+        model (str): 指定した場合は、このモデルを先頭にする（代わりのモデルはtaskの候補から選ぶ）
+        slo (float): 応答時間の目標（秒）。省略時はtask_sloの値
+        structured (bool): 構造化出力（json_schema）が必要か
+
+    Returns:
+        List[Dict]: model, provider, max_tokens, input_tokens, seconds, cost_usd, timeout
+    """
+    config = TASKS.get(task or "default", TASKS["default"])
+    output_tokens = min(max_tokens, int(input_tokens * config["output_ratio"]) + 100)
+    slo = slo if slo is not None else task_slo(task or "default")
+
+    if model:
+        primary = [model]
+    else:
+        primary = ([config["fast"]] if config["fast"] and input_tokens <= config["short_tokens"] else [])
+        primary += [m for m in config["models"] if m not in primary]
+        primary = [m for m in primary if _fits(m, input_tokens, max_tokens, structured)]
+        if slo is not None:
+            # 目標を満たすモデルを優先し、満たすものがない場合は速い順にする
+            meets = [m for m in primary if estimate(m, input_tokens, output_tokens)["seconds"] <= slo]
+            rest = sorted((m for m in primary if m not in meets),
+                          key=lambda m: estimate(m, input_tokens, output_tokens)["seconds"])
+            primary = meets + rest
+        if not primary:
+            # どの候補にも収まらない場合は、コンテキスト長が最大のモデルで試す
+            primary = [max(config["models"], key=lambda m: MODELS[m]["context"])]
+    fallback = [m for m in config["fallback"]
+                if m not in primary and _fits(m, input_tokens, max_tokens, structured)]
+
+    routes = []
+    for name in primary + fallback:
+        spec = MODELS.get(name)
+        if spec is None:
+            # MODELSにないモデルを直接指定した場合は、そのまま呼び出す
+            routes.append({"model": name, "provider": "openai", "max_tokens": max_tokens,
+                           "input_tokens": input_tokens, "seconds": None, "cost_usd": None,
+                           "timeout": None})
+            continue
+        expected = estimate(name, input_tokens, min(output_tokens, spec["max_output"]))
+        routes.append({
+            "model": name,
+            "provider": spec["provider"],
+            "max_tokens": min(max_tokens, spec["max_output"]),
+            "input_tokens": input_tokens,
+            "seconds": expected["seconds"],
+            "cost_usd": expected["cost_usd"],
+            "timeout": max(MIN_TIMEOUT, math.ceil(expected["seconds"] * TIMEOUT_FACTOR)),
+        })
+    return routes
+
+
+def describe(route: Dict) -> str:
+    """見積もりの表示用の文字列（例: gpt-4o・約12秒・約$0.010）"""
+    if route.get("seconds") is None:
+        return route["model"]
+    return f"{route['model']}・約{route['seconds']:.0f}秒・約${route['cost_usd']:.3f}"
@@ -0,0 +1,327 @@
+"""
+OCR抽出結果の構造化保存モジュール
+
+ocr.resultに保存されるモデルの生出力（前後に文章が付いたJSONや「項目: 値」形式）を
+解析し、ocr_fieldsテーブルに1項目1行で保存する。数値として解釈できる値は
+numeric_valueにも保存するため、文書をまたいだ集計をインデックス検索で行える。
+"""
+import json
+import re
+import sqlite3
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+# 金額の単位と倍率
+_UNIT_MULTIPLIERS = [
+    ("百万円", 1_000_000),
+    ("千万円", 10_000_000),
+    ("億円", 100_000_000),
+    ("万円", 10_000),
+    ("千円", 1_000),
+    ("円", 1),
+]
+_NUMBER_PATTERN = re.compile(r"^[-+]?\d+(?:\.\d+)?$")
+_KEY_VALUE_PATTERN = re.compile(r"^\s*[-*・]?\s*[\"「]?([^:：\"」]{1,60})[\"」]?\s*[:：]\s*(.+?)\s*,?\s*$")
+# 「{項目: 値, 項目: 値}」形式で、カンマの後に次の項目が始まる位置
+_ENTRY_START_PATTERN = re.compile(r"\s*[\"「]?[^,，:：\"」{}()\[\]]{1,60}[\"」]?\s*[:：]")
+
+
+def parse_numeric(value) -> Optional[float]:
+    """
+    値を数値に変換する（桁区切り、全角数字、△▲や括弧の負数、金額単位に対応）
+
+    Args:
+        value: 抽出された値
+
+    Returns:
+        Optional[float]: 数値（数値として解釈できない場合はNone）
+    """
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = unicodedata.normalize("NFKC", str(value)).strip()
+    if not text:
+        return None
+    negative = False
+    if text[0] in "△▲-−":
+        negative = True
+        text = text[1:].strip()
+    if text.startswith("(") and text.endswith(")"):
+        negative = True
+        text = text[1:-1].strip()
+    multiplier = 1
+    for unit, factor in _UNIT_MULTIPLIERS:
+        if text.endswith(unit):
+            multiplier = factor
+            text = text[:-len(unit)].strip()
+            break
+    text = text.replace(",", "").replace(" ", "")
+    if not _NUMBER_PATTERN.match(text):
+        return None
+    number = float(text) * multiplier
+    return -number if negative else number
+
+
+def _find_json_objects(text: str) -> List:
+    """テキスト中に含まれるJSONオブジェクトを順に取り出す"""
+    decoder = json.JSONDecoder()
+    objects = []
+    index = 0
+    while True:
+        start = text.find("{", index)
+        if start < 0:
+            break
+        try:
+            obj, end = decoder.raw_decode(text, start)
+        except ValueError:
+            index = start + 1
+            continue
+        if isinstance(obj, dict):
+            objects.append(obj)
+        index = end
+    return objects
+
+
+def _flatten(obj, prefix: str = "") -> List[Tuple[str, str]]:
+    """入れ子のJSONを (項目名, 値) のリストに展開する"""
+    if isinstance(obj, dict):
+        # 表形式 {"columns": [...], "data": [[...], ...]}
+        if isinstance(obj.get("columns"), list) and isinstance(obj.get("data"), list):
+            return _flatten_table(obj["columns"], obj["data"], prefix)
+        items = []
+        for key, value in obj.items():
+            name = f"{prefix}.{key}" if prefix else str(key)
+            items.extend(_flatten(value, name))
+        return items
+    if isinstance(obj, list):
+        if all(not isinstance(v, (dict, list)) for v in obj):
+            return [(prefix, ", ".join(str(v) for v in obj))]
+        items = []
+        for i, value in enumerate(obj):
+            items.extend(_flatten(value, f"{prefix}[{i}]"))
+        return items
+    return [(prefix, "" if obj is None else str(obj))]
+
+
+def _flatten_table(columns: List, rows: List, prefix: str = "") -> List[Tuple[str, str]]:
+    """表形式のJSONを「行見出し」または「行見出し.列名」の項目に展開する"""
+    items = []
+    for row in rows:
+        if not isinstance(row, list) or not row:
+            continue
+        row_label = str(row[0]).strip()
+        for column, value in zip(columns[1:], row[1:]):
+            name = row_label if len(columns) == 2 else f"{row_label}.{column}"
+            if prefix:
+                name = f"{prefix}.{name}"
+            items.append((name, "" if value is None else str(value)))
+    return items
+
+
+def _split_entries(line: str) -> List[str]:
+    """
+    「{項目: 値, 項目: 値}」形式（JSONでないもの）の行を項目ごとに分ける
+
+    波括弧を外し、括弧の外にあって直後に「項目:」が続くカンマだけで分けるため、
+    1,000千円のような値の中の桁区切りでは分けない。
+    """
+    line = line.strip()
+    if not line.startswith("{"):
+        return [line]
+    line = line[1:]
+    if line.endswith("}"):
+        line = line[:-1]
+    entries, depth, start = [], 0, 0
+    for i, char in enumerate(line):
+        if char in "([「":
+            depth += 1
+        elif char in ")]」":
+            depth = max(0, depth - 1)
+        elif char in ",，" and depth == 0 and _ENTRY_START_PATTERN.match(line, i + 1):
+            entries.append(line[start:i])
+            start = i + 1
+    entries.append(line[start:])
+    return entries
+
+
+def parse_result(text: str) -> List[Dict]:
+    """
+    OCRの生出力を項目ごとに分解する
+
+    JSONが複数含まれる場合（PDFのページごとの出力など）は、出現順をページ番号とする。
+    JSONが含まれない場合は「項目: 値」形式の行（「{項目: 値, 項目: 値}」の1行形式を含む）を取り出す。
+
+    Args:
+        text (str): ocr.resultの内容
+
+    Returns:
+        List[Dict]: page, field, value, numeric_value のリスト
+    """
+    if not text:
+        return []
+    fields = []
+    objects = _find_json_objects(text)
+    if objects:
+        for page, obj in enumerate(objects, start=1):
+            for field, value in _flatten(obj):
+                if field:
+                    fields.append({"page": page, "field": field, "value": value,
+                                   "numeric_value": parse_numeric(value)})
+        return fields
+    for line in text.splitlines():
+        for entry in _split_entries(line):
+            match = _KEY_VALUE_PATTERN.match(entry)
+            if match:
+                field, value = match.group(1).strip(), match.group(2).strip().strip("\"」")
+                fields.append({"page": 1, "field": field, "value": value,
+                               "numeric_value": parse_numeric(value)})
+    return fields
+
+
+class OcrFieldStore:
+    """OCR抽出結果を項目単位で保存・検索するクラス"""
+    def __init__(self, db_path: str = "db/qa.db"):
+        self.db_path = db_path
+        self._init_db()
+
+    def _init_db(self):
+        """ocr_fieldsテーブルの作成（新規作成時は既存の結果を取り込む）"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='ocr_fields'")
+            created = cursor.fetchone() is None
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS ocr_fields (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ocr_id INTEGER NOT NULL,
+                    page INTEGER NOT NULL DEFAULT 1,
+                    field TEXT NOT NULL,
+                    value TEXT,
+                    numeric_value REAL,
+                    model TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ocr_fields_field ON ocr_fields(field, numeric_value)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ocr_fields_ocr_id ON ocr_fields(ocr_id)")
+            conn.commit()
+        if created:
+            self.rebuild()
+
+    def save_result(self, ocr_id: int, result: str, model: Optional[str] = None,
+                    conn: Optional[sqlite3.Connection] = None) -> int:
+        """
+        OCR結果を解析してocr_fieldsに保存する（同じocr_idの既存データは置き換え）
+
+        Args:
+            ocr_id (int): ocrテーブルのID
+            result (str): OCRの生出力
+            model (str): 抽出に使用したモデル名
+            conn (sqlite3.Connection): 呼び出し元のトランザクションで保存する場合の接続
+
+        Returns:
+            int: 保存した項目数
+        """
+        fields = parse_result(result)
+        own_conn = conn is None
+        if own_conn:
+            conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute("DELETE FROM ocr_fields WHERE ocr_id = ?", (ocr_id,))
+            conn.executemany("""
+                INSERT INTO ocr_fields (ocr_id, page, field, value, numeric_value, model)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [(ocr_id, f["page"], f["field"], f["value"], f["numeric_value"], model) for f in fields])
+            if own_conn:
+                conn.commit()
+        finally:
+            if own_conn:
+                conn.close()
+        return len(fields)
+
+    def rebuild(self):
+        """ocrテーブルの全結果からocr_fieldsを作り直す"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='ocr'")
+            if not cursor.fetchone():
+                return
+            rows = cursor.execute("SELECT id, result FROM ocr WHERE result IS NOT NULL AND result != ''").fetchall()
+            for ocr_id, result in rows:
+                self.save_result(ocr_id, result, conn=conn)
+            conn.commit()
+
+    def query(self, field: str, label: Optional[str] = None, model: Optional[str] = None,
+              prefix: bool = False) -> List[Dict]:
+        """
+        項目名で抽出値を検索する（例: label=不動産 の全文書の「売上高」）
+
+        Args:
+            field (str): 項目名
+            label (str): ocr.label（業種）で絞り込む場合に指定
+            model (str): 抽出モデルで絞り込む場合に指定
+            prefix (bool): Trueの場合は項目名の前方一致（「売上高.当期」なども対象）
+
+        Returns:
+            List[Dict]: ocr_id, filename, label, page, field, value, numeric_value, model のリスト
+        """
+        conditions = ["f.field LIKE ? ESCAPE '\\'" if prefix else "f.field = ?"]
+        params = [field.replace("%", "\\%").replace("_", "\\_") + "%" if prefix else field]
+        if label:
+            conditions.append("o.label = ?")
+            params.append(label)
+        if model:
+            conditions.append("f.model = ?")
+            params.append(model)
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute(f"""
+                SELECT f.ocr_id, o.filename, o.label, f.page, f.field, f.value, f.numeric_value, f.model
+                FROM ocr_fields f
+                JOIN ocr o ON o.id = f.ocr_id
+                WHERE {" AND ".join(conditions)}
+                ORDER BY f.ocr_id, f.page
+            """, params).fetchall()
+        columns = ["ocr_id", "filename", "label", "page", "field", "value", "numeric_value", "model"]
+        return [dict(zip(columns, row)) for row in rows]
+
+    def list_labels(self) -> List[str]:
+        """ocrテーブルに登録されている業種（label）の一覧"""
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT label FROM ocr WHERE label IS NOT NULL AND label != '' ORDER BY label"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def list_fields(self, label: Optional[str] = None) -> List[str]:
+        """保存されている項目名の一覧"""
+        with sqlite3.connect(self.db_path) as conn:
+            if label:
+                rows = conn.execute("""
+                    SELECT DISTINCT f.field FROM ocr_fields f JOIN ocr o ON o.id = f.ocr_id
+                    WHERE o.label = ? ORDER BY f.field
+                """, (label,)).fetchall()
+            else:
+                rows = conn.execute("SELECT DISTINCT field FROM ocr_fields ORDER BY field").fetchall()
+        return [row[0] for row in rows]
+
+
+# 解析・数値化の確認用の例（python -m modules.ocr_fields で確認する）
+# (OCRの生出力, [(項目名, 値, 数値), ...])
+_NORMALIZATION_CASES = [
+    ('結果は以下です。\n```json\n{"売上高": "1,000千円", "営業利益": "△200"}\n```',
+     [("売上高", "1,000千円", 1_000_000.0), ("営業利益", "△200", -200.0)]),
+    ('{"columns": ["項目", "金額"], "data": [["現金", "(50)"]]}',
+     [("現金", "(50)", -50.0)]),
+    ("売上高: １２３百万円\n「代表者」：山田太郎",
+     [("売上高", "１２３百万円", 123_000_000.0), ("代表者", "山田太郎", None)]),
+    ("{売上高: 1,000千円, 営業利益: 200}",
+     [("売上高", "1,000千円", 1_000_000.0), ("営業利益", "200", 200.0)]),
+]
+
+
+if __name__ == "__main__":
+    for text, expected in _NORMALIZATION_CASES:
+        actual = [(f["field"], f["value"], f["numeric_value"]) for f in parse_result(text)]
+        assert actual == expected, f"{text!r}: {actual} != {expected}"
+    print(f"{len(_NORMALIZATION_CASES)}件の例を確認しました")
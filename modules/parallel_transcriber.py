@@ -0,0 +1,184 @@
+"""
+長時間録音の並列文字起こしモジュール
+
+音声を無音の位置で区間に分割し、CPUコア数に合わせたプロセスプールで
+区間ごとに文字起こしを行う。結果は元の音声での絶対時刻に直して結合し、
+強制分割した区間の重なり部分の重複を取り除く。
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from modules import lazy_imports
+from modules.speech_to_text import get_engine
+from modules.vad import split_on_silence, SAMPLE_RATE, MAX_SEGMENT_SECONDS
+from modules.wav_io import read_wav_16k
+
+# ワーカープロセス内で読み込んだエンジンとモデル
+_worker_engine = None
+_worker_model = None
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _init_worker(model_size: str, engine_name: str, compute_type: str):
+    """ワーカープロセスの初期化（モデルの読み込みとスレッド数の設定）"""
+    global _worker_engine, _worker_model
+    _worker_engine = get_engine(engine_name, compute_type)
+    # プロセス数で並列化するため、各プロセス内のスレッドは1つにする
+    _worker_model = _worker_engine.load(model_size, threads=1)
+
+
+def _transcribe_segment(audio: np.ndarray, language: str) -> Dict:
+    """ワーカープロセスで1区間を文字起こしする"""
+    result = _worker_engine.transcribe(_worker_model, audio, language=language)
+    return {"text": result["text"], "segments": result["segments"]}
+
+
+def default_workers() -> int:
+    """ワーカー数（CPUコア数、ただしサーバーの応答用に1コア残す）"""
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+def get_pool(model_size: str = "base", workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """モデルサイズごとのプロセスプールを取得する（プロセス内で使い回す）"""
+    workers = workers or default_workers()
+    # ワーカーではsecretsを読めないため、親プロセスで決めたエンジンを渡す
+    engine = get_engine()
+    compute_type = getattr(engine, "compute_type", None)
+    key = (model_size, workers, engine.name, compute_type)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            # Streamlitサーバーはスレッドを使うため、forkではなくspawnで起動する
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(model_size, engine.name, compute_type)
+            )
+            _pools[key] = pool
+        return pool
+
+
+def discard_pool(pool: ProcessPoolExecutor):
+    """
+    ワーカーが異常終了した（BrokenProcessPool）プールを破棄する
+
+    次のget_poolで新しいプールを作るため、サーバーを再起動しなくても文字起こしを続けられる。
+    """
+    with _pools_lock:
+        for key in [k for k, v in _pools.items() if v is pool]:
+            del _pools[key]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def load_audio(audio) -> np.ndarray:
+    """音声ファイルのパス、または配列を16kHzのfloat32配列にする"""
+    if isinstance(audio, np.ndarray):
+        return audio.astype(np.float32, copy=False)
+    data = read_wav_16k(audio)
+    if data is not None:
+        return data
+    return lazy_imports.whisper().load_audio(audio)
+
+
+def _dedupe_text(previous: str, current: str, min_overlap: int = 4) -> str:
+    """前の区間の末尾と重なる、現在の区間の先頭部分を取り除く"""
+    previous, current = previous.strip(), current.strip()
+    for size in range(min(len(previous), len(current)), min_overlap - 1, -1):
+        if previous.endswith(current[:size]):
+            return current[size:].strip()
+    return current
+
+
+def stitch_results(results: List[Dict], bounds: List[tuple], sample_rate: int = SAMPLE_RATE) -> Dict:
+    """
+    区間ごとの結果を絶対時刻に直して結合する
+
+    Args:
+        results (List[Dict]): 区間ごとの文字起こし結果（区間の先頭を0秒とする時刻）
+        bounds (List[tuple]): 区間の (開始サンプル, 終了サンプル)
+
+    Returns:
+        Dict: text, segments（whisperのtranscribeと同じ形式）
+    """
+    segments = []
+    for i, (result, (start, end)) in enumerate(zip(results, bounds)):
+        offset = start / sample_rate
+        # 重なりがある場合は、重なりの中央より前を前の区間、後を次の区間の担当とする
+        lower = upper = None
+        if i > 0 and start < bounds[i - 1][1]:
+            lower = (start + bounds[i - 1][1]) / 2 / sample_rate
+        if i + 1 < len(bounds) and bounds[i + 1][0] < end:
+            upper = (bounds[i + 1][0] + end) / 2 / sample_rate
+        for seg in result["segments"]:
+            seg_start, seg_end = seg["start"] + offset, seg["end"] + offset
+            midpoint = (seg_start + seg_end) / 2
+            if (lower is not None and midpoint < lower) or (upper is not None and midpoint >= upper):
+                continue
+            text = seg["text"].strip()
+            if lower is not None and segments and seg_start < lower + 1.0:
+                text = _dedupe_text(segments[-1]["text"], text)
+            if not text:
+                continue
+            segments.append({"id": len(segments), "start": round(seg_start, 2), "end": round(seg_end, 2), "text": text})
+    return {"text": "".join(s["text"] for s in segments), "segments": segments}
+
+
+def transcribe_parallel(audio, model_size: str = "base", language: str = "ja",
+                        workers: Optional[int] = None,
+                        progress_callback: Optional[Callable[[int, int], None]] = None) -> Dict:
+    """
+    長い音声を区間に分割し、プロセスプールで並列に文字起こしする
+
+    Args:
+        audio: 音声ファイルのパス、または16kHzのfloat32配列
+        model_size (str): Whisperのモデルサイズ
+        language (str): 言語
+        workers (int): ワーカー数（省略時はCPUコア数-1）
+        progress_callback (Callable): 区間が完了するたびに (完了数, 全体数) で呼ばれる
+
+    Returns:
+        Dict: text, segments（whisperのtranscribeと同じ形式、時刻は元の音声での秒数）
+    """
+    data = load_audio(audio)
+    bounds = split_on_silence(data)
+    if not bounds:
+        return {"text": "", "segments": []}
+
+    # 1区間で収まる短い音声は、プロセス間のやり取りをせず共有モデルで処理する
+    if len(bounds) == 1 and len(data) <= MAX_SEGMENT_SECONDS * SAMPLE_RATE:
+        from modules.whisper_manager import get_manager
+        result = get_manager().transcribe(data, size=model_size, language=language)
+        if progress_callback:
+            progress_callback(1, 1)
+        return {"text": result["text"], "segments": result["segments"]}
+
+    results = [None] * len(bounds)
+    done = 0
+    # ワーカーが異常終了（メモリ不足など）した場合は、プールを作り直して残りの区間を1回だけ再実行する
+    for attempt in range(2):
+        pool = get_pool(model_size, workers)
+        try:
+            futures = {
+                pool.submit(_transcribe_segment, data[start:end], language): i
+                for i, (start, end) in enumerate(bounds) if results[i] is None
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                done += 1
+                if progress_callback:
+                    progress_callback(done, len(bounds))
+            break
+        except BrokenProcessPool:
+            discard_pool(pool)
+            if attempt == 1:
+                raise
+    return stitch_results(results, bounds)
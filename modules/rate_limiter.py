@@ -0,0 +1,329 @@
+"""
+API呼び出しのレート制御モジュール
+
+プロバイダ（anthropic / openai / gemini）ごとに、1分あたりのリクエスト数（RPM）と
+トークン数（TPM）をトークンバケットで管理する。バケットの状態はSQLiteに保存するため、
+同一プロセス内の全Streamlitセッションだけでなく、複数プロセス間でも上限を共有できる。
+
+待機中の呼び出しは優先度付きのキューに並び、対話操作（PRIORITY_INTERACTIVE）が
+一括処理（PRIORITY_BATCH）より先に実行される。
+"""
+import heapq
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# プロバイダごとの既定の上限（secrets.tomlの[rate_limits]で上書き可能）
+DEFAULT_LIMITS = {
+    "anthropic": {"rpm": 50, "tpm": 40000},
+    "openai": {"rpm": 500, "tpm": 30000},
+    "gemini": {"rpm": 15, "tpm": 1000000},
+}
+
+# 優先度（小さいほど先に実行）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+# SDKクライアントの再試行回数（429の待機・再試行はRateGovernorだけが行い、
+# SDKが裏で再送して他の呼び出しへの待機の指示が遅れないようにする）
+SDK_MAX_RETRIES = 0
+
+# 画像1枚あたりのトークン数の目安
+IMAGE_TOKEN_ESTIMATE = 1600
+
+DEFAULT_DB_PATH = "db/rate_limit.db"
+
+
+def estimate_tokens(text: str) -> int:
+    """テキストのトークン数を概算する（日本語は1文字≒1トークン、英数字は4文字≒1トークン）"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+def _is_rate_limit_error(e: Exception) -> bool:
+    """429（レート制限）エラーかどうかを判定"""
+    status = getattr(e, "status_code", None) or getattr(e, "code", None)
+    return status == 429 or "429" in type(e).__name__ or "RateLimit" in type(e).__name__
+
+
+def _retry_after_seconds(e: Exception, default: float) -> float:
+    """エラーレスポンスのretry-afterヘッダから待機秒数を取得"""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", default))
+    except (TypeError, ValueError):
+        return default
+
+
+class MemoryBucketStore:
+    """プロセス内のみで共有するトークンバケット"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def try_consume(self, provider: str, limits: Dict, tokens: int) -> float:
+        """
+        バケットからリクエスト1件分とトークンを消費する
+
+        Returns:
+            float: 消費できた場合は0、できない場合は待機すべき秒数
+        """
+        with self._lock:
+            state = self._buckets.get(provider)
+            state, wait = _consume(state, limits, tokens, time.time())
+            self._buckets[provider] = state
+            return wait
+
+    def penalize(self, provider: str, seconds: float):
+        """429を受けたプロバイダへの送信を一定時間止める"""
+        with self._lock:
+            state = self._buckets.get(provider)
+            if state:
+                state["blocked_until"] = max(state["blocked_until"], time.time() + seconds)
+
+
+class SQLiteBucketStore:
+    """SQLiteに状態を保存し、複数プロセスで共有するトークンバケット"""
+    def __init__(self, db_path: str = DEFAULT_DB_PATH):
+        self.db_path = db_path
+        dir_path = os.path.dirname(db_path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    provider TEXT PRIMARY KEY,
+                    requests REAL NOT NULL,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    blocked_until REAL NOT NULL DEFAULT 0
+                )
+            """)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=Noneで明示的にBEGIN IMMEDIATEを発行する
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def try_consume(self, provider: str, limits: Dict, tokens: int) -> float:
+        """
+        バケットからリクエスト1件分とトークンを消費する
+
+        Returns:
+            float: 消費できた場合は0、できない場合は待機すべき秒数
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT requests, tokens, updated_at, blocked_until FROM rate_buckets WHERE provider = ?",
+                (provider,)
+            ).fetchone()
+            state = None
+            if row:
+                state = {"requests": row[0], "tokens": row[1], "updated_at": row[2], "blocked_until": row[3]}
+            state, wait = _consume(state, limits, tokens, time.time())
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_buckets (provider, requests, tokens, updated_at, blocked_until) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (provider, state["requests"], state["tokens"], state["updated_at"], state["blocked_until"])
+            )
+            conn.execute("COMMIT")
+            return wait
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def penalize(self, provider: str, seconds: float):
+        """429を受けたプロバイダへの送信を一定時間止める"""
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE rate_buckets SET blocked_until = MAX(blocked_until, ?) WHERE provider = ?",
+                (time.time() + seconds, provider)
+            )
+        finally:
+            conn.close()
+
+
+def _consume(state: Optional[Dict], limits: Dict, tokens: int, now: float):
+    """トークンバケットの補充と消費を行い、(新しい状態, 待機秒数) を返す"""
+    rpm = float(limits["rpm"])
+    tpm = float(limits["tpm"])
+    if state is None:
+        state = {"requests": rpm, "tokens": tpm, "updated_at": now, "blocked_until": 0.0}
+    elapsed = max(0.0, now - state["updated_at"])
+    state["requests"] = min(rpm, state["requests"] + elapsed * rpm / 60.0)
+    state["tokens"] = min(tpm, state["tokens"] + elapsed * tpm / 60.0)
+    state["updated_at"] = now
+
+    if state["blocked_until"] > now:
+        return state, state["blocked_until"] - now
+
+    # バケット容量を超える大きな要求は、満タンになった時点で通す
+    needed = min(float(tokens), tpm)
+    if state["requests"] >= 1.0 and state["tokens"] >= needed:
+        state["requests"] -= 1.0
+        state["tokens"] -= needed
+        return state, 0.0
+
+    wait_requests = max(0.0, (1.0 - state["requests"]) * 60.0 / rpm)
+    wait_tokens = max(0.0, (needed - state["tokens"]) * 60.0 / tpm)
+    return state, max(wait_requests, wait_tokens, 0.01)
+
+
+class RateGovernor:
+    """プロバイダごとのレート制御と優先度付き待ち行列"""
+    def __init__(self, store=None, limits: Optional[Dict] = None):
+        self.store = store or MemoryBucketStore()
+        self.limits = {k: dict(v) for k, v in DEFAULT_LIMITS.items()}
+        for provider, values in (limits or {}).items():
+            self.limits.setdefault(provider, {}).update(values)
+        self._cond = threading.Condition()
+        self._queues = {}
+        # バケットの読み書き（SQLiteのロック待ちを含む）はこのロックで行い、待ち行列の操作を止めない
+        self._store_locks = {}
+        self._seq = itertools.count()
+
+    def queue_length(self, provider: str) -> int:
+        """待ち行列に並んでいる呼び出し数"""
+        with self._cond:
+            return len(self._queues.get(provider, []))
+
+    def _position(self, provider: str, entry) -> int:
+        """待ち行列内の順番（0始まり）"""
+        return sum(1 for other in self._queues[provider] if other < entry)
+
+    def _remove(self, provider: str, entry):
+        queue = self._queues[provider]
+        if entry in queue:
+            queue.remove(entry)
+            heapq.heapify(queue)
+        self._cond.notify_all()
+
+    @contextmanager
+    def acquire(self, provider: str, tokens: int = 1000, priority: int = PRIORITY_INTERACTIVE,
+                on_wait: Optional[Callable[[int, float], None]] = None):
+        """
+        APIを呼び出す権利を取得する
+
+        Args:
+            provider (str): プロバイダ名（anthropic / openai / gemini）
+            tokens (int): 入力と出力を合わせた想定トークン数
+            priority (int): 優先度（小さいほど優先）
+            on_wait (Callable): 待機中に (順番, 想定待ち秒数) で呼ばれるコールバック。
+                待機した後に権利を取得した時点で (0, 0.0) で呼ばれる（表示を消すため）
+        """
+        limits = self.limits.get(provider)
+        if limits is None:
+            yield
+            return
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._queues.setdefault(provider, []), entry)
+            store_lock = self._store_locks.setdefault(provider, threading.Lock())
+        waited = False
+        try:
+            while True:
+                with self._cond:
+                    position = self._position(provider, entry)
+                wait = None
+                if position == 0:
+                    with store_lock:
+                        wait = self.store.try_consume(provider, limits, tokens)
+                    if wait == 0:
+                        with self._cond:
+                            self._remove(provider, entry)
+                        break
+                if on_wait:
+                    waited = True
+                    on_wait(position + 1, wait if wait is not None else 0.0)
+                with self._cond:
+                    self._cond.wait(timeout=min(wait, 1.0) if wait else 1.0)
+        except BaseException:
+            with self._cond:
+                self._remove(provider, entry)
+            raise
+        if waited:
+            on_wait(0, 0.0)
+        yield
+
+    def report_rate_limited(self, provider: str, retry_after: float = 10.0):
+        """429を受けた場合にバケットを止め、他の呼び出しも待機させる"""
+        logger.warning(f"{provider} からレート制限を受けました。{retry_after:.1f}秒待機します")
+        self.store.penalize(provider, retry_after)
+
+    def call(self, provider: str, fn: Callable, tokens: int = 1000,
+             priority: int = PRIORITY_INTERACTIVE,
+             on_wait: Optional[Callable[[int, float], None]] = None, max_retries: int = 3):
+        """
+        レート制御の下でAPI呼び出しを実行する（429の場合は待機して再試行）
+
+        Args:
+            provider (str): プロバイダ名
+            fn (Callable): 引数なしで呼び出すAPI呼び出し関数
+            tokens (int): 想定トークン数
+            priority (int): 優先度
+            on_wait (Callable): 待機中のコールバック
+            max_retries (int): 429時の最大再試行回数
+
+        Returns:
+            fnの戻り値
+        """
+        attempt = 0
+        while True:
+            with self.acquire(provider, tokens, priority, on_wait):
+                try:
+                    return fn()
+                except Exception as e:
+                    if not _is_rate_limit_error(e) or attempt >= max_retries:
+                        raise
+                    self.report_rate_limited(provider, _retry_after_seconds(e, 2.0 ** (attempt + 2)))
+            attempt += 1
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_governor() -> RateGovernor:
+    """プロセス共通のRateGovernorを取得する"""
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            limits = {}
+            try:
+                import streamlit as st
+                limits = {k: dict(v) for k, v in st.secrets.get("rate_limits", {}).items()}
+            except Exception:
+                pass
+            if os.getenv("RATE_LIMIT_BACKEND", "sqlite") == "memory":
+                store = MemoryBucketStore()
+            else:
+                store = SQLiteBucketStore(os.getenv("RATE_LIMIT_DB", DEFAULT_DB_PATH))
+            _governor = RateGovernor(store=store, limits=limits)
+        return _governor
+
+
+def streamlit_wait_notifier(placeholder) -> Callable[[int, float], None]:
+    """待ち行列の順番をStreamlitのプレースホルダーに表示するコールバックを作成（取得後は表示を消す）"""
+    def _notify(position: int, wait: float):
+        if position == 0:
+            placeholder.empty()
+            return
+        placeholder.info(f"API呼び出しの順番待ち中です（{position}番目、約{wait:.0f}秒）")
+    return _notify
@@ -1,86 +1,180 @@
 import streamlit as st
-from pyannote.audio import Pipeline
-import torch
 import os
-from typing import Dict, List, Optional
+import threading
+from typing import Dict, List, Optional, Tuple
 import logging
-import torchaudio
+import numpy as np
 import warnings
+from modules import lazy_imports
+from modules.parallel_transcriber import load_audio
+from modules.vad import SAMPLE_RATE
 
 # 警告を無視する設定
 warnings.filterwarnings("ignore", category=UserWarning, module="torchaudio")
 warnings.filterwarnings("ignore", category=UserWarning, module="streamlit.watcher.local_sources_watcher")
 
-class SpeakerDiarization:
-    """話者分離クラス"""
-    def __init__(self):
-        self.pipeline = self._init_pipeline()
-    
-    def _init_pipeline(self) -> Pipeline:
-        """パイプラインの初期化"""
+logger = logging.getLogger(__name__)
+
+PIPELINE_NAME = "pyannote/speaker-diarization-3.1"
+
+# プロセス内で共有するパイプライン（読み込みに数十秒かかるため1度だけ読み込む）
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def _token_error():
+    st.error("Hugging Faceトークンが設定されていません。.streamlit/secrets.tomlファイルに以下のように設定してください：\n"
+            "```toml\n"
+            "huggingface_token = \"your_token_here\"\n"
+            "```")
+
+
+def _configure_threads():
+    """CPUで推論する場合のスレッド数を設定する（secretsのdiarization_threadsで変更可能）"""
+    try:
+        threads = int(st.secrets.get("diarization_threads", 0))
+    except Exception:
+        threads = 0
+    threads = threads or os.cpu_count() or 1
+    lazy_imports.torch().set_num_threads(threads)
+    logger.info(f"話者分離のスレッド数: {threads}")
+
+
+def get_pipeline():
+    """プロセス共通の話者分離パイプラインを取得する（失敗した場合はNone）"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is not None:
+            return _pipeline
         try:
             # Hugging Faceトークンの確認
             token = st.secrets["huggingface_token"]
             if not token:
-                st.error("Hugging Faceトークンが設定されていません。.streamlit/secrets.tomlファイルに以下のように設定してください：\n"
-                        "```toml\n"
-                        "huggingface_token = \"your_token_here\"\n"
-                        "```")
+                _token_error()
                 return None
-            
+
             # GPUが利用可能な場合は使用
+            torch = lazy_imports.torch()
             device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-            
+            if device.type == "cpu":
+                _configure_threads()
+
             # パイプラインの初期化
             try:
-                pipeline = Pipeline.from_pretrained(
-                    "pyannote/speaker-diarization-3.1",
+                _pipeline = lazy_imports.pyannote_pipeline().from_pretrained(
+                    PIPELINE_NAME,
                     use_auth_token=token
                 ).to(device)
-                return pipeline
+                return _pipeline
             except Exception as e:
                 st.error(f"パイプラインの初期化に失敗しました。以下の手順を確認してください：\n"
                         "1. Hugging Faceのアカウントでログインしているか確認\n"
-                        "2. https://hf.co/pyannote/speaker-diarization-3.1 にアクセスし、使用条件に同意\n"
+                        f"2. https://hf.co/{PIPELINE_NAME} にアクセスし、使用条件に同意\n"
                         "3. トークンが正しく設定されているか確認\n"
                         f"エラー詳細: {str(e)}")
                 return None
-            
+
         except KeyError:
-            st.error("Hugging Faceトークンが設定されていません。.streamlit/secrets.tomlファイルに以下のように設定してください：\n"
-                    "```toml\n"
-                    "huggingface_token = \"your_token_here\"\n"
-                    "```")
+            _token_error()
             return None
         except Exception as e:
             st.error(f"パイプラインの初期化中にエラーが発生しました: {str(e)}")
             return None
-    
-    def separate_speakers(self, text: str) -> str:
-        """テキストから話者を分離"""
+
+
+def assign_speakers(segments: List[Dict], turns: List[Tuple[float, float, str]]) -> List[Dict]:
+    """
+    文字起こしの区間に、時間が最も重なる話者を割り当てる
+
+    重なる話者がいない区間は、時間が最も近い話者とする。
+    話者名は登場順に「話者A」「話者B」…とする。
+
+    Args:
+        segments (List[Dict]): start, end, text を持つ文字起こしの区間
+        turns (List[Tuple]): 話者分離の (開始秒, 終了秒, 話者ラベル)
+
+    Returns:
+        List[Dict]: start, end, speaker, text のリスト
+    """
+    names = {}
+    labelled = []
+    for seg in segments:
+        speaker = None
+        if turns:
+            overlaps = [
+                (min(seg["end"], end) - max(seg["start"], start), label)
+                for start, end, label in turns
+            ]
+            best, label = max(overlaps)
+            if best <= 0:
+                # 重なりがない場合は区間の端からの距離が最も近い話者
+                label = min(turns, key=lambda t: max(t[0] - seg["end"], seg["start"] - t[1]))[2]
+            if label not in names:
+                names[label] = f"話者{chr(ord('A') + len(names))}" if len(names) < 26 else f"話者{len(names) + 1}"
+            speaker = names[label]
+        labelled.append({
+            "start": seg["start"],
+            "end": seg["end"],
+            "speaker": speaker or "不明",
+            "text": seg["text"].strip(),
+        })
+    return labelled
+
+
+def to_conversation(segments: List[Dict]) -> str:
+    """話者付きの区間を「話者名: 発言内容」の形式にする（同じ話者の連続した区間はまとめる）"""
+    lines = []
+    for seg in segments:
+        if not seg["text"]:
+            continue
+        if lines and lines[-1][0] == seg["speaker"]:
+            lines[-1][1].append(seg["text"])
+        else:
+            lines.append((seg["speaker"], [seg["text"]]))
+    return "\n".join(f"{speaker}: {''.join(texts)}" for speaker, texts in lines)
+
+
+class SpeakerDiarization:
+    """話者分離クラス"""
+    def __init__(self):
+        self.pipeline = get_pipeline()
+
+    def diarize(self, audio) -> List[Tuple[float, float, str]]:
+        """
+        音声から話者の交代を検出する
+
+        Args:
+            audio: 音声ファイルのパス、または16kHzのfloat32配列
+
+        Returns:
+            List[Tuple[float, float, str]]: (開始秒, 終了秒, 話者ラベル) のリスト
+        """
+        torch = lazy_imports.torch()
+        # 読み込み済みの波形を渡し、パイプライン側での再デコードを省略する
+        waveform = torch.from_numpy(np.ascontiguousarray(load_audio(audio))).unsqueeze(0)
+        with torch.inference_mode():
+            annotation = self.pipeline({"waveform": waveform, "sample_rate": SAMPLE_RATE})
+        return [
+            (turn.start, turn.end, label)
+            for turn, _, label in annotation.itertracks(yield_label=True)
+        ]
+
+    def separate_speakers(self, audio, segments: List[Dict]) -> Optional[List[Dict]]:
+        """
+        音声を話者分離し、文字起こしの区間に話者を割り当てる
+
+        Args:
+            audio: 音声ファイルのパス、または16kHzのfloat32配列
+            segments (List[Dict]): Whisperの区間（start, end, text）
+
+        Returns:
+            Optional[List[Dict]]: start, end, speaker, text のリスト（失敗した場合はNone）
+        """
         try:
             if not self.pipeline:
-                return "パイプラインが初期化されていません。"
-            
-            # テキストを話者ごとに分離
-            # ここでは簡単な例として、行ごとに話者を分離
-            lines = text.split('\n')
-            result = []
-            current_speaker = None
-            
-            for line in lines:
-                if line.strip():
-                    if ':' in line:
-                        speaker, content = line.split(':', 1)
-                        current_speaker = speaker.strip()
-                        result.append(f"{current_speaker}: {content.strip()}")
-                    elif current_speaker:
-                        result.append(f"{current_speaker}: {line.strip()}")
-                    else:
-                        result.append(f"Unknown: {line.strip()}")
-            
-            return '\n'.join(result)
-            
+                st.error("パイプラインが初期化されていません。")
+                return None
+            return assign_speakers(segments, self.diarize(audio))
         except Exception as e:
             st.error(f"話者分離中にエラーが発生しました: {str(e)}")
-            return None 
\ No newline at end of file
+            return None
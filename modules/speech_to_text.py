@@ -1,7 +1,117 @@
-import whisper
+"""
+文字起こしエンジンの切り替え
+
+whisper（openai-whisper, fp32）と faster_whisper（CTranslate2, int8量子化）を
+同じインターフェースで扱う。どちらのエンジンも結果は text と segments
+（start, end, text）の形式にそろえるため、呼び出し側はエンジンを意識しなくてよい。
+
+エンジンは secrets の stt_engine（または環境変数 STT_ENGINE）で選択する。
+"""
+import os
+from typing import Dict, Optional
+
 import streamlit as st
+from modules import lazy_imports
+from modules.wav_io import read_wav_16k
+
+DEFAULT_ENGINE = "whisper"
+# faster_whisperの量子化方式（CPUではint8が最も速い）
+DEFAULT_COMPUTE_TYPE = "int8"
+
+
+class WhisperEngine:
+    """openai-whisperによる文字起こし"""
+    name = "whisper"
+
+    def load(self, size: str, threads: int = 0):
+        if threads:
+            lazy_imports.torch().set_num_threads(threads)
+        return lazy_imports.whisper().load_model(size)
+
+    def transcribe(self, model, audio, **kwargs) -> Dict:
+        kwargs.setdefault("fp16", False)
+        result = model.transcribe(audio, **kwargs)
+        return {
+            "text": result["text"],
+            "segments": [
+                {"id": i, "start": s["start"], "end": s["end"], "text": s["text"]}
+                for i, s in enumerate(result["segments"])
+            ],
+            "language": result.get("language"),
+        }
+
+
+class FasterWhisperEngine:
+    """faster-whisper（CTranslate2）による量子化モデルでの文字起こし"""
+    name = "faster_whisper"
+
+    def __init__(self, compute_type: str = DEFAULT_COMPUTE_TYPE):
+        self.compute_type = compute_type
+
+    def load(self, size: str, threads: int = 0):
+        return lazy_imports.faster_whisper().WhisperModel(size, device="cpu", compute_type=self.compute_type, cpu_threads=threads)
+
+    def transcribe(self, model, audio, **kwargs) -> Dict:
+        # whisper固有の引数は渡さない
+        kwargs.pop("fp16", None)
+        kwargs.pop("verbose", None)
+        segments, info = model.transcribe(audio, **kwargs)
+        # segmentsは逐次デコードされるジェネレータのため、ここで最後まで読む
+        segments = [
+            {"id": i, "start": s.start, "end": s.end, "text": s.text}
+            for i, s in enumerate(segments)
+        ]
+        return {
+            "text": "".join(s["text"] for s in segments),
+            "segments": segments,
+            "language": info.language,
+        }
+
+
+ENGINES = {
+    WhisperEngine.name: WhisperEngine,
+    FasterWhisperEngine.name: FasterWhisperEngine,
+}
+
+
+def engine_settings() -> Dict:
+    """設定されたエンジン名と量子化方式"""
+    name, compute_type = None, None
+    try:
+        name = st.secrets.get("stt_engine")
+        compute_type = st.secrets.get("stt_compute_type")
+    except Exception:
+        pass
+    return {
+        "engine": name or os.getenv("STT_ENGINE") or DEFAULT_ENGINE,
+        "compute_type": compute_type or os.getenv("STT_COMPUTE_TYPE") or DEFAULT_COMPUTE_TYPE,
+    }
+
+
+def get_engine(name: Optional[str] = None, compute_type: Optional[str] = None):
+    """
+    文字起こしエンジンを取得する
+
+    Args:
+        name (str): エンジン名（whisper / faster_whisper、省略時は設定値）
+        compute_type (str): faster_whisperの量子化方式（省略時は設定値）
+    """
+    settings = engine_settings()
+    name = name or settings["engine"]
+    if name not in ENGINES:
+        raise ValueError(f"未対応の文字起こしエンジンです: {name}（{', '.join(ENGINES)} から選択）")
+    if name == FasterWhisperEngine.name:
+        return FasterWhisperEngine(compute_type or settings["compute_type"])
+    return ENGINES[name]()
+
+
+def transcribe(audio_path, model_size="base"):
+    from modules.whisper_manager import get_manager
+    from modules.transcription_cache import cached_transcribe
+
+    def run():
+        # 録音時に16kHz・モノラルで保存したWAVはffmpegでのデコード・リサンプリングを省略
+        audio = read_wav_16k(audio_path)
+        return get_manager().transcribe(audio if audio is not None else audio_path, size=model_size, language="ja")
 
-def transcribe(audio_path):
-    model = whisper.load_model("base")
-    result = model.transcribe(audio_path, language="ja")
-    return result["text"] 
\ No newline at end of file
+    return cached_transcribe(audio_path, run, model_size=model_size, language="ja")["text"]
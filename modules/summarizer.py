@@ -1,57 +1,51 @@
 import streamlit as st
-from openai import OpenAI
-import tiktoken
+import hashlib
+import json
+import math
+from modules import chunker
+from modules import llm_client
+from modules import model_router
+from modules.case_manager import QAManager
+from modules.speaker_diarization import to_conversation
 import re
 
+# 1チャンクあたりの最大トークン数
+CHUNK_TOKENS = 3000
+# 会話形式への整形を行う場合の1チャンクあたりの最大トークン数（整形後も出力の上限に収まる大きさ）
+FORMAT_CHUNK_TOKENS = 2000
+# 整形の出力の上限トークン数
+FORMAT_MAX_TOKENS = 3000
+# 話者の続きを推定するため、次のチャンクの整形に渡す直前のチャンクの末尾の文字数
+FORMAT_CONTEXT_CHARS = 300
+# 要約の出力の上限トークン数
+SUMMARY_MAX_TOKENS = 2000
+# 1回の統合で入力する要約の合計トークン数の上限（超える場合は段階的に統合する）
+MERGE_INPUT_TOKENS = 6000
+# 進捗の見積もりに使う、チャンク要約1件あたりの想定トークン数
+ESTIMATED_SUMMARY_TOKENS = 500
+# プロンプトを変更した場合は上げる（保存済みの途中結果を使わないようにする）
+PROMPT_VERSION = 1
+
 def count_tokens(text):
     """テキストのトークン数をカウント"""
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    return len(encoding.encode(text))
+    return chunker.count_tokens(text)
 
-def split_text(text, max_tokens=3000):
+def split_text(text, max_tokens=3000, overlap_tokens=0):
     """
     テキストを適切なサイズに分割
     
     Args:
         text (str): 分割するテキスト
         max_tokens (int): 1チャンクあたりの最大トークン数
+        overlap_tokens (int): 隣接するチャンクで重ねるトークン数
         
     Returns:
         list: 分割されたテキストのリスト
     """
-    # 文単位で分割
-    sentences = text.split('。')
-    chunks = []
-    current_chunk = []
-    current_tokens = 0
-    
-    for sentence in sentences:
-        sentence_tokens = count_tokens(sentence)
-        if current_tokens + sentence_tokens > max_tokens and current_chunk:
-            chunks.append('。'.join(current_chunk) + '。')
-            current_chunk = []
-            current_tokens = 0
-        
-        current_chunk.append(sentence)
-        current_tokens += sentence_tokens
-    
-    if current_chunk:
-        chunks.append('。'.join(current_chunk) + '。')
-    
-    return chunks
+    # 全体を1度だけトークン化し、話者の交代や文末を優先して分割
+    return chunker.chunk_text(text, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
 
-def format_conversation(text):
-    """
-    テキストを会話形式に整形
-    
-    Args:
-        text (str): 整形するテキスト
-        
-    Returns:
-        str: 整形された会話テキスト
-    """
-    try:
-        prompt = f"""
+_FORMAT_RULES = """
         以下のテキストを自然な日本語の会話形式に整形してください。
         以下のルールに従って整形してください：
         
@@ -75,73 +69,106 @@ def format_conversation(text):
         - 不自然な改行や空白を整理
         - 句読点の使い方を統一
         - 余分な空白を削除
+        """
+
+def _clean_conversation(formatted_text):
+    """整形されたテキストをさらに整理"""
+    # 空行の整理（2行以上の空行を1行に）
+    formatted_text = re.sub(r'\n\s*\n', '\n\n', formatted_text)
+    
+    # 話者の発言形式の統一（コロンの後の空白を統一）
+    formatted_text = re.sub(r'([^:]+):\s*', r'\1: ', formatted_text)
+    
+    # 余分な空白の削除（2つ以上の空白を1つに）
+    formatted_text = re.sub(r' +', ' ', formatted_text)
+    
+    # 句読点の統一（全角に統一）
+    formatted_text = formatted_text.replace('。', '。').replace('、', '、')
+    
+    return formatted_text.strip()
+
+def _format_chunk(chunk, previous_tail=None):
+    """
+    チャンクを会話形式に整形する（エラーは呼び出し元に送出）
+    
+    previous_tailには直前のチャンクの末尾（整形前）を渡す。話者の続きを判断する手がかりとして
+    使い、出力には含めない。
+    """
+    prompt = _FORMAT_RULES
+    if previous_tail:
+        prompt += f"""
+        このテキストは長い会話の途中の部分です。以下は直前の部分の末尾です（参考のみで、出力には含めないでください）。
+        直前の部分から発言が続いている場合は同じ話者として扱い、話者の区別が前後で一貫するようにしてください。
         
+        直前の部分の末尾:
+        {previous_tail}
+        """
+    prompt += f"""
         テキスト:
-        {text}
+        {chunk}
         """
-        
-        client = OpenAI(api_key=st.secrets["openai_api_key"])
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "あなたは日本語の会話記録を整形する専門家です。自然な日本語表現を使用し、話者を明確に区別し、会話の流れを保ちながら、重要なポイントを強調してください。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=2000
-        )
-        
-        # 整形されたテキストをさらに整理
-        formatted_text = response.choices[0].message.content
-        
-        # 空行の整理（2行以上の空行を1行に）
-        formatted_text = re.sub(r'\n\s*\n', '\n\n', formatted_text)
-        
-        # 話者の発言形式の統一（コロンの後の空白を統一）
-        formatted_text = re.sub(r'([^:]+):\s*', r'\1: ', formatted_text)
-        
-        # 余分な空白の削除（2つ以上の空白を1つに）
-        formatted_text = re.sub(r' +', ' ', formatted_text)
-        
-        # 句読点の統一（全角に統一）
-        formatted_text = formatted_text.replace('。', '。').replace('、', '、')
-        
-        return formatted_text.strip()
-    except Exception as e:
-        st.error(f"会話整形中にエラーが発生しました: {str(e)}")
-        return text
+    formatted_text = llm_client.chat([
+        {"role": "system", "content": "あなたは日本語の会話記録を整形する専門家です。自然な日本語表現を使用し、話者を明確に区別し、会話の流れを保ちながら、重要なポイントを強調してください。"},
+        {"role": "user", "content": prompt}
+    ], task="format", temperature=0.3, max_tokens=FORMAT_MAX_TOKENS, template=f"summarizer.format/{PROMPT_VERSION}")
+    return _clean_conversation(formatted_text)
 
-def summarize_chunk(chunk):
+def format_conversation(text):
     """
-    テキストのチャンクを要約
+    テキストを会話形式に整形
     
     Args:
-        chunk (str): 要約するテキストのチャンク
+        text (str): 整形するテキスト
         
     Returns:
-        str: 要約結果
+        str: 整形された会話テキスト
     """
     try:
-        prompt = f"""
+        return _format_chunk(text)
+    except Exception as e:
+        st.error(f"会話整形中にエラーが発生しました: {str(e)}")
+        return text
+
+def _summarize_chunk(chunk):
+    """チャンクを要約する（エラーは呼び出し元に送出）"""
+    prompt = f"""
         以下のテキストを要約してください。
         重要なポイントを漏れなく抽出し、簡潔にまとめてください。
         
         テキスト:
         {chunk}
         """
+    return llm_client.chat([
+        {"role": "system", "content": "あなたはテキストを要約する専門家です。重要なポイントを漏れなく抽出し、簡潔にまとめてください。"},
+        {"role": "user", "content": prompt}
+    ], task="summarize", temperature=0.3, max_tokens=SUMMARY_MAX_TOKENS, template=f"summarizer.summary/{PROMPT_VERSION}")
+
+def _merge(summaries):
+    """複数の要約を1つに統合する（エラーは呼び出し元に送出）"""
+    prompt = f"""
+        以下の複数の要約を統合し、1つの要約にまとめてください。
+        重複を避け、重要なポイントを漏れなく含めてください。
         
-        client = OpenAI(api_key=st.secrets["openai_api_key"])
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "あなたはテキストを要約する専門家です。重要なポイントを漏れなく抽出し、簡潔にまとめてください。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=2000
-        )
+        要約:
+        {chr(10).join(summaries)}
+        """
+    return llm_client.chat([
+        {"role": "system", "content": "あなたは複数の要約を統合する専門家です。重複を避け、重要なポイントを漏れなく含めてください。"},
+        {"role": "user", "content": prompt}
+    ], task="summarize", temperature=0.3, max_tokens=SUMMARY_MAX_TOKENS, template=f"summarizer.merge/{PROMPT_VERSION}")
+
+def summarize_chunk(chunk):
+    """
+    テキストのチャンクを要約
+    
+    Args:
+        chunk (str): 要約するテキストのチャンク
         
-        return response.choices[0].message.content
+    Returns:
+        str: 要約結果
+    """
+    try:
+        return _summarize_chunk(chunk)
     except Exception as e:
         st.error(f"チャンク要約中にエラーが発生しました: {str(e)}")
         return ""
@@ -163,64 +190,261 @@ def merge_summaries(summaries):
         return summaries[0]
     
     try:
-        prompt = f"""
-        以下の複数の要約を統合し、1つの要約にまとめてください。
-        重複を避け、重要なポイントを漏れなく含めてください。
-        
-        要約:
-        {chr(10).join(summaries)}
-        """
-        
-        client = OpenAI(api_key=st.secrets["openai_api_key"])
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "あなたは複数の要約を統合する専門家です。重複を避け、重要なポイントを漏れなく含めてください。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=2000
-        )
-        
-        return response.choices[0].message.content
+        return _merge(summaries)
     except Exception as e:
         st.error(f"要約統合中にエラーが発生しました: {str(e)}")
         return chr(10).join(summaries)  # エラー時は単純に結合
 
-def summarize(text):
+def group_by_tokens(summaries, budget=MERGE_INPUT_TOKENS):
+    """
+    要約を、合計トークン数がbudget以内になるよう先頭から順にまとめる
+    
+    Returns:
+        list: 要約のリストのリスト（1件ずつにしかまとまらない場合は2件ずつ）
+    """
+    groups = []
+    current, current_tokens = [], 0
+    for summary in summaries:
+        tokens = count_tokens(summary)
+        if current and current_tokens + tokens > budget:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(summary)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    if len(groups) == len(summaries) and len(summaries) > 1:
+        # 要約が大きく統合が進まない場合も、必ず件数が減るようにする
+        groups = [summaries[i:i + 2] for i in range(0, len(summaries), 2)]
+    return groups
+
+def _merge_levels(count, budget=MERGE_INPUT_TOKENS):
+    """count件の要約を1つに統合するまでの、段階ごとの統合の呼び出し回数の見積もり"""
+    levels = []
+    while count > 1:
+        groups = min(max(1, math.ceil(count * ESTIMATED_SUMMARY_TOKENS / budget)), math.ceil(count / 2))
+        levels.append(groups)
+        count = groups
+    return levels
+
+def _estimate_merge_calls(count, budget=MERGE_INPUT_TOKENS):
+    """count件の要約を1つに統合するまでの呼び出し回数の見積もり"""
+    return sum(_merge_levels(count, budget))
+
+def estimate_summary(text, segments=None):
+    """
+    summarizeの呼び出し回数・所要時間・費用の見積もり（実行前に画面に表示する）
+    
+    途中結果や応答のキャッシュを使わない場合の値のため、再要約では実際にはこれより短くなる。
+    
+    Args:
+        text (str): 要約するテキスト
+        segments (list): 話者分離済みの区間（summarizeと同じ）
+        
+    Returns:
+        dict: model, calls, seconds, cost_usd
+    """
+    format_chunks = not (segments and any(seg.get("speaker") for seg in segments))
+    if not format_chunks:
+        text = to_conversation(segments)
+    chunk_tokens = FORMAT_CHUNK_TOKENS if format_chunks else CHUNK_TOKENS
+    tokens = count_tokens(text)
+    chunk_count = max(1, math.ceil(tokens / chunk_tokens))
+    tokens_per_chunk = min(tokens, chunk_tokens)
+    
+    # チャンクごとの処理（整形と要約）は並列に、統合は段階ごとに並列に行う
+    steps = []
+    if format_chunks:
+        steps.append(model_router.plan_tokens("format", tokens_per_chunk, FORMAT_MAX_TOKENS)[0])
+    summary_route = model_router.plan_tokens("summarize", tokens_per_chunk, SUMMARY_MAX_TOKENS)[0]
+    steps.append(summary_route)
+    waves = math.ceil(chunk_count / llm_client.concurrency())
+    seconds = waves * sum(route["seconds"] for route in steps)
+    cost = chunk_count * sum(route["cost_usd"] for route in steps)
+    calls = chunk_count * len(steps)
+    for groups in _merge_levels(chunk_count):
+        merge_input = min(MERGE_INPUT_TOKENS, math.ceil(chunk_count / groups) * ESTIMATED_SUMMARY_TOKENS)
+        merge_route = model_router.plan_tokens("summarize", merge_input, SUMMARY_MAX_TOKENS)[0]
+        seconds += math.ceil(groups / llm_client.concurrency()) * merge_route["seconds"]
+        cost += groups * merge_route["cost_usd"]
+        calls += groups
+    return {"model": summary_route["model"], "calls": calls, "seconds": seconds, "cost_usd": cost}
+
+def _part_hash(kind, texts):
+    """途中結果（整形・要約・統合）を保存するキー（処理の種類と入力のハッシュ）"""
+    payload = json.dumps([PROMPT_VERSION, kind, texts], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class _Progress:
+    """完了した呼び出し数と見積もった総数から進捗を計算する（値は減らない）"""
+    def __init__(self, callback, total):
+        self.callback = callback
+        self.done = 0
+        self.total = max(1, total)
+        self._fraction = 0.0
+
+    def set_remaining(self, remaining):
+        self.total = max(1, self.done + remaining)
+        self._report()
+
+    def advance(self, steps=1):
+        self.done += steps
+        self._report()
+
+    def _report(self):
+        self._fraction = max(self._fraction, min(1.0, self.done / self.total))
+        if self.callback:
+            self.callback(self._fraction, self.done, self.total)
+
+def map_reduce_summarize(chunks, merge_budget=MERGE_INPUT_TOKENS, progress_callback=None,
+                         format_chunks=False, parts=None):
+    """
+    チャンクを並列に要約し、合計トークン数がmerge_budgetを超える場合は段階的に統合する
+    
+    Args:
+        chunks (list): 要約するテキストのチャンク
+        merge_budget (int): 1回の統合で入力する要約の合計トークン数の上限
+        progress_callback (Callable): (進捗率, 完了数, 総数の見積もり) で呼ばれる
+        format_chunks (bool): 各チャンクを会話形式に整形してから要約する。直前のチャンクの
+            末尾を話者の手がかりとして渡すため、チャンク同士を並列に処理できる
+        parts (dict): 前回までの途中結果（入力のハッシュ → body, summary）。入力が同じチャンク・
+            統合はAPIを呼び出さずに再利用する。実行後は今回使った途中結果だけが残る
+        
+    Returns:
+        tuple: (チャンクごとの本文（整形した場合は整形後）, 統合された要約, 発生したエラーのリスト)
+    """
+    errors = []
+    parts = {} if parts is None else parts
+    used = {}
+    # 整形する場合は1チャンクにつき整形と要約の2回の呼び出し
+    steps_per_chunk = 2 if format_chunks else 1
+
+    def previous_tail(index):
+        return chunks[index - 1][-FORMAT_CONTEXT_CHARS:] if index > 0 else None
+
+    if format_chunks:
+        keys = [_part_hash("format", [previous_tail(i), chunk]) for i, chunk in enumerate(chunks)]
+    else:
+        keys = [_part_hash("summary", [chunk]) for chunk in chunks]
+    pending = [i for i, key in enumerate(keys) if key not in parts]
+    progress = _Progress(progress_callback,
+                         len(pending) * steps_per_chunk + _estimate_merge_calls(len(chunks), merge_budget))
+
+    def process(index):
+        # 整形・要約のどちらが失敗しても、他のチャンクの結果は使えるようにする
+        chunk, chunk_errors = chunks[index], []
+        if format_chunks:
+            try:
+                chunk = _format_chunk(chunk, previous_tail(index))
+            except Exception as e:
+                chunk_errors.append(e)
+        try:
+            summary = _summarize_chunk(chunk)
+        except Exception as e:
+            chunk_errors.append(e)
+            summary = ""
+        return chunk, summary, chunk_errors
+
+    # map: チャンクごとの整形・要約（レート制御の範囲で並列に実行）
+    results = dict(zip(pending, llm_client.map_parallel(
+        process, pending, on_done=lambda _: progress.advance(steps_per_chunk)
+    )))
+    bodies, summaries = [], []
+    for index, key in enumerate(keys):
+        if index in results:
+            body, summary, chunk_errors = results[index]
+            errors.extend(chunk_errors)
+            if summary and not chunk_errors:
+                used[key] = {"body": body if format_chunks else None, "summary": summary}
+        else:
+            part = parts[key]
+            body, summary = part["body"] if format_chunks else chunks[index], part["summary"]
+            used[key] = part
+        bodies.append(body)
+        if summary:
+            summaries.append(summary)
+
+    # reduce: 入力の上限に収まる単位でまとめて統合し、1つになるまで繰り返す
+    while len(summaries) > 1:
+        groups = group_by_tokens(summaries, merge_budget)
+        group_keys = [_part_hash("merge", group) if len(group) > 1 else None for group in groups]
+        merging = [i for i, key in enumerate(group_keys) if key is not None and key not in parts]
+        progress.set_remaining(len(merging) + _estimate_merge_calls(len(groups), merge_budget))
+        merged = dict(zip(merging, llm_client.map_parallel(
+            lambda i: _merge(groups[i]), merging, on_done=lambda _: progress.advance()
+        )))
+        next_summaries = []
+        for i, (group, key) in enumerate(zip(groups, group_keys)):
+            if key is None:
+                next_summaries.append(group[0])
+                continue
+            if i not in merged:
+                result = parts[key]["summary"]
+            elif isinstance(merged[i], Exception):
+                errors.append(merged[i])
+                next_summaries.append(chr(10).join(group))  # エラー時は単純に結合
+                continue
+            else:
+                result = merged[i]
+            used[key] = {"body": None, "summary": result}
+            next_summaries.append(result)
+        summaries = next_summaries
+
+    parts.clear()
+    parts.update(used)
+    progress.set_remaining(0)
+    return bodies, (summaries[0] if summaries else ""), errors
+
+def summarize(text, segments=None, case_id=None):
     """
     テキストを要約する関数
     
+    話者分離済みの区間がない場合は、テキストを先に分割し、チャンクごとに会話形式への整形と
+    要約を並列に行う（全文を1回で整形しないため、長い文字起こしでも出力が途切れない）。
+    
+    case_idを指定した場合は、チャンクごとの要約と統合結果を案件に保存し、次回は内容が
+    変わったチャンクと、その影響を受ける統合だけをAPIで処理する（録音の追加や修正後の再要約）。
+    
     Args:
         text (str): 要約するテキスト
+        segments (list): 話者分離済みの区間（speaker, text）。指定した場合は
+            話者の推定を兼ねた会話形式への整形（LLM呼び出し）を省略する
+        case_id (int): 要約の途中結果を保存・再利用する案件のID
         
     Returns:
-        str: 要約結果
+        tuple: (会話形式に整形したテキスト, 要約結果)
     """
     try:
-        # テキストを会話形式に整形
-        formatted_text = format_conversation(text)
-        
-        # テキストを分割
-        chunks = split_text(formatted_text)
-        summaries = []
+        if segments and any(seg.get("speaker") for seg in segments):
+            chunks = split_text(to_conversation(segments), max_tokens=CHUNK_TOKENS)
+            format_chunks = False
+        else:
+            # 整形後も出力の上限に収まる大きさに分割し、チャンクごとに整形する
+            chunks = split_text(text, max_tokens=FORMAT_CHUNK_TOKENS)
+            format_chunks = True
         
         # プログレスバーの設定
         progress_bar = st.progress(0)
         status_text = st.empty()
         
-        # 各チャンクを要約
-        for i, chunk in enumerate(chunks):
-            status_text.text(f"要約中... ({i+1}/{len(chunks)})")
-            summary = summarize_chunk(chunk)
-            summaries.append(summary)
-            progress_bar.progress((i + 1) / len(chunks))
+        def on_progress(fraction, done, total):
+            status_text.text(f"要約中... ({done}/{total})")
+            progress_bar.progress(fraction)
+        
+        qa_manager = QAManager() if case_id is not None else None
+        parts = qa_manager.get_summary_parts(case_id) if qa_manager else None
         
-        # 要約を統合
-        final_summary = merge_summaries(summaries)
+        # チャンクを並列に整形・要約し、段階的に統合
+        bodies, final_summary, errors = map_reduce_summarize(
+            chunks, progress_callback=on_progress, format_chunks=format_chunks, parts=parts
+        )
+        if qa_manager:
+            qa_manager.save_case_summary(case_id, parts, final_summary if not errors else "")
+        for error in errors:
+            st.error(f"要約中にエラーが発生しました: {str(error)}")
+        formatted_text = "\n\n".join(body.strip() for body in bodies) if format_chunks else "".join(bodies)
         return formatted_text, final_summary
         
     except Exception as e:
         st.error(f"要約中にエラーが発生しました: {str(e)}")
         return text, ""
-    
\ No newline at end of file
@@ -1,24 +1,48 @@
 import streamlit as st
-import openai
 from typing import Dict, List, Optional
 import json
 import os
 import httpx
+from modules import lazy_imports
+from modules.llm_client import chat, openai_settings
+from modules.rate_limiter import SDK_MAX_RETRIES
+
+# プロンプトを変更した場合は上げる（キャッシュされた応答を使わないようにする）
+PROMPT_TEMPLATE = "summary_generator/1"
 
 class SummaryGenerator:
     """サマリー生成クラス"""
     def __init__(self):
         try:
-            self.openai_api_key = st.secrets["openai_api_key"]
-            # OpenAIクライアントの初期化
-            self.client = openai.OpenAI(
-                api_key=self.openai_api_key,
-                http_client=httpx.Client()
+            # OpenAIクライアントの初期化（APIキーはsecrets、なければ環境変数OPENAI_API_KEY）
+            self.client = lazy_imports.openai().OpenAI(
+                **openai_settings(),
+                http_client=httpx.Client(),
+                max_retries=SDK_MAX_RETRIES
             )
         except KeyError:
             st.error("OpenAI APIキーが設定されていません。")
             self.client = None
     
+    def _messages(self, text: str) -> List[Dict]:
+        """サマリー生成のメッセージを作成する"""
+        prompt = f"""
+            以下の会話ログを、以下の要件に従って要約してください：
+
+            1. 不要な言い回しや重複を削除
+            2. 重要な情報を簡潔にまとめる
+            3. 自然な日本語で読みやすくする
+            4. 箇条書きや見出しを使用して構造化する
+            5. 金融機関の面談記録として適切な形式にする
+
+            会話ログ:
+            {text}
+            """
+        return [
+            {"role": "system", "content": "あなたは金融機関の面談記録を要約する専門家です。"},
+            {"role": "user", "content": prompt}
+        ]
+    
     def generate_summary(self, text: str) -> Optional[str]:
         """テキストからサマリーを生成する
         
@@ -32,34 +56,10 @@ class SummaryGenerator:
             if not self.client:
                 return None
 
-            # プロンプトの作成
-            prompt = f"""
-            以下の会話ログを、以下の要件に従って要約してください：
-
-            1. 不要な言い回しや重複を削除
-            2. 重要な情報を簡潔にまとめる
-            3. 自然な日本語で読みやすくする
-            4. 箇条書きや見出しを使用して構造化する
-            5. 金融機関の面談記録として適切な形式にする
-
-            会話ログ:
-            {text}
-            """
-            
-            # OpenAI APIの呼び出し
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "あなたは金融機関の面談記録を要約する専門家です。"},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=2000
-            )
-            
-            # レスポンスの解析
-            summary = response.choices[0].message.content.strip()
-            return summary
+            # OpenAI APIの呼び出し（モデルは入力の長さから選び、同じ内容の呼び出しはキャッシュから返す）
+            summary = chat(self._messages(text), task="summary", temperature=0.3, max_tokens=2000,
+                           client=self.client, template=PROMPT_TEMPLATE)
+            return summary.strip()
                 
         except Exception as e:
             st.error(f"サマリー生成中にエラーが発生しました: {str(e)}")
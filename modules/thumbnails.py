@@ -0,0 +1,86 @@
+from PIL import Image
+import os
+import tempfile
+import logging
+from typing import Optional
+from modules import lazy_imports
+
+logger = logging.getLogger(__name__)
+
+# 一覧表示用サムネイルの最大サイズ（幅, 高さ）
+THUMBNAIL_SIZE = (350, 350)
+THUMBNAIL_SUFFIX = ".thumb.webp"
+
+
+def thumbnail_path(file_path: str) -> str:
+    """サムネイルの保存先パス（元ファイルと同じディレクトリ）"""
+    return file_path + THUMBNAIL_SUFFIX
+
+
+def _load_first_page(file_path: str, size) -> Image.Image:
+    """画像、またはPDFの1ページ目を読み込む"""
+    if os.path.splitext(file_path)[1].lower() == ".pdf":
+        # 1ページ目だけを必要な解像度でラスタライズする
+        pages = lazy_imports.pdf2image().convert_from_path(file_path, first_page=1, last_page=1, size=(size[0] * 2, None))
+        return pages[0]
+    img = Image.open(file_path)
+    # JPEGはデコード時に縮小して読み込む
+    img.draft("RGB", (size[0] * 2, size[1] * 2))
+    return img
+
+
+def create_thumbnail(file_path: str, size=THUMBNAIL_SIZE) -> Optional[str]:
+    """
+    サムネイルを作成して保存する
+
+    Args:
+        file_path (str): 元の画像またはPDFのパス
+        size (tuple): サムネイルの最大サイズ
+
+    Returns:
+        Optional[str]: サムネイルのパス（作成できない場合はNone）
+    """
+    try:
+        img = _load_first_page(file_path, size)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.thumbnail(size, Image.LANCZOS)
+        dest = thumbnail_path(file_path)
+        # 書きかけのファイルが読まれないよう一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest) or ".", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                try:
+                    img.save(f, format="WEBP", quality=75)
+                except (OSError, KeyError):
+                    # WebP非対応のPillowではJPEGで保存
+                    f.seek(0)
+                    f.truncate()
+                    img.save(f, format="JPEG", quality=75)
+            os.replace(tmp_path, dest)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return dest
+    except Exception as e:
+        logger.warning(f"サムネイルの作成に失敗しました: {file_path} ({e})")
+        return None
+
+
+def get_thumbnail(file_path: str, size=THUMBNAIL_SIZE) -> Optional[str]:
+    """
+    サムネイルのパスを取得する（未作成または元ファイルより古い場合は作成）
+
+    Args:
+        file_path (str): 元の画像またはPDFのパス
+        size (tuple): サムネイルの最大サイズ
+
+    Returns:
+        Optional[str]: サムネイルのパス（作成できない場合はNone）
+    """
+    if not os.path.isfile(file_path):
+        return None
+    dest = thumbnail_path(file_path)
+    if os.path.exists(dest) and os.path.getmtime(dest) >= os.path.getmtime(file_path):
+        return dest
+    return create_thumbnail(file_path, size)
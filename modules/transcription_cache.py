@@ -0,0 +1,190 @@
+"""
+文字起こし結果のキャッシュ
+
+音声の内容のハッシュ・モデル・言語・エンジン設定をキーに、文字起こし結果（text, segments）を
+SQLiteに保存する。同じ音声を再表示・再処理する場合は文字起こしを行わずに結果を返す。
+合計サイズが上限を超えた場合は、最後に使われた日時が古いものから削除する。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from modules.speech_to_text import engine_settings
+
+DEFAULT_DB_PATH = "db/transcription_cache.db"
+# キャッシュの合計サイズの上限（MB）
+DEFAULT_MAX_MB = 200
+
+
+def hash_audio(audio) -> str:
+    """音声データ（bytes）、ファイルパス、またはファイルオブジェクトのSHA-256"""
+    digest = hashlib.sha256()
+    if isinstance(audio, (bytes, bytearray, memoryview)):
+        digest.update(audio)
+    elif hasattr(audio, "read"):
+        # ファイルオブジェクトはチャンクごとに読み、読み終えたら先頭に戻す
+        audio.seek(0)
+        for block in iter(lambda: audio.read(1024 * 1024), b""):
+            digest.update(block)
+        audio.seek(0)
+    else:
+        with open(audio, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def make_key(audio_hash: str, model_size: str, language: str, settings: Optional[Dict] = None) -> str:
+    """キャッシュのキー（音声のハッシュ・モデル・言語・エンジン設定から作る）"""
+    settings = settings or engine_settings()
+    payload = json.dumps({
+        "audio": audio_hash, "model": model_size, "language": language,
+        "engine": settings.get("engine"),
+        # 量子化方式はfaster_whisperの場合のみ結果に影響する
+        "compute_type": settings.get("compute_type") if settings.get("engine") == "faster_whisper" else None,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TranscriptionCache:
+    """文字起こし結果をSQLiteに保存するキャッシュ"""
+    def __init__(self, db_path: str = DEFAULT_DB_PATH, max_mb: float = DEFAULT_MAX_MB):
+        self.db_path = db_path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        dir_path = os.path.dirname(db_path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS transcripts (
+                    key TEXT PRIMARY KEY,
+                    audio_hash TEXT NOT NULL,
+                    model TEXT,
+                    language TEXT,
+                    engine TEXT,
+                    text TEXT NOT NULL,
+                    segments TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_transcripts_last_used ON transcripts(last_used)")
+            conn.commit()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        キャッシュされた結果を取得する
+
+        Returns:
+            Optional[Dict]: text, segments（キャッシュにない場合はNone）
+        """
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT text, segments FROM transcripts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE transcripts SET last_used = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            self.hits += 1
+        return {"text": row[0], "segments": json.loads(row[1])}
+
+    def put(self, key: str, result: Dict, audio_hash: str = "", model: Optional[str] = None,
+            language: Optional[str] = None, engine: Optional[str] = None):
+        """結果を保存し、上限を超えた分を古いものから削除する"""
+        segments = json.dumps([
+            {"start": s["start"], "end": s["end"], "text": s["text"]} for s in result.get("segments", [])
+        ], ensure_ascii=False)
+        size = len(result["text"].encode("utf-8")) + len(segments.encode("utf-8"))
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO transcripts
+                    (key, audio_hash, model, language, engine, text, segments, size, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (key, audio_hash, model, language, engine, result["text"], segments, size, now, now))
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection):
+        """合計サイズが上限以下になるまで、最後に使われた日時が古いものから削除する"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM transcripts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        removed = []
+        for key, size in conn.execute("SELECT key, size FROM transcripts ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            removed.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM transcripts WHERE key = ?", removed)
+
+    def stats(self) -> Dict:
+        """件数・合計サイズ・ヒット率"""
+        with self._connect() as conn:
+            count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM transcripts").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": count,
+            "size_mb": round(total / (1024 * 1024), 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> TranscriptionCache:
+    """プロセス共通のTranscriptionCacheを取得する（上限はsecretsのtranscription_cache_mb）"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            max_mb = DEFAULT_MAX_MB
+            try:
+                import streamlit as st
+                max_mb = float(st.secrets.get("transcription_cache_mb", max_mb))
+            except Exception:
+                pass
+            _cache = TranscriptionCache(max_mb=max_mb)
+        return _cache
+
+
+def cached_transcribe(audio, transcribe: Callable[[], Dict], model_size: str = "base",
+                      language: str = "ja") -> Dict:
+    """
+    キャッシュにあれば保存済みの結果を返し、なければ文字起こしして保存する
+
+    Args:
+        audio: 音声データ（bytes）、ファイルパス、またはファイルオブジェクト（キーの計算に使う）
+        transcribe (Callable): キャッシュにない場合に呼ぶ関数（text, segments を返す）
+        model_size (str): モデルサイズ
+        language (str): 言語
+
+    Returns:
+        Dict: text, segments
+    """
+    cache = get_cache()
+    settings = engine_settings()
+    audio_hash = hash_audio(audio)
+    key = make_key(audio_hash, model_size, language, settings)
+    result = cache.get(key)
+    if result is None:
+        result = transcribe()
+        cache.put(key, result, audio_hash, model_size, language, settings["engine"])
+    return result
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+from datetime import datetime
+from typing import Dict, Optional
+from modules import lazy_imports
+from modules.thumbnails import create_thumbnail
+
+# 先頭バイトによるファイル形式の判定
+_MAGIC_NUMBERS = [
+    (b"\x89PNG\r\n\x1a\n", "image/png", ".png"),
+    (b"%PDF", "application/pdf", ".pdf"),
+    (b"\xff\xd8\xff", "image/jpeg", ".jpg"),
+    (b"GIF8", "image/gif", ".gif"),
+    (b"BM", "image/bmp", ".bmp"),
+]
+
+
+def detect_mime(data: bytes, filename: str = "") -> tuple:
+    """ファイルの先頭バイトからMIMEタイプと拡張子を判定"""
+    for magic, mime, ext in _MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return mime, ext
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp", ".webp"
+    ext = os.path.splitext(filename)[1].lower()
+    return "application/octet-stream", ext
+
+
+def count_pages(data: bytes, mime: str) -> int:
+    """ページ数を取得（画像は1ページ）"""
+    if mime != "application/pdf":
+        return 1
+    try:
+        return int(lazy_imports.pdf2image().pdfinfo_from_bytes(data)["Pages"])
+    except Exception:
+        # popplerが使えない場合はページオブジェクトを数える
+        return max(1, len(re.findall(rb"/Type\s*/Page(?!s)", data)))
+
+
+class UploadStore:
+    """アップロードファイルを内容のハッシュ値で保存・重複排除するストア"""
+    def __init__(self, db_path: str = "db/qa.db", blob_dir: str = "png/blobs"):
+        self.db_path = db_path
+        self.blob_dir = blob_dir
+        self._init_db()
+
+    def _init_db(self):
+        """メタデータテーブルの作成とocrテーブルへのblob_hash列の追加"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS upload_blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    original_name TEXT,
+                    size INTEGER NOT NULL,
+                    mime TEXT,
+                    page_count INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='ocr'")
+            if cursor.fetchone():
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(ocr)")]
+                if "blob_hash" not in columns:
+                    cursor.execute("ALTER TABLE ocr ADD COLUMN blob_hash TEXT")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_ocr_blob_hash ON ocr(blob_hash)")
+            conn.commit()
+
+    def blob_path(self, sha256: str, ext: str) -> str:
+        """ハッシュ値からファイルの保存先パスを作成（先頭2文字でディレクトリを分割）"""
+        return os.path.join(self.blob_dir, sha256[:2], f"{sha256}{ext}")
+
+    def put(self, data: bytes, original_name: str) -> Dict:
+        """
+        ファイルを保存する（同じ内容のファイルは1つだけ保存）
+
+        Args:
+            data (bytes): ファイルの内容
+            original_name (str): 元のファイル名
+
+        Returns:
+            Dict: sha256, path, original_name, size, mime, page_count, deduplicated
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        mime, ext = detect_mime(data, original_name)
+        path = self.blob_path(sha256, ext)
+        deduplicated = os.path.exists(path)
+        if not deduplicated:
+            # 同じディレクトリに一時ファイルを書いてから置き換えることで、
+            # 同時アップロードでも書きかけのファイルが見えないようにする
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            # 一覧表示用のサムネイルはアップロード時に作成しておく
+            create_thumbnail(path)
+
+        meta = self.get(sha256)
+        if meta is None:
+            meta = {
+                "sha256": sha256,
+                "original_name": original_name,
+                "size": len(data),
+                "mime": mime,
+                "page_count": count_pages(data, mime),
+            }
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("""
+                    INSERT OR IGNORE INTO upload_blobs (sha256, original_name, size, mime, page_count, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (sha256, original_name, meta["size"], mime, meta["page_count"],
+                      datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                conn.commit()
+        meta["path"] = path
+        meta["deduplicated"] = deduplicated
+        return meta
+
+    def put_upload(self, uploaded_file) -> Dict:
+        """Streamlitのアップロードファイルを保存する"""
+        return self.put(bytes(uploaded_file.getbuffer()), uploaded_file.name)
+
+    def get(self, sha256: str) -> Optional[Dict]:
+        """ハッシュ値からメタデータを取得"""
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT sha256, original_name, size, mime, page_count FROM upload_blobs WHERE sha256 = ?",
+                (sha256,)
+            ).fetchone()
+        if not row:
+            return None
+        return {
+            "sha256": row[0],
+            "original_name": row[1],
+            "size": row[2],
+            "mime": row[3],
+            "page_count": row[4],
+        }
+
+    def path_for(self, sha256: str) -> Optional[str]:
+        """ハッシュ値から保存済みファイルのパスを取得"""
+        meta = self.get(sha256)
+        if meta is None:
+            return None
+        _, ext = detect_mime(b"", meta["original_name"])
+        for candidate_ext in dict.fromkeys([ext, ".png", ".pdf", ".jpg", ".gif", ".bmp", ".webp"]):
+            path = self.blob_path(sha256, candidate_ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def find_existing_result(self, sha256: str, want_to_read: str) -> Optional[str]:
+        """同じ内容・同じ読み取り項目で処理済みの結果があれば返す"""
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute("""
+                SELECT result FROM ocr
+                WHERE blob_hash = ? AND want_to_read = ? AND result IS NOT NULL AND result != ''
+                ORDER BY id DESC LIMIT 1
+            """, (sha256, want_to_read)).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,136 @@
+"""
+音声区間検出（VAD）モジュール
+
+フレームごとの音量から無音区間を検出し、長い録音を無音の位置で分割する。
+外部ライブラリを使わずNumPyのみで処理する。
+"""
+import numpy as np
+from typing import List, Optional, Tuple
+
+SAMPLE_RATE = 16000
+FRAME_SECONDS = 0.03
+# 無音とみなす最短の長さ（秒）
+MIN_SILENCE_SECONDS = 0.3
+# 分割後の区間の長さ（秒）。Whisperは30秒単位で処理するため上限は30秒
+MIN_SEGMENT_SECONDS = 15.0
+MAX_SEGMENT_SECONDS = 30.0
+# 無音が見つからず強制的に分割する場合の重なり（秒）
+OVERLAP_SECONDS = 1.0
+
+
+def frame_energy_db(audio: np.ndarray, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """フレームごとの音量（dBFS）"""
+    frame = int(sample_rate * FRAME_SECONDS)
+    count = len(audio) // frame
+    if count == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = audio[:count * frame].reshape(count, frame).astype(np.float32)
+    rms = np.sqrt(np.mean(frames ** 2, axis=1) + 1e-10)
+    return 20 * np.log10(rms)
+
+
+def detect_speech(audio: np.ndarray, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    フレームごとの発話有無を判定する
+
+    Returns:
+        np.ndarray: フレームごとのbool配列（Trueが発話）
+    """
+    energy = frame_energy_db(audio, sample_rate)
+    if len(energy) == 0:
+        return np.zeros(0, dtype=bool)
+    # 背景雑音より10dB以上大きいフレームを発話とする
+    # （無音の少ない録音でも発話を取りこぼさないよう、大きな音から20dB下を上限とする）
+    noise_floor = np.percentile(energy, 2)
+    threshold = min(max(noise_floor + 10.0, -55.0), np.percentile(energy, 95) - 20.0)
+    # -60dBFS未満はどのような録音でも無音とする
+    threshold = max(threshold, -60.0)
+    speech = energy > threshold
+    # 発話の直後の短い途切れは発話として扱う（ハングオーバー）
+    hangover = int(0.2 / FRAME_SECONDS)
+    if hangover > 0 and speech.any():
+        kernel = np.ones(hangover + 1, dtype=np.int32)
+        speech = np.convolve(speech.astype(np.int32), kernel)[:len(speech)] > 0
+    return speech
+
+
+def _silence_midpoints(speech: np.ndarray, min_frames: int) -> List[int]:
+    """一定以上続く無音区間の中央のフレーム位置"""
+    midpoints = []
+    start = None
+    for i, is_speech in enumerate(np.append(speech, True)):
+        if not is_speech:
+            if start is None:
+                start = i
+        elif start is not None:
+            if i - start >= min_frames:
+                midpoints.append((start + i) // 2)
+            start = None
+    return midpoints
+
+
+def split_on_silence(audio: np.ndarray, sample_rate: int = SAMPLE_RATE,
+                     min_segment: float = MIN_SEGMENT_SECONDS,
+                     max_segment: float = MAX_SEGMENT_SECONDS,
+                     overlap: float = OVERLAP_SECONDS) -> List[Tuple[int, int]]:
+    """
+    音声を無音の位置で分割する
+
+    区間がmin_segment秒を超えたら次の無音で分割し、max_segment秒までに無音がなければ
+    overlap秒の重なりを持たせて強制的に分割する。全体が無音の区間は除外する。
+
+    Returns:
+        List[Tuple[int, int]]: (開始サンプル, 終了サンプル) のリスト
+    """
+    total = len(audio)
+    if total == 0:
+        return []
+    frame = int(sample_rate * FRAME_SECONDS)
+    speech = detect_speech(audio, sample_rate)
+    cut_points = [m * frame for m in _silence_midpoints(speech, int(MIN_SILENCE_SECONDS / FRAME_SECONDS))]
+
+    segments = []
+    start = 0
+    min_len, max_len = int(min_segment * sample_rate), int(max_segment * sample_rate)
+    overlap_len = int(overlap * sample_rate)
+    while start < total:
+        if total - start <= max_len:
+            segments.append((start, total))
+            break
+        candidates = [c for c in cut_points if start + min_len <= c <= start + max_len]
+        if candidates:
+            end = candidates[0]
+            segments.append((start, end))
+            start = end
+        else:
+            end = start + max_len
+            segments.append((start, end))
+            start = end - overlap_len
+
+    # 発話を含まない区間を除外
+    result = []
+    for seg_start, seg_end in segments:
+        frames = speech[seg_start // frame:max(seg_start // frame + 1, seg_end // frame)]
+        if frames.any():
+            result.append((seg_start, seg_end))
+    return result
+
+
+def find_cut_point(audio: np.ndarray, min_seconds: float, max_seconds: float,
+                   sample_rate: int = SAMPLE_RATE) -> Optional[int]:
+    """
+    min_seconds〜max_seconds秒の範囲で最初の無音の位置を探す
+
+    Returns:
+        Optional[int]: 分割位置のサンプル数（範囲内に無音がなく、音声がmax_seconds秒に
+        満たない場合はNone、max_seconds秒以上ある場合はmax_seconds秒の位置）
+    """
+    min_len, max_len = int(min_seconds * sample_rate), int(max_seconds * sample_rate)
+    if len(audio) < min_len:
+        return None
+    frame = int(sample_rate * FRAME_SECONDS)
+    speech = detect_speech(audio[:max_len], sample_rate)
+    for midpoint in _silence_midpoints(speech, int(MIN_SILENCE_SECONDS / FRAME_SECONDS)):
+        if min_len <= midpoint * frame <= max_len:
+            return midpoint * frame
+    return max_len if len(audio) >= max_len else None
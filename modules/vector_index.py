@@ -0,0 +1,321 @@
+"""
+案件の要約・文字起こし・OCR結果の意味検索（オフライン）
+
+文書をベクトルに変換し、float32の配列としてファイル（db/vector_index/vectors.f32）に追記する。
+検索時はファイルをメモリマップし、正規化済みのベクトルとの内積（コサイン類似度）を一括で計算して
+上位k件を返す。文書ID・種類・参照先などのメタデータはSQLiteに保存し、行番号でベクトルと対応させる。
+内容が変わった文書は古い行を無効にして新しい行を追記する。
+
+ベクトル化の関数は差し替えられる（既定は文字n-gramのハッシュで、外部のモデルやAPIを使わない）。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import unicodedata
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_INDEX_DIR = "db/vector_index"
+DEFAULT_DIM = 512
+# 文字起こしを検索の単位に分ける目安の文字数
+TRANSCRIPT_CHUNK_CHARS = 400
+# メタデータに保存する本文の先頭の文字数（検索結果の表示用）
+SNIPPET_CHARS = 300
+# 検索結果に含める類似度の下限（関係のない文書どうしでもハッシュの衝突で0.07程度になるため）
+DEFAULT_MIN_SCORE = 0.08
+
+
+class HashingEmbedder:
+    """
+    文字n-gramをハッシュで次元に割り当てるベクトル化（学習済みモデルを使わない）
+
+    日本語は単語の区切りがないため、文字の2-gram・3-gramを特徴にする。
+    """
+    def __init__(self, dim: int = DEFAULT_DIM, ngram_sizes: Tuple[int, ...] = (2, 3)):
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+        self.name = f"hashing-{dim}-{'-'.join(map(str, ngram_sizes))}"
+
+    def _features(self, text: str) -> Iterable[str]:
+        text = unicodedata.normalize("NFKC", text).lower()
+        text = " ".join(text.split())
+        for n in self.ngram_sizes:
+            for i in range(len(text) - n + 1):
+                yield text[i:i + n]
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in self._features(text)), dtype=np.uint32)
+            if hashes.size == 0:
+                continue
+            # 上位ビットで符号を決め、衝突による偏りを打ち消す
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+            np.add.at(vectors[row], (hashes % self.dim).astype(np.int64), signs)
+        # 文書の長さに依らないよう、対数で頻度を抑えてから正規化する
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class VectorIndex:
+    """メモリマップしたfloat32のベクトルとSQLiteのメタデータによる検索インデックス"""
+    def __init__(self, index_dir: str = DEFAULT_INDEX_DIR,
+                 embedder: Optional[Callable[[List[str]], np.ndarray]] = None,
+                 min_score: float = DEFAULT_MIN_SCORE):
+        self.embedder = embedder or HashingEmbedder()
+        self.dim = self.embedder.dim
+        self.min_score = min_score
+        self.vectors_path = os.path.join(index_dir, "vectors.f32")
+        self.db_path = os.path.join(index_dir, "meta.db")
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._active = None
+        self._kinds = None
+        os.makedirs(index_dir, exist_ok=True)
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS items (
+                    row INTEGER PRIMARY KEY,
+                    doc_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    ref_id TEXT,
+                    snippet TEXT,
+                    content_hash TEXT NOT NULL,
+                    active INTEGER NOT NULL DEFAULT 1
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_items_doc_id ON items(doc_id, active)")
+            conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+            row = conn.execute("SELECT value FROM settings WHERE key = 'embedder'").fetchone()
+            name = getattr(self.embedder, "name", type(self.embedder).__name__)
+            if row is None:
+                conn.execute("INSERT INTO settings (key, value) VALUES ('embedder', ?)", (name,))
+            elif row[0] != name:
+                raise ValueError(
+                    f"インデックスは別のベクトル化（{row[0]}）で作成されています。{self.vectors_path}を削除して作り直してください"
+                )
+            conn.commit()
+
+    def __len__(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM items WHERE active = 1").fetchone()[0]
+
+    def add(self, docs: List[Dict]) -> int:
+        """
+        文書を追加する（内容が同じ文書は何もしない、変わった文書は置き換える）
+
+        Args:
+            docs: doc_id, kind, text（と任意でref_id）の辞書のリスト
+
+        Returns:
+            int: 新たにベクトル化した文書の数
+        """
+        with self._lock, self._connect() as conn:
+            current = {
+                doc_id: content_hash for doc_id, content_hash in
+                conn.execute("SELECT doc_id, content_hash FROM items WHERE active = 1")
+            }
+            changed = []
+            seen = set()
+            for doc in docs:
+                if doc["doc_id"] in seen or not doc["text"].strip():
+                    continue
+                seen.add(doc["doc_id"])
+                content_hash = _content_hash(doc["text"])
+                if current.get(doc["doc_id"]) != content_hash:
+                    changed.append((doc, content_hash))
+            if not changed:
+                return 0
+
+            vectors = np.ascontiguousarray(self.embedder([doc["text"] for doc, _ in changed]), dtype=np.float32)
+            rows = conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+            # 前回の書き込みが途中で失敗した場合の余分なベクトルを取り除いてから追記する
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(rows * self.dim * 4)
+                f.write(vectors.tobytes())
+            conn.executemany("UPDATE items SET active = 0 WHERE doc_id = ? AND active = 1",
+                             [(doc["doc_id"],) for doc, _ in changed])
+            conn.executemany("""
+                INSERT INTO items (row, doc_id, kind, ref_id, snippet, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [
+                (rows + i, doc["doc_id"], doc["kind"], str(doc.get("ref_id", "")),
+                 doc["text"][:SNIPPET_CHARS], content_hash)
+                for i, (doc, content_hash) in enumerate(changed)
+            ])
+            conn.commit()
+            self._matrix = None
+            return len(changed)
+
+    def remove(self, doc_ids: Iterable[str]):
+        """文書を検索対象から外す"""
+        with self._lock, self._connect() as conn:
+            conn.executemany("UPDATE items SET active = 0 WHERE doc_id = ? AND active = 1",
+                             [(doc_id,) for doc_id in doc_ids])
+            conn.commit()
+            self._matrix = None
+
+    def doc_ids(self, kind: Optional[str] = None) -> List[str]:
+        """検索対象の文書IDの一覧"""
+        with self._connect() as conn:
+            if kind is None:
+                return [row[0] for row in conn.execute("SELECT doc_id FROM items WHERE active = 1")]
+            return [row[0] for row in conn.execute(
+                "SELECT doc_id FROM items WHERE active = 1 AND kind = ?", (kind,)
+            )]
+
+    def _load(self):
+        """ベクトルのメモリマップと、行ごとの有効・無効と種類（追加・削除があった場合のみ読み直す）"""
+        if self._matrix is not None:
+            return self._matrix, self._active, self._kinds
+        with self._connect() as conn:
+            items = conn.execute("SELECT active, kind FROM items ORDER BY row").fetchall()
+        active = np.array([bool(a) for a, _ in items], dtype=bool)
+        kinds = np.array([kind for _, kind in items], dtype=object)
+        if not items or not os.path.exists(self.vectors_path):
+            matrix = np.zeros((0, self.dim), dtype=np.float32)
+        else:
+            matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(items), self.dim))
+        self._matrix, self._active, self._kinds = matrix, active, kinds
+        return matrix, active, kinds
+
+    def search(self, query: str, k: int = 10, kinds: Optional[List[str]] = None,
+               min_score: Optional[float] = None) -> List[Dict]:
+        """
+        クエリに近い文書を検索する
+
+        Args:
+            query: 検索するテキスト
+            k: 返す件数（類似度がmin_score以下の文書は含めないため、k件より少ない場合がある）
+            kinds: 対象とする文書の種類（summary / transcript / ocr、省略時はすべて）
+            min_score: 類似度の下限（省略時はインデックスのmin_score）
+
+        Returns:
+            List[Dict]: doc_id, kind, ref_id, snippet, score（類似度の高い順）
+        """
+        if not query.strip():
+            return []
+        with self._lock:
+            matrix, active, row_kinds = self._load()
+        if len(matrix) == 0:
+            return []
+        query_vector = np.asarray(self.embedder([query])[0], dtype=np.float32)
+        scores = matrix @ query_vector
+        mask = active if not kinds else active & np.isin(row_kinds, list(kinds))
+        mask = mask & (scores > (self.min_score if min_score is None else min_score))
+        scores[~mask] = -np.inf
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        with self._connect() as conn:
+            placeholders = ",".join("?" * len(top))
+            meta = {row[0]: row[1:] for row in conn.execute(
+                f"SELECT row, doc_id, kind, ref_id, snippet FROM items WHERE row IN ({placeholders})",
+                [int(r) for r in top]
+            )}
+        return [
+            {"doc_id": meta[r][0], "kind": meta[r][1], "ref_id": meta[r][2], "snippet": meta[r][3],
+             "score": float(scores[r])}
+            for r in map(int, top)
+        ]
+
+
+def _table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone() is not None
+
+
+def _transcript_chunks(segments: List[Tuple[Optional[str], str]]) -> List[str]:
+    """話者付きの区間を、目安の文字数ごとの検索単位にまとめる"""
+    chunks, current = [], ""
+    for speaker, text in segments:
+        line = f"{speaker}: {text}" if speaker else text
+        if current and len(current) + len(line) > TRANSCRIPT_CHUNK_CHARS:
+            chunks.append(current)
+            current = ""
+        current += line + "\n"
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def collect_documents(db_path: str = "db/qa.db") -> Dict[str, List[Dict]]:
+    """
+    qa.dbから検索対象の文書を集める（案件の要約・文字起こし・OCR結果）
+
+    Returns:
+        Dict[str, List[Dict]]: 種類ごとの文書のリスト
+    """
+    docs = {"summary": [], "transcript": [], "ocr": []}
+    with sqlite3.connect(db_path) as conn:
+        if _table_exists(conn, "case_summaries"):
+            for case_id, summary in conn.execute("SELECT case_id, summary FROM case_summaries"):
+                docs["summary"].append({"doc_id": f"summary:{case_id}", "kind": "summary",
+                                        "ref_id": case_id, "text": summary})
+        if _table_exists(conn, "case_segments"):
+            by_case = {}
+            for case_id, speaker, text in conn.execute(
+                "SELECT case_id, speaker, text FROM case_segments ORDER BY case_id, segment_index"
+            ):
+                by_case.setdefault(case_id, []).append((speaker, text))
+            for case_id, segments in by_case.items():
+                for i, chunk in enumerate(_transcript_chunks(segments)):
+                    docs["transcript"].append({"doc_id": f"transcript:{case_id}:{i}", "kind": "transcript",
+                                               "ref_id": case_id, "text": chunk})
+        if _table_exists(conn, "ocr"):
+            for ocr_id, result in conn.execute("SELECT id, result FROM ocr WHERE result IS NOT NULL"):
+                docs["ocr"].append({"doc_id": f"ocr:{ocr_id}", "kind": "ocr", "ref_id": ocr_id, "text": result})
+    return docs
+
+
+def sync_index(index: VectorIndex, db_path: str = "db/qa.db") -> int:
+    """
+    qa.dbの内容をインデックスに反映する（追加・変更された文書だけをベクトル化し、削除された文書は外す）
+
+    Returns:
+        int: 新たにベクトル化した文書の数
+    """
+    added = 0
+    for kind, docs in collect_documents(db_path).items():
+        added += index.add(docs)
+        current = {doc["doc_id"] for doc in docs if doc["text"].strip()}
+        removed = [doc_id for doc_id in index.doc_ids(kind) if doc_id not in current]
+        if removed:
+            index.remove(removed)
+    return added
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _min_score() -> float:
+    try:
+        import streamlit as st
+        return float(st.secrets.get("vector_search_min_score", DEFAULT_MIN_SCORE))
+    except Exception:
+        return DEFAULT_MIN_SCORE
+
+
+def get_index() -> VectorIndex:
+    """プロセス共通のVectorIndexを取得する（類似度の下限はsecretsのvector_search_min_scoreで変更できる）"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = VectorIndex(min_score=_min_score())
+        return _index
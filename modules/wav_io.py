@@ -0,0 +1,132 @@
+"""
+WAVファイルの入出力と録音時のリサンプリング
+
+録音データは書き込みのたびにヘッダーのサイズ情報を更新するため、
+録音中にプロセスが落ちても、それまでに書き出した部分は通常のWAVとして読み込める。
+"""
+import os
+import struct
+import wave
+from typing import Optional
+
+import numpy as np
+
+# 文字起こし用のサンプリングレート（Whisperの入力形式）
+TARGET_SAMPLE_RATE = 16000
+_HEADER_SIZE = 44
+
+
+class IncrementalWavWriter:
+    """16bit PCMのWAVを追記しながら書き出すクラス"""
+    def __init__(self, path: str, samplerate: int = TARGET_SAMPLE_RATE, channels: int = 1):
+        self.path = path
+        self.samplerate = samplerate
+        self.channels = channels
+        self.data_bytes = 0
+        self._file = open(path, "wb")
+        self._file.write(self._header())
+        self._file.flush()
+
+    def _header(self) -> bytes:
+        block_align = self.channels * 2
+        return b"".join([
+            b"RIFF", struct.pack("<I", 36 + self.data_bytes), b"WAVE",
+            b"fmt ", struct.pack("<IHHIIHH", 16, 1, self.channels, self.samplerate,
+                                 self.samplerate * block_align, block_align, 16),
+            b"data", struct.pack("<I", self.data_bytes),
+        ])
+
+    def write(self, samples: np.ndarray):
+        """int16のサンプルを追記し、ヘッダーのサイズ情報を更新する"""
+        if samples.size == 0:
+            return
+        data = np.ascontiguousarray(samples, dtype="<i2").tobytes()
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(data)
+        self.data_bytes += len(data)
+        self._update_header()
+
+    def _update_header(self):
+        self._file.seek(4)
+        self._file.write(struct.pack("<I", 36 + self.data_bytes))
+        self._file.seek(40)
+        self._file.write(struct.pack("<I", self.data_bytes))
+        self._file.flush()
+
+    @property
+    def frames_written(self) -> int:
+        return self.data_bytes // (self.channels * 2)
+
+    def close(self):
+        """ヘッダーを確定してファイルを閉じる"""
+        if self._file.closed:
+            return
+        self._update_header()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+class StreamingResampler:
+    """チャンク単位で入力される音声をモノラル・指定サンプリングレートに変換するクラス"""
+    def __init__(self, src_rate: int, dst_rate: int = TARGET_SAMPLE_RATE, taps: int = 63):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self.step = src_rate / dst_rate
+        # 折り返し雑音を防ぐローパスフィルタ（窓関数法）
+        cutoff = min(1.0, dst_rate / src_rate) * 0.9
+        n = np.arange(taps) - (taps - 1) / 2
+        kernel = cutoff * np.sinc(cutoff * n) * np.hamming(taps)
+        self._kernel = (kernel / kernel.sum()).astype(np.float32)
+        self._history = np.zeros(taps - 1, dtype=np.float32)
+        self._carry = np.zeros(0, dtype=np.float32)
+        self._position = 0.0
+
+    def process(self, frames: np.ndarray) -> np.ndarray:
+        """
+        int16のフレーム（サンプル数 × チャンネル数）を変換する
+
+        Returns:
+            np.ndarray: モノラルint16のサンプル
+        """
+        if frames.ndim == 2:
+            mono = frames.astype(np.float32).mean(axis=1)
+        else:
+            mono = frames.astype(np.float32)
+        if self.src_rate == self.dst_rate:
+            return np.clip(np.round(mono), -32768, 32767).astype(np.int16)
+
+        x = np.concatenate([self._history, mono])
+        filtered = np.convolve(x, self._kernel, mode="valid")
+        self._history = x[-(len(self._kernel) - 1):]
+
+        # 前回の最後のサンプルとつなげて線形補間で間引く
+        y = np.concatenate([self._carry, filtered])
+        if len(y) < 2:
+            self._carry = y
+            return np.zeros(0, dtype=np.int16)
+        positions = np.arange(self._position, len(y) - 1, self.step)
+        index = positions.astype(np.int64)
+        fraction = (positions - index).astype(np.float32)
+        out = y[index] * (1.0 - fraction) + y[index + 1] * fraction
+        next_position = positions[-1] + self.step if len(positions) else self._position
+        self._position = next_position - (len(y) - 1)
+        self._carry = y[-1:]
+        return np.clip(np.round(out), -32768, 32767).astype(np.int16)
+
+
+def read_wav_16k(path: str) -> Optional[np.ndarray]:
+    """
+    16kHz・モノラル・16bitのWAVを、Whisperにそのまま渡せるfloat32配列として読み込む
+
+    Returns:
+        Optional[np.ndarray]: 音声データ（形式が異なる場合はNone）
+    """
+    try:
+        with wave.open(path, "rb") as wf:
+            if (wf.getframerate() != TARGET_SAMPLE_RATE or wf.getnchannels() != 1
+                    or wf.getsampwidth() != 2):
+                return None
+            data = wf.readframes(wf.getnframes())
+    except (wave.Error, EOFError, OSError):
+        return None
+    return np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768.0
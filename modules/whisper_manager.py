@@ -0,0 +1,158 @@
+import numpy as np
+import os
+import threading
+import time
+import logging
+from typing import Dict, List, Optional
+from modules.speech_to_text import get_engine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_SIZE = "base"
+# 同時に実行する文字起こしの上限
+DEFAULT_MAX_CONCURRENCY = 2
+
+
+def _rss_mb() -> float:
+    """現在のプロセスの常駐メモリ（MB）"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class WhisperModelManager:
+    """
+    Whisperモデルをプロセス内で共有する管理クラス
+
+    モデルはサイズごとに1度だけ読み込み、全セッションで使い回す。
+    Whisperのデコード処理はモデルにフックを登録するため、同じモデルでの文字起こしは
+    1件ずつ実行し、全体の同時実行数はmax_concurrencyで制限する。
+    モデルの読み込みと推論は文字起こしエンジン（modules.speech_to_text）に委ねる。
+    """
+    def __init__(self, sizes: Optional[List[str]] = None, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 engine=None):
+        self.sizes = sizes or [DEFAULT_MODEL_SIZE]
+        self.engine = engine or get_engine()
+        self._models = {}
+        self._load_locks = {size: threading.Lock() for size in self.sizes}
+        self._run_locks = {size: threading.Lock() for size in self.sizes}
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._warmup_thread = None
+        self.stats = {}
+
+    def _size_lock(self, locks: Dict, size: str) -> threading.Lock:
+        with self._lock:
+            return locks.setdefault(size, threading.Lock())
+
+    def get_model(self, size: str = DEFAULT_MODEL_SIZE):
+        """
+        モデルを取得する（未読み込みの場合は読み込む）
+
+        Args:
+            size (str): モデルサイズ（tiny / base / small / medium / large）
+
+        Returns:
+            読み込み済みのモデル（エンジンごとのモデルオブジェクト）
+        """
+        model = self._models.get(size)
+        if model is not None:
+            return model
+        with self._size_lock(self._load_locks, size):
+            model = self._models.get(size)
+            if model is None:
+                rss_before = _rss_mb()
+                started = time.perf_counter()
+                model = self.engine.load(size)
+                load_seconds = time.perf_counter() - started
+                self.stats[size] = {
+                    "load_seconds": round(load_seconds, 2),
+                    "memory_mb": round(_rss_mb() - rss_before, 1),
+                }
+                logger.info(f"Whisperモデル({size}, {self.engine.name})を読み込みました: {load_seconds:.1f}秒")
+                self._models[size] = model
+        return model
+
+    def _warm_up(self, sizes: List[str]):
+        for size in sizes:
+            try:
+                model = self.get_model(size)
+                # 初回推論の準備処理を済ませておく
+                started = time.perf_counter()
+                with self._size_lock(self._run_locks, size):
+                    self.engine.transcribe(model, np.zeros(16000, dtype=np.float32), language="ja")
+                self.stats[size]["warmup_seconds"] = round(time.perf_counter() - started, 2)
+            except Exception as e:
+                logger.error(f"Whisperモデル({size})のウォームアップに失敗しました: {e}")
+
+    def warm_up(self, sizes: Optional[List[str]] = None, background: bool = True):
+        """
+        設定されたモデルを読み込み、1秒分の無音で推論を実行しておく
+
+        Args:
+            sizes (List[str]): 対象のモデルサイズ（省略時は設定されたすべて）
+            background (bool): Trueの場合は別スレッドで実行する
+        """
+        sizes = sizes or self.sizes
+        if not background:
+            self._warm_up(sizes)
+            return
+        with self._lock:
+            if self._warmup_thread is not None:
+                return
+            self._warmup_thread = threading.Thread(target=self._warm_up, args=(sizes,), daemon=True)
+            self._warmup_thread.start()
+
+    def transcribe(self, audio, size: str = DEFAULT_MODEL_SIZE, **kwargs) -> Dict:
+        """
+        文字起こしを実行する（スレッドセーフ）
+
+        Args:
+            audio: 音声ファイルのパス、または16kHzのfloat32配列
+            size (str): モデルサイズ
+            **kwargs: エンジンのtranscribeに渡す引数（language など）
+
+        Returns:
+            Dict: text, segments, language
+        """
+        model = self.get_model(size)
+        with self._semaphore:
+            with self._size_lock(self._run_locks, size):
+                return self.engine.transcribe(model, audio, **kwargs)
+
+    def is_loaded(self, size: str = DEFAULT_MODEL_SIZE) -> bool:
+        return size in self._models
+
+    def status(self) -> Dict:
+        """読み込み状況（サイズごとの読み込み時間・メモリ使用量）"""
+        return {
+            size: {"loaded": size in self._models, "engine": self.engine.name, **self.stats.get(size, {})}
+            for size in dict.fromkeys(self.sizes + list(self._models))
+        }
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager() -> WhisperModelManager:
+    """プロセス共通のWhisperModelManagerを取得する"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            sizes = None
+            max_concurrency = DEFAULT_MAX_CONCURRENCY
+            try:
+                import streamlit as st
+                sizes = list(st.secrets.get("whisper_models", [])) or None
+                max_concurrency = int(st.secrets.get("whisper_max_concurrency", max_concurrency))
+            except Exception:
+                pass
+            if sizes is None and os.getenv("WHISPER_MODELS"):
+                sizes = [s.strip() for s in os.getenv("WHISPER_MODELS").split(",") if s.strip()]
+            _manager = WhisperModelManager(sizes, max_concurrency)
+        return _manager
@@ -1,5 +1,6 @@
 import streamlit as st
 from modules.case_manager import QAManager
+from modules.vector_index import get_index, sync_index
 import pandas as pd
 import sqlite3
 import io
@@ -9,6 +10,34 @@ st.title("案件情報一覧")
 
 case_manager = QAManager()
 cases = case_manager.get_cases()
+
+# --- 検索（要約・文字起こし・OCR結果） ---
+query = st.text_input("要約・面談の文字起こし・OCR結果を検索", placeholder="例: 自社株の評価")
+if st.button("検索の索引を更新"):
+    st.session_state.vector_index_synced = False
+if query:
+    index = get_index()
+    # 索引の更新はセッションごとに1度（追加・変更された文書だけをベクトル化する）
+    if not st.session_state.get("vector_index_synced"):
+        with st.spinner("検索の索引を更新中..."):
+            sync_index(index, case_manager.db.db_path)
+        st.session_state.vector_index_synced = True
+    kind_labels = {"summary": "要約", "transcript": "文字起こし", "ocr": "OCR"}
+    company_names = {str(c["id"]): c["company_name"] for c in cases}
+    results = index.search(query, k=10)
+    if results:
+        st.dataframe(pd.DataFrame([
+            {
+                "種類": kind_labels.get(r["kind"], r["kind"]),
+                "案件": company_names.get(r["ref_id"], "") if r["kind"] != "ocr" else "",
+                "参照ID": r["ref_id"],
+                "類似度": round(r["score"], 3),
+                "内容": r["snippet"],
+            }
+            for r in results
+        ]), use_container_width=True, hide_index=True)
+    else:
+        st.info("該当する内容は見つかりませんでした。")
 if cases:
     df = pd.DataFrame(cases)
     edited_df = st.data_editor(
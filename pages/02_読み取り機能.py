@@ -1,12 +1,13 @@
 import streamlit as st
+from modules import lazy_imports
 from modules.claude_vision_reader import ClaudeVisionReader
-import sqlite3
+from modules.upload_store import UploadStore
+from modules.thumbnails import get_thumbnail
+from modules.ocr_fields import OcrFieldStore
+from modules.rate_limiter import get_governor, estimate_tokens, streamlit_wait_notifier, IMAGE_TOKEN_ESTIMATE
 import statistics
-import google.generativeai as genai
-from pdf2image import convert_from_path
 import pandas as pd
 from collections import Counter
-import matplotlib.pyplot as plt
 import numpy as np
 import json
 import re
@@ -27,6 +28,9 @@ st.markdown(
 db_path = "db/qa.db"
 png_dir = "png"
 reader = ClaudeVisionReader()
+# API呼び出しの順番待ち表示
+wait_placeholder = st.empty()
+reader.on_wait = streamlit_wait_notifier(wait_placeholder)
 
 COMMON_PROMPT_TEMPLATE = """
 画像内のテキストと数値を正確に読み取り、次の点に留意して、以下のすべての項目を抽出してください: {variables}
@@ -39,29 +43,31 @@ COMMON_PROMPT_TEMPLATE = """
 
 def gemini_ocr(file_path, prompt):
     api_key = st.secrets["gemini_api_key"]
+    genai = lazy_imports.genai()
     genai.configure(api_key=api_key)
     model = genai.GenerativeModel("gemini-2.0-flash")
+    tokens = IMAGE_TOKEN_ESTIMATE + estimate_tokens(prompt) + 2048
     ext = file_path.split('.')[-1].lower()
     if ext == "pdf":
-        images = convert_from_path(file_path)
+        images = lazy_imports.pdf2image().convert_from_path(file_path)
         results = []
         for i, img in enumerate(images):
             buf = st.BytesIO()
             img.save(buf, format="PNG")
             image_data = buf.getvalue()
-            response = model.generate_content([
+            response = get_governor().call("gemini", lambda: model.generate_content([
                 prompt + f"（{i+1}ページ目）",
                 {"mime_type": "image/png", "data": image_data}
-            ])
+            ]), tokens=tokens, on_wait=reader.on_wait)
             results.append(response.text)
         return "\n".join(results)
     else:
         with open(file_path, "rb") as f:
             image_data = f.read()
-        response = model.generate_content([
+        response = get_governor().call("gemini", lambda: model.generate_content([
             prompt,
             {"mime_type": "image/png", "data": image_data}
-        ])
+        ]), tokens=tokens, on_wait=reader.on_wait)
         return response.text
 
 # --- OCR実行対象を選択（テスト実行用） ---
@@ -83,11 +89,13 @@ if not st.session_state.ocr_done:
                 col_img, col_ocr = st.columns([7, 3], gap="large")
                 with col_img:
                     st.markdown(f"#### プレビュー: {entry['filename']}")
-                    if entry['type'] == "image":
-                        st.image(entry['file_path'], caption=entry['filename'], width=350)
-                    elif entry['type'] == "pdf":
+                    # 原寸画像ではなく縮小済みサムネイルを表示
+                    thumb = get_thumbnail(entry['file_path']) if entry['type'] in ("image", "pdf") else None
+                    if thumb:
+                        st.image(thumb, caption=entry['filename'], width=350)
+                    if entry['type'] == "pdf":
                         st.markdown(f"[PDFを開く]({entry['file_path']})")
-                    else:
+                    elif entry['type'] != "image":
                         st.info("対応していないファイル形式です。")
                 with col_ocr:
                     st.markdown(f"**want_to_read:** {entry['want_to_read']}")
@@ -107,12 +115,11 @@ if not st.session_state.ocr_done:
                         st.info(f"OpenAI Vision（gpt-4o）OCR結果:\n{st.session_state[key_openai]}")
                     if (key_claude in st.session_state or key_openai in st.session_state):
                         if st.button(f"出力結果を登録（このファイル）", key=f"register_result_test_{entry['id']}"):
-                            conn = sqlite3.connect(db_path)
-                            cursor = conn.cursor()
-                            result_to_save = st.session_state.get(key_claude) or st.session_state.get(key_openai)
-                            cursor.execute("UPDATE ocr SET result = ? WHERE id = ?", (result_to_save, entry['id']))
-                            conn.commit()
-                            conn.close()
+                            if st.session_state.get(key_claude):
+                                result_to_save, result_model = st.session_state[key_claude], reader.model
+                            else:
+                                result_to_save, result_model = st.session_state.get(key_openai), "gpt-4o"
+                            reader.save_ocr_result(db_path, entry['id'], result_to_save, result_model)
                             st.success("出力結果をデータベースに登録しました。")
                 st.markdown("</div>", unsafe_allow_html=True)
     run_ocr_test = st.button("選択したものだけOCR読み取りを実行（テスト用）", key="run_ocr_test")
@@ -141,16 +148,15 @@ uploaded_file = st.file_uploader("画像またはPDFを選択", type=["png", "jp
 
 if uploaded_file:
     st.success("ファイルがアップロードされました。次に進んでください。")
-    # 一時保存
-    file_ext = uploaded_file.name.split('.')[-1].lower()
-    file_type = "image" if file_ext in ["png", "jpg", "jpeg"] else "pdf"
-    save_path = f"tmp_{uploaded_file.name}"
-    with open(save_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-    # プレビュー
-    if file_type == "image":
-        st.image(save_path, caption=uploaded_file.name, width=350)
-    else:
+    # 内容のハッシュ値で保存（同じファイルは重複して保存しない）
+    blob = UploadStore(db_path).put_upload(uploaded_file)
+    file_type = "image" if blob["mime"].startswith("image/") else "pdf"
+    save_path = blob["path"]
+    # プレビュー（サムネイル）
+    thumb = get_thumbnail(save_path)
+    if thumb:
+        st.image(thumb, caption=uploaded_file.name, width=350)
+    if file_type != "image":
         st.markdown(f"[PDFを開く]({save_path})")
 
     # --- 2. AIで全情報をテーブル化（各AIモデルで比較） ---
@@ -306,17 +312,29 @@ if uploaded_file:
                 st.experimental_rerun()
         with col2:
             if st.button("出力結果を一括登録", key="register_all_results"):
-                conn = sqlite3.connect(db_path)
-                cursor = conn.cursor()
                 updated = 0
                 for entry in entries:
                     if entry['id'] in ocr_ids:
                         key_claude = f"claude_result_{entry['id']}"
                         key_openai = f"openai_result_{entry['id']}"
-                        result_to_save = st.session_state.get(key_claude) or st.session_state.get(key_openai)
+                        if st.session_state.get(key_claude):
+                            result_to_save, result_model = st.session_state[key_claude], reader.model
+                        else:
+                            result_to_save, result_model = st.session_state.get(key_openai), "gpt-4o"
                         if result_to_save:
-                            cursor.execute("UPDATE ocr SET result = ? WHERE id = ?", (result_to_save, entry['id']))
+                            reader.save_ocr_result(db_path, entry['id'], result_to_save, result_model)
                             updated += 1
-                conn.commit()
-                conn.close()
-                st.success(f"{updated}件の出力結果をデータベースに登録しました。") 
\ No newline at end of file
+                st.success(f"{updated}件の出力結果をデータベースに登録しました。") 
+# --- 抽出結果の横断検索 ---
+st.header("抽出結果の横断検索")
+field_store = OcrFieldStore(db_path)
+search_label = st.selectbox("業種", ["（すべて）"] + field_store.list_labels(), key="field_search_label")
+search_label = None if search_label == "（すべて）" else search_label
+field_options = field_store.list_fields(search_label)
+if field_options:
+    search_field = st.selectbox("項目名", field_options, key="field_search_field")
+    field_rows = field_store.query(search_field, label=search_label)
+    if field_rows:
+        st.dataframe(pd.DataFrame(field_rows), use_container_width=True)
+else:
+    st.info("項目ごとに保存された抽出結果はまだありません。")
@@ -1,39 +1,244 @@
+import os
 import streamlit as st
-import tempfile
-import whisper
+from modules.whisper_manager import get_manager
+from modules.parallel_transcriber import transcribe_parallel
 from modules.categorizer import Categorizer
 from modules.summary_generator import SummaryGenerator
+from modules.interview_extractor import InterviewExtractor, SummaryStream
+from modules.summarizer import summarize, estimate_summary
+from modules.audio_capture import record_audio, discard_recording
+from modules.speaker_diarization import SpeakerDiarization, to_conversation
+from modules.case_manager import QAManager
+from modules.transcription_cache import cached_transcribe, get_cache, hash_audio
+from modules import llm_cache, model_router
+from modules.audio_decode import decode_audio, AudioDecodeError
 from st_audiorecorder import st_audiorecorder
 
 st.set_page_config(page_title="面談・録音機能", page_icon="🎤")
 st.title("面談・録音機能")
 
-audio_processor = whisper.load_model("base")
+# Whisperモデルはプロセス内で共有（再実行のたびに読み込まない）
+audio_processor = get_manager()
+audio_processor.warm_up()
 categorizer = Categorizer()
 summary_generator = SummaryGenerator()
+interview_extractor = InterviewExtractor()
+
+with st.sidebar:
+    st.caption(f"文字起こしモデルの状態（エンジン: {audio_processor.engine.name}）")
+    for size, info in audio_processor.status().items():
+        if info["loaded"]:
+            st.caption(f"{size}: 読み込み済み（{info.get('load_seconds', '-')}秒, {info.get('memory_mb', '-')}MB）")
+        else:
+            st.caption(f"{size}: 読み込み中...")
+    cache_stats = get_cache().stats()
+    st.caption(f"文字起こしキャッシュ: {cache_stats['entries']}件（{cache_stats['size_mb']}MB）")
+    response_cache = llm_cache.get_cache()
+    if response_cache is not None:
+        llm_stats = response_cache.stats()
+        st.caption(f"応答キャッシュ: {llm_stats['entries']}件（{llm_stats['size_mb']}MB, "
+                   f"ヒット率 {llm_stats['hit_rate']:.0%}）")
+
+
+def show_summary(text):
+    """
+    サマリーとカテゴリ分類の生成・表示
+
+    サマリーとカテゴリはquestion.jsonのスキーマに沿って1回の呼び出しで抽出する。
+    サマリーは届いた順に表示し、完了後の結果はセッションに保持する（再実行時はAPIを呼び出さない）。
+    """
+    st.subheader("サマリー・カテゴリ分類")
+    generated = st.session_state.get("generated_summary")
+    if generated is not None and generated["text"] != text:
+        generated = None
+    streamed = generated is None
+    if streamed:
+        # 入力の長さから選んだモデルと、所要時間・費用の見積もりを実行前に表示する
+        route = interview_extractor.estimate(text)
+        if route is not None:
+            st.caption(f"見積もり: {model_router.describe(route)}")
+        if not st.button("サマリーとカテゴリ分類を生成"):
+            return
+        stream = interview_extractor.extract_stream(text)
+        if stream is None:
+            return
+        try:
+            st.subheader("会話サマリー")
+            with st.spinner("抽出中..."):
+                summary_stream = SummaryStream(stream)
+                st.write_stream(summary_stream)
+        except Exception as e:
+            st.error(f"サマリー・カテゴリ分類の生成中にエラーが発生しました: {str(e)}")
+            return
+        extracted = interview_extractor.parse(stream.text)
+        if extracted is None:
+            return
+        generated = {"text": text, "summary": extracted["summary"],
+                     "categories": extracted["categories"], "ttft": summary_stream.ttft, "model": stream.model}
+        st.session_state.generated_summary = generated
+
+    # 生成した直後はサマリーを表示済みのため、再実行時のみ表示する
+    if generated["summary"] and not streamed:
+        summary_generator.display_summary(generated["summary"])
+    if generated["categories"]:
+        categorizer.display_categories(generated["categories"])
+    if generated["ttft"] is not None:
+        st.caption(f"最初の応答まで: {generated['ttft']:.1f}秒（{generated.get('model') or '-'}）")
+
+
+def append_recording(stored, labelled, recording_id):
+    """
+    案件に保存済みの区間の後ろに、今回の録音の区間を追加する（分けて録音した面談を1つの記録にする）
+
+    区間には元の録音のrecording_idを保存し、同じ録音が保存済みの場合は追加せず、その録音の区間を
+    今回の結果で置き換える（同じ音声の文字起こしをやり直した場合に、文字起こしの結果が少し違っても重複しない）。
+    追加する区間の時刻は、直前の区間の後に続ける。
+
+    Args:
+        stored (list): 案件に保存済みの区間
+        labelled (list): 今回の録音の話者付きの区間
+        recording_id (str): 今回の録音のID（音声のハッシュなど）
+
+    Returns:
+        tuple: (案件の区間全体, 保存済みの区間から変わったか)
+    """
+    if not labelled:
+        return stored, False
+    positions = [i for i, seg in enumerate(stored) if seg.get("recording_id") == recording_id]
+    first, last = (positions[0], positions[-1] + 1) if positions else (len(stored), len(stored))
+    offset = stored[first - 1]["end"] if first else 0.0
+    added = [{"start": seg["start"] + offset, "end": seg["end"] + offset, "speaker": seg.get("speaker"),
+              "text": seg["text"], "recording_id": recording_id} for seg in labelled]
+    combined = stored[:first] + added + stored[last:]
+    return combined, combined != stored
+
+
+def show_transcription(result, load_audio, recording_id, on_saved=None):
+    """
+    文字起こし結果の表示と、話者分離・案件への保存
+
+    Args:
+        result (dict): 文字起こし結果（text, segments）
+        load_audio (Callable): 話者分離に使う音声（ファイルパスまたは16kHzの配列）を返す関数
+            （キャッシュから結果を表示する場合はデコードしないよう、必要になった時点で呼ぶ）
+        recording_id (str): 録音のID（音声のハッシュなど。同じ録音を案件に重ねて追加しないために使う）
+        on_saved (Callable): 案件に保存した後に呼ぶ関数（録音ファイルの削除など）
+    """
+    st.success("文字起こし結果：")
+    st.write(result["text"])
+    show_summary(result["text"])
+
+    if not st.checkbox("話者分離を行う", key="run_diarization"):
+        return
+    # 同じ音声の話者分離は再実行のたびに行わない
+    cache_key = (result["text"], len(result["segments"]))
+    if st.session_state.get("diarization_key") != cache_key:
+        with st.spinner("話者分離中..."):
+            try:
+                labelled = SpeakerDiarization().separate_speakers(load_audio(), result["segments"])
+            except AudioDecodeError as e:
+                st.error(str(e))
+                labelled = None
+        if labelled is None:
+            return
+        st.session_state.diarization_key = cache_key
+        st.session_state.labelled_segments = labelled
+    labelled = st.session_state.labelled_segments
+    st.subheader("話者分離結果")
+    st.text_area("話者分離", value=to_conversation(labelled), height=200)
+
+    qa_manager = QAManager()
+    cases = qa_manager.get_all_cases()
+    if not cases:
+        st.info("案件を登録すると、話者分離結果を案件に保存できます。")
+        return
+    case_labels = {f"{c['id']}: {c['company_name']}": c["id"] for c in cases}
+    selected = st.selectbox("保存先の案件", list(case_labels))
+    case_id = case_labels[selected]
+    stored = qa_manager.get_case_segments(case_id)
+    combined, changed = append_recording(stored, labelled, recording_id)
+    if changed and any(seg.get("recording_id") == recording_id for seg in stored):
+        st.caption("この録音は案件に保存済みのため、保存済みの区間を今回の結果で置き換えます")
+    elif changed and stored:
+        st.caption(f"案件に保存済みの文字起こし（{len(stored)}区間）の後に、今回の録音を追加します")
+    if st.button("案件に保存"):
+        if qa_manager.save_case_segments(case_id, combined):
+            st.success("話者分離結果を案件に保存しました")
+            changed = False
+            if on_saved:
+                on_saved()
+    # 案件の文字起こし全体を要約し、前回から変わったチャンク（追加した録音の部分）だけをAPIで処理する
+    try:
+        job = estimate_summary(to_conversation(combined), segments=combined)
+        st.caption(f"見積もり（途中結果を使わない場合）: {job['model']}・呼び出し{job['calls']}回・"
+                   f"約{job['seconds']:.0f}秒・約${job['cost_usd']:.3f}")
+    except Exception as e:
+        st.caption(f"所要時間の見積もりに失敗しました: {str(e)}")
+    if st.button("案件の要約を更新"):
+        # 保存していない今回の録音は、案件に保存してから要約する（要約と保存済みの文字起こしを一致させる）
+        if changed:
+            if not qa_manager.save_case_segments(case_id, combined):
+                return
+            if on_saved:
+                on_saved()
+        _, case_summary = summarize(to_conversation(combined), segments=combined, case_id=case_id)
+    else:
+        case_summary = qa_manager.get_case_summary(case_id)
+    if case_summary:
+        st.subheader("案件の要約")
+        st.markdown(case_summary)
+
 
 mode = st.radio("操作モードを選択", ("音声アップロード", "音声録音"), horizontal=True)
 
 if mode == "音声アップロード":
     uploaded_file = st.file_uploader("音声ファイルをアップロードしてください（mp3, wav, m4a など）", type=["mp3", "wav", "m4a"])
     if uploaded_file is not None:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_file:
-            tmp_file.write(uploaded_file.read())
-            tmp_path = tmp_file.name
-        st.info("音声ファイルを文字起こし中...")
-        result = audio_processor.transcribe(tmp_path, language="ja")
-        transcription = result["text"]
-        st.success("文字起こし結果：")
-        st.write(transcription)
+        def transcribe_upload():
+            st.info("音声ファイルを文字起こし中...")
+            # アップロードされたファイルをffmpegで直接デコードし、一時ファイルは作らない
+            audio = decode_audio(uploaded_file)
+            # 無音の位置で区間に分割し、CPUコア数に応じて並列に文字起こし
+            progress_bar = st.progress(0)
+            return transcribe_parallel(
+                audio, language="ja",
+                progress_callback=lambda done, total: progress_bar.progress(done / total, text=f"文字起こし中... ({done}/{total})")
+            )
+
+        try:
+            # 同じ音声は再実行のたびに文字起こしせず、キャッシュの結果を使う
+            result = cached_transcribe(uploaded_file, transcribe_upload, language="ja")
+            show_transcription(result, lambda: decode_audio(uploaded_file), hash_audio(uploaded_file))
+        except AudioDecodeError as e:
+            st.error(str(e))
 elif mode == "音声録音":
-    st.info("下のボタンで録音を開始・停止してください。録音後、自動で文字起こしされます。")
-    audio_data = st_audiorecorder("録音開始", "録音停止")
-    if audio_data is not None:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_file:
-            tmp_file.write(audio_data)
-            tmp_path = tmp_file.name
-        st.info("録音データを文字起こし中...")
-        result = audio_processor.transcribe(tmp_path, language="ja")
-        transcription = result["text"]
-        st.success("文字起こし結果：")
-        st.write(transcription) 
\ No newline at end of file
+    record_method = st.radio(
+        "録音方法を選択",
+        ("ブラウザで録音", "録音しながら文字起こし（サーバーのマイク）"),
+        horizontal=True
+    )
+    if record_method == "ブラウザで録音":
+        st.info("下のボタンで録音を開始・停止してください。録音後、自動で文字起こしされます。")
+        audio_data = st_audiorecorder("録音開始", "録音停止")
+        if audio_data is not None:
+            def transcribe_recording():
+                st.info("録音データを文字起こし中...")
+                return audio_processor.transcribe(decode_audio(audio_data), language="ja")
+
+            try:
+                result = cached_transcribe(audio_data, transcribe_recording, language="ja")
+                show_transcription(result, lambda: decode_audio(audio_data), hash_audio(audio_data))
+            except AudioDecodeError as e:
+                st.error(str(e))
+    else:
+        st.info("録音中は区間ごとに文字起こしを行い、途中経過を表示します。録音終了後は最後の区間だけを処理します。")
+        # 録音ファイル（と区間の結果の.segments.jsonl）は録音ごとに別のパスに保存し、
+        # 案件に保存した時点で削除する（話者分離の結果はセッションに保持している）
+        record_audio(live=True)
+        live_result = st.session_state.get("live_result")
+        if st.session_state.get("recording_status") == "saved" and live_result is not None:
+            # 録音ファイルは案件に保存すると削除するため、ファイル名（録音ごとに一意）をIDにする
+            saved_path = st.session_state.saved_file_path
+            show_transcription(live_result, lambda: saved_path,
+                               os.path.splitext(os.path.basename(saved_path))[0],
+                               on_saved=lambda: discard_recording(saved_path))
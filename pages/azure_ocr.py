@@ -1,10 +1,13 @@
 import streamlit as st
-from pdf2image import convert_from_path
+import io
 import os
 from azure.cognitiveservices.vision.computervision import ComputerVisionClient
 from msrest.authentication import CognitiveServicesCredentials
 import pandas as pd
 import json
+from modules import lazy_imports
+from modules.upload_store import UploadStore
+from modules.thumbnails import get_thumbnail
 
 st.set_page_config(page_title="Azure OCR専用ページ", page_icon="🟦")
 st.title("Azure OCR（画像・PDF対応）")
@@ -27,18 +30,18 @@ def azure_ocr(file_path, want_to_read=None):
     ext = os.path.splitext(file_path)[1].lower()
     results = []
     if ext == ".pdf":
-        images = convert_from_path(file_path)
+        images = lazy_imports.pdf2image().convert_from_path(file_path)
         for i, img in enumerate(images):
-            tmp_img_path = f"tmp_azure_{i}.png"
-            img.save(tmp_img_path, format="PNG")
-            with open(tmp_img_path, "rb") as f:
-                ocr_result = client.recognize_printed_text_in_stream(image=f, language="ja")
+            # 一時ファイルを使わずメモリ上で送信する
+            buf = io.BytesIO()
+            img.save(buf, format="PNG")
+            buf.seek(0)
+            ocr_result = client.recognize_printed_text_in_stream(image=buf, language="ja")
             lines = []
             for region in ocr_result.regions:
                 for line in region.lines:
                     lines.append("".join([w.text for w in line.words]))
             results.append("\n".join(lines))
-            os.remove(tmp_img_path)
         text = "\n".join(results)
     else:
         with open(file_path, "rb") as f:
@@ -65,16 +68,15 @@ uploaded_file = st.file_uploader("画像またはPDFを選択", type=["png", "jp
 
 if uploaded_file:
     st.success("ファイルがアップロードされました。次に進んでください。")
-    # 一時保存
-    file_ext = uploaded_file.name.split('.')[-1].lower()
-    file_type = "image" if file_ext in ["png", "jpg", "jpeg"] else "pdf"
-    save_path = f"tmp_{uploaded_file.name}"
-    with open(save_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-    # プレビュー
-    if file_type == "image":
-        st.image(save_path, caption=uploaded_file.name, width=350)
-    else:
+    # 内容のハッシュ値で保存（同じファイルは重複して保存しない）
+    blob = UploadStore("db/qa.db").put_upload(uploaded_file)
+    file_type = "image" if blob["mime"].startswith("image/") else "pdf"
+    save_path = blob["path"]
+    # プレビュー（サムネイル）
+    thumb = get_thumbnail(save_path)
+    if thumb:
+        st.image(thumb, caption=uploaded_file.name, width=350)
+    if file_type != "image":
         st.markdown(f"[PDFを開く]({save_path})")
 
     # --- 2. OCR実行 ---